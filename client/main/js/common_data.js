@@ -93,7 +93,7 @@ function setGamePlayerJoin(game_id, player_id, client_id) {
   }
   pubsub.publish(enums.PubSub.Client_RemoveLobbyClient, client_id);
   pubsub.publish(enums.PubSub.Client_SetGamePlayerJoin, game_id, player_id, client_id);
-  if (client_id === data.client_id) {
+  if (client_id === data.client_id && !data.resetting_lobby) {
     pubsub.publish(enums.PubSub.Client_JoinGame);
   }
 }
@@ -112,7 +112,7 @@ function setGamePlayerRejoin(game_id, player_id, client_id) {
   pubsub.publish(enums.PubSub.Client_SetGamePlayerData, game_id, player_id, data.game_id_to_player_data[game_id][player_id].username, client_id);
   pubsub.publish(enums.PubSub.Client_RemoveLobbyClient, client_id);
   pubsub.publish(enums.PubSub.Client_SetGamePlayerRejoin, game_id, player_id, client_id);
-  if (client_id === data.client_id) {
+  if (client_id === data.client_id && !data.resetting_lobby) {
     pubsub.publish(enums.PubSub.Client_JoinGame);
   }
 }
@@ -162,7 +162,7 @@ function setGameWatcherClientId(game_id, client_id) {
 
   pubsub.publish(enums.PubSub.Client_RemoveLobbyClient, client_id);
   pubsub.publish(enums.PubSub.Client_AddGameWatcher, game_id, client_id);
-  if (client_id === data.client_id) {
+  if (client_id === data.client_id && !data.resetting_lobby) {
     pubsub.publish(enums.PubSub.Client_JoinGame);
   }
 }
@@ -193,10 +193,28 @@ function destroyGame(game_id) {
   delete data.game_id_to_watcher_client_ids[game_id];
 }
 
+// the server sends the whole lobby after this, including the user's game if in one
+function resetLobby() {
+  data.resetting_lobby = true;
+  data.client_id_to_data = {};
+  data.game_id_to_state_id = {};
+  data.game_id_to_mode_id = {};
+  data.game_id_to_max_players = {};
+  data.game_id_to_score = {};
+  data.game_id_to_number_of_players = {};
+  data.game_id_to_player_data = {};
+  data.game_id_to_watcher_client_ids = {};
+}
+
+function messageProcessingComplete() {
+  data.resetting_lobby = false;
+}
+
 function reset() {
   data.client_id = null;
   data.game_id = null;
   data.player_id = null;
+  data.resetting_lobby = false;
   data.client_id_to_data = {};
   data.game_id_to_state_id = {};
   data.game_id_to_mode_id = {};
@@ -219,6 +237,8 @@ pubsub.subscribe(enums.PubSub.Server_SetGamePlayerJoinMissing, setGamePlayerJoin
 pubsub.subscribe(enums.PubSub.Server_SetGameWatcherClientId, setGameWatcherClientId);
 pubsub.subscribe(enums.PubSub.Server_ReturnWatcherToLobby, returnWatcherToLobby);
 pubsub.subscribe(enums.PubSub.Server_DestroyGame, destroyGame);
+pubsub.subscribe(enums.PubSub.Server_ResetLobby, resetLobby);
+pubsub.subscribe(enums.PubSub.Network_MessageProcessingComplete, messageProcessingComplete);
 pubsub.subscribe(enums.PubSub.Network_Disconnect, reset);
 
 module.exports = data;
@@ -366,6 +366,29 @@ function setGameBoardCell(x, y, game_board_type_id) {
   $cell.text(text);
 }
 
+// arguments after game_board_type_id are cell indexes (x * 9 + y). -n after an index stands for the n indexes following it.
+function setGameBoardCells(game_board_type_id) {
+  var num_arguments = arguments.length,
+    i,
+    value,
+    index = 0,
+    end_index;
+
+  for (i = 1; i < num_arguments; i++) {
+    value = arguments[i];
+    if (value >= 0) {
+      index = value;
+      setGameBoardCell(Math.floor(index / 9), index % 9, game_board_type_id);
+    } else {
+      end_index = index - value;
+      while (index < end_index) {
+        index++;
+        setGameBoardCell(Math.floor(index / 9), index % 9, game_board_type_id);
+      }
+    }
+  }
+}
+
 function setGameBoard(x_to_y_to_board_type) {
   var num_x, x, y_to_board_type, num_y, y, board_type;
 
@@ -1346,6 +1369,11 @@ function leaveGameButtonClicked() {
   network.sendMessage(enums.CommandsToServer.LeaveGame);
 }
 
+function sendInGameSubscriptions() {
+  // the lobby and global chat only need to be sent while in a game if they are shown
+  network.sendMessage(enums.CommandsToServer.SetInGameSubscriptions, show_lobby, show_global_chat);
+}
+
 function initializeMessageWindows() {
   lobby.setShowOnGamePage(show_lobby);
   $('#show-lobby').prop('checked', show_lobby);
@@ -1389,6 +1417,10 @@ function messageWindowCheckboxClicked() {
       break;
   }
 
+  if (key === 'lobby' || key === 'global-chat') {
+    sendInGameSubscriptions();
+  }
+
   setMessageWindowPositions();
 }
 
@@ -1461,7 +1493,9 @@ pubsub.subscribe(enums.PubSub.Client_SetOption, setOption);
 pubsub.subscribe(enums.PubSub.Client_Resize, resize);
 pubsub.subscribe(enums.PubSub.Client_SetGamePlayerData, setGamePlayerData);
 pubsub.subscribe(enums.PubSub.Client_JoinGame, joinGame);
+pubsub.subscribe(enums.PubSub.Server_SetClientId, sendInGameSubscriptions);
 pubsub.subscribe(enums.PubSub.Server_SetGameBoardCell, setGameBoardCell);
+pubsub.subscribe(enums.PubSub.Server_SetGameBoardCells, setGameBoardCells);
 pubsub.subscribe(enums.PubSub.Server_SetGameBoard, setGameBoard);
 pubsub.subscribe(enums.PubSub.Server_SetTile, setTile);
 pubsub.subscribe(enums.PubSub.Server_SetTileGameBoardType, setTileGameBoardType);
@@ -118,7 +118,7 @@ function addGameChatMessage(client_id, chat_message) {
 function addClientLocationMessage(template_selector, client_id, game_id) {
   var $message;
 
-  if (game_id === common_data.game_id && client_id !== common_data.client_id) {
+  if (game_id === common_data.game_id && client_id !== common_data.client_id && !common_data.resetting_lobby) {
     $message = $(template_selector).clone().removeAttr('id');
 
     $message.find('.username').text(common_data.client_id_to_data[client_id].username);
@@ -108,10 +108,12 @@ function chatHistoryScrolled() {
   }
 }
 
-function addGlobalChatMessage(client_id, chat_message) {
-  var $message = $('#chat-message').clone().removeAttr('id');
+function addGlobalChatMessage(client_id, chat_message, username) {
+  var $message = $('#chat-message').clone().removeAttr('id'),
+    client_data = common_data.client_id_to_data[client_id];
 
-  $message.find('.username').text(common_data.client_id_to_data[client_id].username);
+  // username is sent for users who are not receiving lobby changes while in a game
+  $message.find('.username').text(client_data ? client_data.username : username);
   $message.find('.chat-message-contents').text(chat_message);
 
   appendElement($message);
@@ -238,6 +240,12 @@ function removeClient(client_id) {
   addClientLocationMessage('#global-chat-remove-client', client_id);
 }
 
+function resetLobby() {
+  // do not report everyone in the lobby again
+  add_client_location_messages = false;
+  game_ids_with_changed_state = [];
+}
+
 function reset() {
   $('#global-chat .chat-history').empty();
   $('#global-chat .chat-history-new-messages').hide();
@@ -257,6 +265,7 @@ pubsub.subscribe(enums.PubSub.Client_SetGameState, gameStateChanged);
 pubsub.subscribe(enums.PubSub.Client_SetGamePlayerJoin, gameStateChanged);
 pubsub.subscribe(enums.PubSub.Client_AddClient, addClient);
 pubsub.subscribe(enums.PubSub.Client_RemoveClient, removeClient);
+pubsub.subscribe(enums.PubSub.Server_ResetLobby, resetLobby);
 pubsub.subscribe(enums.PubSub.Network_Disconnect, reset);
 pubsub.subscribe(enums.PubSub.Client_InitializationComplete, onInitializationComplete);
 
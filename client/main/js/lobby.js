@@ -452,6 +452,7 @@ pubsub.subscribe(enums.PubSub.Client_SetGamePlayerJoinMissing, setGamePlayerJoin
 pubsub.subscribe(enums.PubSub.Client_AddGameWatcher, addGameWatcher);
 pubsub.subscribe(enums.PubSub.Client_RemoveGameWatcher, removeGameWatcher);
 pubsub.subscribe(enums.PubSub.Server_DestroyGame, destroyGame);
+pubsub.subscribe(enums.PubSub.Server_ResetLobby, reset);
 pubsub.subscribe(enums.PubSub.Network_MessageProcessingComplete, messageProcessingComplete);
 pubsub.subscribe(enums.PubSub.Network_Disconnect, reset);
 pubsub.subscribe(enums.PubSub.Client_InitializationComplete, onInitializationComplete);
@@ -18,7 +18,7 @@ cp -a client/main/static/* dist/web/static
 cp server/server.py dist/server.py
 
 # other .py files
-cp -a server/cron.py server/enums.py server/orm.py server/settings.py server/util.py dist
+cp -a server/checkpoint.py server/cron.py server/enums.py server/event_log.py server/orm.py server/settings.py server/util.py server/websocket.py dist
 
 # main.css
 ./node_modules/clean-css/bin/cleancss --s0 client/main/css/main.css | sed "s/\.\.\/static\///" > dist/build/main.css
@@ -74,6 +74,9 @@ sed "s/var server_version = 'VERSION';/var server_version = '${VERSION}';/" dist
 sed "s/var enums = require('\.\.\/client\/main\/js\/enums');/\/\/ var enums = require('\.\.\/client\/main\/js\/enums');/" > dist/server.js
 chmod u+x dist/server.js
 
+# finish server.py
+sed -i "s/^server_version = \"VERSION\"$/server_version = \"${VERSION}\"/" dist/server.py
+
 # cleanup
 rm -rf dist/build
 
@@ -0,0 +1,908 @@
+import asyncio
+import checkpoint
+import collections
+import enums
+import gc
+import multiprocessing
+import os
+import random
+import server
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+import ujson
+import websocket
+
+
+class LegacyServerProtocol:
+    # ServerProtocol.data_received before the bytearray receive buffer, kept for comparison
+    def __init__(self, handle_line):
+        self.handle_line = handle_line
+        self.unprocessed_data = []
+
+    def data_received(self, data):
+        start_index = 0
+        len_data = len(data)
+        while start_index < len_data:
+            index = data.find(b"\n", start_index)
+            if index >= 0:
+                key_and_value = data[start_index:index]
+                start_index = index + 1
+
+                if self.unprocessed_data:
+                    key_and_value = b"".join(self.unprocessed_data) + key_and_value
+                    del self.unprocessed_data[:]
+
+                key, value = key_and_value.split(b" ", 1)
+                self.handle_line(key, value)
+            else:
+                self.unprocessed_data.append(data[start_index:])
+                break
+
+
+class FramingServerProtocol(server.ServerProtocol):
+    def __init__(self, handle_line):
+        super().__init__(None)
+        self.handle_line = handle_line
+
+
+def get_framing_chunks(num_lines, chunk_size):
+    lines = []
+    for index in range(num_lines):
+        client_id = index % 200 + 1
+        if index % 3 == 0:
+            lines.append(b"%d [5,6,[0,3],0]\n" % client_id)
+        elif index % 3 == 1:
+            lines.append(b"%d [5,1,%d]\n" % (client_id, index % 6))
+        else:
+            lines.append(
+                b'%d [6,"%s"]\n' % (client_id, b"chat message " * (index % 20 + 1))
+            )
+    data = b"".join(lines)
+    return [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def benchmark_framing(num_lines=200000, chunk_size=4096, repeat=5):
+    chunks = get_framing_chunks(num_lines, chunk_size)
+    num_bytes = sum(len(chunk) for chunk in chunks)
+
+    def handle_line(key, value):
+        # do what Client.on_message does with the payload
+        value.decode()
+
+    for name, protocol_class in [
+        ("legacy", LegacyServerProtocol),
+        ("buffer", FramingServerProtocol),
+    ]:
+        best = None
+        for _ in range(repeat):
+            protocol = protocol_class(handle_line)
+            start = time.perf_counter()
+            for chunk in chunks:
+                protocol.data_received(chunk)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(
+            "framing %s chunk_size=%d: %.1f MB/s, %d lines/s"
+            % (
+                name,
+                chunk_size,
+                num_bytes / best / 1000000,
+                num_lines / best,
+            )
+        )
+
+
+def get_game_board_benchmark_board(seed):
+    # a late game board: a few large chains separated by empty cells
+    rng = random.Random(seed)
+    board = [[enums.GameBoardTypes.Nothing.value for y in range(9)] for x in range(12)]
+    for x in range(12):
+        for y in range(9):
+            if rng.random() < 0.7:
+                board[x][y] = rng.choice(
+                    [0, 1, 2, enums.GameBoardTypes.NothingYet.value]
+                )
+    return board
+
+
+def benchmark_game_board(num_boards=200, repeat=5):
+    boards = [get_game_board_benchmark_board(seed) for seed in range(num_boards)]
+
+    for game_board_class in [server.GameBoard, server.BitboardGameBoard]:
+        best_fill = None
+        best_chain_size = None
+        for _ in range(repeat):
+            game_boards = []
+            for board in boards:
+                game = types.SimpleNamespace(
+                    client_ids=set(),
+                    add_pending_messages=lambda *args: None,
+                    headless=False,
+                )
+                game_boards.append(
+                    game_board_class(game, [list(column) for column in board])
+                )
+
+            start = time.perf_counter()
+            for game_board in game_boards:
+                # merge everything connected to the middle of the board into Luxor
+                game_board.fill_cells((6, 4), enums.GameBoardTypes.Luxor.value)
+            elapsed = time.perf_counter() - start
+            best_fill = elapsed if best_fill is None else min(best_fill, elapsed)
+
+            start = time.perf_counter()
+            for game_board in game_boards:
+                for board_type in range(7):
+                    game_board.get_chain_size(board_type)
+            elapsed = time.perf_counter() - start
+            best_chain_size = (
+                elapsed if best_chain_size is None else min(best_chain_size, elapsed)
+            )
+
+        print(
+            "game board %s: %.1f us/fill_cells, %.2f us/get_chain_size"
+            % (
+                game_board_class.__name__,
+                best_fill / num_boards * 1000000,
+                best_chain_size / num_boards / 7 * 1000000,
+            )
+        )
+
+
+def get_merger_benchmark_board(seed):
+    # a late game merger: two large chains on either side of an empty column, joined by
+    # the tile in that column
+    rng = random.Random(seed)
+    board = [[enums.GameBoardTypes.Nothing.value for y in range(9)] for x in range(12)]
+    split_x = rng.randrange(3, 9)
+    for x in range(12):
+        for y in range(9):
+            if x < split_x:
+                board[x][y] = enums.GameBoardTypes.Luxor.value
+            elif x > split_x:
+                board[x][y] = enums.GameBoardTypes.Tower.value
+    return board, (split_x, rng.randrange(9))
+
+
+def benchmark_merger(num_boards=200, repeat=5):
+    boards = [get_merger_benchmark_board(seed) for seed in range(num_boards)]
+
+    for game_board_class in [
+        server.GameBoard,
+        server.BitboardGameBoard,
+        server.UnionFindGameBoard,
+    ]:
+        best = None
+        num_messages = 0
+        for _ in range(repeat):
+            game_boards = []
+            for board, tile in boards:
+                game = types.SimpleNamespace(
+                    client_ids=set(),
+                    add_pending_messages=lambda *args: None,
+                    headless=False,
+                )
+                game_boards.append(
+                    (game_board_class(game, [list(column) for column in board]), tile)
+                )
+
+            start = time.perf_counter()
+            for game_board, tile in game_boards:
+                game_board.fill_cells(tile, enums.GameBoardTypes.Luxor.value)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(
+            "merger %s: %.1f us/fill_cells"
+            % (game_board_class.__name__, best / num_boards * 1000000)
+        )
+
+
+def play_game(tile_bag, num_players, actions, headless, add_pending_messages=None):
+    # plays a game from a tile bag and a list of (player id, game action id, data)
+    game = server.Game(
+        1,
+        1,
+        enums.GameModes.Singles.value,
+        num_players,
+        add_pending_messages or (lambda *args: None),
+        False,
+        list(tile_bag),
+        headless=headless,
+    )
+    clients = [
+        types.SimpleNamespace(
+            client_id=player_id + 1,
+            username="user%d" % player_id,
+            game_id=None,
+            player_id=None,
+        )
+        for player_id in range(num_players)
+    ]
+    for client in clients:
+        game.join_game(client)
+    player_id_to_client = {client.player_id: client for client in clients}
+
+    for player_id, game_action_id, data in actions:
+        game.do_game_action(player_id_to_client[player_id], game_action_id, data)
+
+    return game
+
+
+def get_random_game(seed, max_actions=2000):
+    # returns a tile bag, a number of players and the actions of a game with random moves
+    rng = random.Random(seed)
+    tile_bag = [(x, y) for x in range(12) for y in range(9)]
+    rng.shuffle(tile_bag)
+    num_players = rng.randint(2, 6)
+    game = play_game(tile_bag, num_players, [], True)
+
+    actions = []
+    for _ in range(max_actions):
+        action = game.actions[-1]
+        if action.game_action_id == enums.GameActions.GameOver.value:
+            break
+        client = game.score_sheet.player_data[action.player_id][
+            enums.ScoreSheetIndexes.Client.value
+        ]
+        game_action = rng.choice(game.legal_actions(action.player_id))
+        game.do_game_action(client, game_action[0], game_action[1:])
+        actions.append((action.player_id, game_action[0], game_action[1:]))
+
+    return tile_bag, num_players, actions
+
+
+def benchmark_headless(num_games=200, repeat=3):
+    games = [get_random_game(seed) for seed in range(num_games)]
+    num_actions = sum(len(actions) for _, _, actions in games)
+
+    for name, headless in [("normal", False), ("headless", True)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for tile_bag, num_players, actions in games:
+                play_game(tile_bag, num_players, actions, headless)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(
+            "replay %s: %.1f games/s, %d actions/s"
+            % (name, num_games / best, num_actions / best)
+        )
+
+
+def benchmark_snapshot(num_games=200, repeat=5):
+    # games stopped half way through
+    games = []
+    for seed in range(num_games):
+        tile_bag, num_players, actions = get_random_game(seed)
+        games.append(
+            play_game(tile_bag, num_players, actions[: len(actions) // 2], True)
+        )
+
+    best_snapshot = None
+    best_restore = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        snapshots = [game.snapshot() for game in games]
+        elapsed = time.perf_counter() - start
+        best_snapshot = (
+            elapsed if best_snapshot is None else min(best_snapshot, elapsed)
+        )
+
+        start = time.perf_counter()
+        for game, snapshot in zip(games, snapshots):
+            game.restore(snapshot)
+        elapsed = time.perf_counter() - start
+        best_restore = elapsed if best_restore is None else min(best_restore, elapsed)
+
+    print(
+        "game snapshot: %.1f us/snapshot, %.1f us/restore"
+        % (best_snapshot / num_games * 1000000, best_restore / num_games * 1000000)
+    )
+
+
+def benchmark_legal_actions(num_games=100, repeat=3):
+    # the states of games played with random legal actions
+    snapshots = []
+    for seed in range(num_games):
+        tile_bag, num_players, actions = get_random_game(seed)
+        game = play_game(tile_bag, num_players, [], True)
+        player_id_to_client = {
+            player_id: player_datum[enums.ScoreSheetIndexes.Client.value]
+            for player_id, player_datum in enumerate(game.score_sheet.player_data)
+        }
+        for player_id, game_action_id, data in actions:
+            snapshots.append(game.snapshot())
+            game.do_game_action(player_id_to_client[player_id], game_action_id, data)
+
+    game_action_id_to_games = collections.defaultdict(list)
+    for snapshot in snapshots:
+        game = server.Game(
+            1,
+            1,
+            enums.GameModes.Singles.value,
+            6,
+            lambda *args: None,
+            False,
+            headless=True,
+        )
+        game.restore(snapshot)
+        game_action_id_to_games[game.actions[-1].game_action_id].append(game)
+
+    for game_action_id, games in sorted(game_action_id_to_games.items()):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            num_legal_actions = 0
+            for game in games:
+                num_legal_actions += len(game.legal_actions(game.actions[-1].player_id))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(
+            "legal actions %s: %.1f us/call, %.1f legal actions/call, %d calls/s"
+            % (
+                enums.GameActions(game_action_id).name,
+                best / len(games) * 1000000,
+                num_legal_actions / len(games),
+                len(games) / best,
+            )
+        )
+
+
+def benchmark_history(num_games=50, repeat=5):
+    # catching up a watcher on the history of finished games, encoding the history every
+    # time and with the encoded history cached
+    games = []
+    for seed in range(num_games):
+        game = play_game(*get_random_game(seed), False)
+        game.add_pending_batch = lambda *args: None
+        games.append(game)
+    num_history_messages = sum(len(game.history_messages) for game in games)
+    watcher = types.SimpleNamespace(
+        client_id=100, username="watcher", game_id=None, player_id=None
+    )
+
+    for name, clear_cache in [("uncached", True), ("cached", False)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for game in games:
+                if clear_cache:
+                    game.history_player_id_to_json.clear()
+                game._send_past_history_messages(watcher)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(
+            "history catch-up %s: %.1f us/catch-up of %.0f history messages"
+            % (name, best / num_games * 1000000, num_history_messages / num_games)
+        )
+
+
+def benchmark_initialization(num_games=50, repeat=5):
+    # the state sent to watchers of games stopped half way, built every time and cached
+    games = []
+    for seed in range(num_games):
+        tile_bag, num_players, actions = get_random_game(seed)
+        game = play_game(tile_bag, num_players, actions[: len(actions) // 2], False)
+        game.add_pending_batch = lambda *args: None
+        games.append(game)
+    watcher = types.SimpleNamespace(
+        client_id=100, username="watcher", game_id=None, player_id=None
+    )
+
+    for name, new_state_version in [("uncached", True), ("cached", False)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for game in games:
+                if new_state_version:
+                    game.state_version += 1
+                game._send_initialization_messages(watcher)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(
+            "watcher initialization %s: %.1f us/watcher"
+            % (name, best / num_games * 1000000)
+        )
+
+
+def benchmark_checkpoint(num_games=4000, num_distinct_games=200):
+    # games stopped at random points, checkpointed once each and then restored like at
+    # startup. the distinct games are reused under other ids.
+    games = []
+    for seed in range(num_distinct_games):
+        tile_bag, num_players, actions = get_random_game(seed)
+        num_actions = random.Random(seed).randint(0, len(actions))
+        games.append(play_game(tile_bag, num_players, actions[:num_actions], True))
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "checkpoints")
+        writer = checkpoint.CheckpointWriter()
+        writer.open(filename)
+        start = time.perf_counter()
+        for game_id in range(1, num_games + 1):
+            game = games[game_id % num_distinct_games]
+            game.game_id = game_id
+            game.internal_game_id = game_id
+            writer.write_game(game_id, tuple(game.get_checkpoint()))
+        writer.flush()
+        write_elapsed = time.perf_counter() - start
+        writer.close()
+        size = os.path.getsize(filename)
+
+        # like server.main
+        server_ = server.Server()
+        gc.disable()
+        start = time.perf_counter()
+        internal_game_id_to_checkpoint, last_internal_game_id = writer.open(filename)
+        open_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        server_.restore_games(
+            internal_game_id_to_checkpoint.values(), last_internal_game_id
+        )
+        restore_elapsed = time.perf_counter() - start
+        gc.freeze()
+        gc.enable()
+        writer.close()
+
+    print(
+        "checkpoint: %.1f us/game, %d bytes/game"
+        % (write_elapsed / num_games * 1000000, size / num_games)
+    )
+    print(
+        "warm restart of %d games: %.3fs reading and compacting, %.3fs restoring"
+        % (num_games, open_elapsed, restore_elapsed)
+    )
+
+
+def get_game_process_requests(game_id, seed):
+    # the requests of a lobby for a game with random moves, and their count
+    tile_bag, num_players, actions = get_random_game(seed)
+    game = play_game(tile_bag, num_players, [], True)
+    player_id_to_client_id = {}
+    requests = [
+        "create-game "
+        + ujson.dumps(
+            [game_id, game_id, enums.GameModes.Singles.value, num_players, tile_bag]
+        )
+    ]
+    for player_id in range(num_players):
+        client_id = game_id * 10 + player_id
+        requests.append(
+            "join-game " + ujson.dumps([game_id, client_id, "user%d" % player_id])
+        )
+        player_id_to_client_id[
+            game.score_sheet.username_to_player_id["user%d" % player_id]
+        ] = client_id
+    for player_id, game_action_id, data in actions:
+        requests.append(
+            "do-game-action "
+            + ujson.dumps(
+                [game_id, player_id_to_client_id[player_id], game_action_id, data]
+            )
+        )
+    return "".join(request + "\n" for request in requests).encode(), len(requests)
+
+
+def benchmark_game_processes(num_games=400, max_processes=None):
+    # games played through game processes as fast as they reply, like server.main with
+    # --game-processes. game ids are spread over the processes like Server.create_game.
+    if max_processes is None:
+        max_processes = max(multiprocessing.cpu_count(), 2)
+    games = [
+        get_game_process_requests(game_id, seed)
+        for seed, game_id in enumerate(range(1, num_games + 1))
+    ]
+    num_actions = sum(num_requests for _, num_requests in games)
+
+    def send_and_receive(lobby_socket, data, num_requests):
+        sender = threading.Thread(target=lobby_socket.sendall, args=(data,))
+        sender.start()
+        receive_buffer = b""
+        while num_requests:
+            receive_buffer += lobby_socket.recv(262144)
+            lines = receive_buffer.split(b"\n")
+            receive_buffer = lines.pop()
+            for line in lines:
+                if line.startswith(b"end "):
+                    num_requests -= int(line[4:])
+        sender.join()
+
+    print("%d cpus" % multiprocessing.cpu_count())
+    for num_processes in range(1, max_processes + 1):
+        game_processes = [server.start_game_process() for _ in range(num_processes)]
+        process_data = [[] for _ in range(num_processes)]
+        process_num_requests = [0] * num_processes
+        for game_id, (data, num_requests) in enumerate(games, 1):
+            index = (game_id - 1) % num_processes
+            process_data[index].append(data)
+            process_num_requests[index] += num_requests
+
+        start = time.perf_counter()
+        threads = [
+            threading.Thread(
+                target=send_and_receive,
+                args=(lobby_socket, b"".join(data), num_requests),
+            )
+            for (_, lobby_socket), data, num_requests in zip(
+                game_processes, process_data, process_num_requests
+            )
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        # later game processes have copies of the earlier ones' lobby sockets
+        for process, lobby_socket in game_processes:
+            lobby_socket.close()
+        for process, lobby_socket in game_processes:
+            process.join()
+
+        print(
+            "%d game processes: %.1f games/s, %d requests/s"
+            % (num_processes, num_games / elapsed, num_actions / elapsed)
+        )
+
+
+def benchmark_frontends(num_clients=1000, num_messages=2000, repeat=3):
+    # global chat messages to all clients, flushed one at a time, with the clients spread
+    # over one or more frontend connections
+    enabled_categories = server.log_writer.enabled_categories
+    server.log_writer.enabled_categories = set()
+    for num_frontends in [1, 2, 4, 8]:
+        the_server = server.Server()
+        frontends = []
+        written_sizes = []
+        for _ in range(num_frontends):
+            frontend = server.ServerProtocol(the_server)
+            frontend.connection_made(
+                types.SimpleNamespace(
+                    write=lambda data: written_sizes.append(len(data))
+                )
+            )
+            frontends.append(frontend)
+        for index in range(num_clients):
+            frontends[index % num_frontends].data_received(
+                b'connect ["user%d","1.2.3.4",%d,false]\n' % (index, index)
+            )
+
+        best = None
+        for _ in range(repeat):
+            del written_sizes[:]
+            start = time.perf_counter()
+            for index in range(num_messages):
+                frontends[index % num_frontends].data_received(
+                    b'%d [6,"chat message"]\n' % (index % num_clients + 1)
+                )
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(
+            "%d frontends: %.1f us/message, %.1f bytes/message"
+            % (
+                num_frontends,
+                best / num_messages * 1000000,
+                sum(written_sizes) / num_messages,
+            )
+        )
+    server.log_writer.enabled_categories = enabled_categories
+
+
+def benchmark_websocket(num_round_trips=2000):
+    # round trips of a global chat message from a client back to it, through the built-in
+    # websocket listener, and through python.sock the way server.js sends it. the second
+    # does not include server.js itself, which is the hop the websocket listener removes.
+    enabled_categories = server.log_writer.enabled_categories
+    server.log_writer.enabled_categories = set()
+    the_server = server.Server()
+    loop = asyncio.new_event_loop()
+    directory = tempfile.mkdtemp()
+    unix_path = os.path.join(directory, "python.sock")
+    loop.run_until_complete(
+        loop.create_unix_server(lambda: server.ServerProtocol(the_server), unix_path)
+    )
+    websocket_server = loop.run_until_complete(
+        loop.create_server(lambda: server.WebSocketProtocol(the_server), "127.0.0.1", 0)
+    )
+    port = websocket_server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def receive_until(sock, receive_buffer, marker):
+        while marker not in receive_buffer:
+            receive_buffer += sock.recv(65536)
+        index = receive_buffer.index(marker) + len(marker)
+        return receive_buffer[index:]
+
+    def masked_frame(payload):
+        mask = os.urandom(4)
+        frame = websocket.encode_frame(websocket.unmask(payload, mask))
+        header_size = len(frame) - len(payload)
+        return (
+            frame[:1]
+            + bytes([frame[1] | 0x80])
+            + frame[2:header_size]
+            + mask
+            + frame[header_size:]
+        )
+
+    # websocket
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(
+        b"GET /sockjs/websocket HTTP/1.1\r\nHost: x\r\nUpgrade: websocket\r\n"
+        b"Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+        b"Sec-WebSocket-Version: 13\r\n\r\n"
+    )
+    receive_buffer = receive_until(sock, b"", b"\r\n\r\n")
+    sock.sendall(masked_frame(b'["%s","ws",""]' % server.server_version.encode()))
+    receive_buffer = receive_until(sock, receive_buffer, b'"ws","127.0.0.1"]')
+    websocket_times = []
+    for index in range(num_round_trips):
+        marker = b'"m%d","ws"]' % index
+        start = time.perf_counter()
+        sock.sendall(masked_frame(b'[6,"m%d"]' % index))
+        receive_buffer = receive_until(sock, receive_buffer, marker)
+        websocket_times.append(time.perf_counter() - start)
+    sock.close()
+
+    # python.sock
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(unix_path)
+    sock.sendall(b'connect ["unix","127.0.0.1","unix",false]\n')
+    receive_buffer = receive_until(sock, b"", b'"unix","127.0.0.1"]')
+    client_id = the_server.username_to_client["unix"].client_id
+    unix_times = []
+    for index in range(num_round_trips):
+        marker = b'"m%d","unix"]]\n' % index
+        start = time.perf_counter()
+        sock.sendall(b'%d [6,"m%d"]\n' % (client_id, index))
+        receive_buffer = receive_until(sock, receive_buffer, marker)
+        unix_times.append(time.perf_counter() - start)
+    sock.close()
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    os.remove(unix_path)
+    os.rmdir(directory)
+    server.log_writer.enabled_categories = enabled_categories
+
+    for name, times in [("websocket", websocket_times), ("python.sock", unix_times)]:
+        times.sort()
+        print(
+            "%s: median %.1f us, 99th percentile %.1f us per round trip"
+            % (
+                name,
+                statistics.median(times) * 1000000,
+                times[len(times) * 99 // 100] * 1000000,
+            )
+        )
+
+
+def benchmark_backpressure(num_games=20, num_watchers=20):
+    # games played through a frontend on a socket that is not read from until the end,
+    # like a stalled server.js, with and without a write buffer limit that holds and
+    # coalesces messages
+    enabled_categories = server.log_writer.enabled_categories
+    server.log_writer.enabled_categories = set()
+    for write_buffer_limit in [1 << 40, None]:
+        random.seed(0)
+        rng = random.Random(0)
+        loop = asyncio.new_event_loop()
+        the_server = server.Server(write_buffer_limit=write_buffer_limit)
+        server_socket, frontend_socket = socket.socketpair(socket.AF_UNIX)
+        _, frontend = loop.run_until_complete(
+            loop.create_unix_connection(
+                lambda: server.ServerProtocol(the_server), sock=server_socket
+            )
+        )
+        frontend.transport.pause_reading = lambda: None
+
+        def send(line):
+            frontend.data_received(line.encode() + b"\n")
+
+        for index in range(num_watchers):
+            send('connect ["watcher%d","127.0.0.1",%d,false]' % (index, index))
+
+        max_buffered = 0
+        num_actions = 0
+        start = time.perf_counter()
+        for game_index in range(num_games):
+            num_players = rng.randint(2, 6)
+            client_ids = []
+            for player_id in range(num_players):
+                username = "player%d-%d" % (game_index, player_id)
+                send('connect ["%s","127.0.0.1","%s",false]' % (username, username))
+                client_ids.append(the_server.username_to_client[username].client_id)
+            send("%d [0,0,%d]" % (client_ids[0], num_players))
+            game = the_server.game_id_to_game[
+                the_server.client_id_to_client[client_ids[0]].game_id
+            ]
+            for client_id in client_ids[1:]:
+                send("%d [1,%d]" % (client_id, game.game_id))
+            for index in range(num_watchers):
+                send("%d [3,%d]" % (index + 1, game.game_id))
+
+            while True:
+                action = game.actions[-1]
+                if action.game_action_id == enums.GameActions.GameOver.value:
+                    break
+                client = game.score_sheet.player_data[action.player_id][
+                    enums.ScoreSheetIndexes.Client.value
+                ]
+                game_action = rng.choice(game.legal_actions(action.player_id))
+                send("%d %s" % (client.client_id, ujson.dumps([5] + game_action)))
+                num_actions += 1
+                loop.run_until_complete(asyncio.sleep(0))
+                max_buffered = max(
+                    max_buffered,
+                    frontend.transport.get_write_buffer_size()
+                    + frontend.held_messages.num_bytes,
+                )
+
+            for client_id in client_ids:
+                send("%d [4]" % client_id)
+                send("disconnect %d" % client_id)
+            for index in range(num_watchers):
+                send("%d [4]" % (index + 1))
+        elapsed = time.perf_counter() - start
+
+        # drain the socket like the frontend catching up
+        num_bytes = 0
+        frontend_socket.setblocking(False)
+        while frontend.transport.get_write_buffer_size() or frontend.writing_paused:
+            try:
+                num_bytes += len(frontend_socket.recv(1 << 20))
+            except BlockingIOError:
+                pass
+            loop.run_until_complete(asyncio.sleep(0))
+        try:
+            while True:
+                data = frontend_socket.recv(1 << 20)
+                if not data:
+                    break
+                num_bytes += len(data)
+        except BlockingIOError:
+            pass
+
+        print(
+            "write buffer limit %s: %d actions in %.2fs, at most %d bytes buffered and held, %d bytes sent, %d messages coalesced"
+            % (
+                "none" if write_buffer_limit == 1 << 40 else "default",
+                num_actions,
+                elapsed,
+                max_buffered,
+                num_bytes,
+                frontend.held_messages.coalesced_count,
+            )
+        )
+        frontend.transport.close()
+        loop.run_until_complete(asyncio.sleep(0))
+        frontend_socket.close()
+        loop.close()
+    server.log_writer.enabled_categories = enabled_categories
+
+
+def get_per_cell_messages(message):
+    # a SetGameBoardCells message as the SetGameBoardCell messages it replaced
+    if message[0] != enums.CommandsToClient.SetGameBoardCells.value:
+        return [message]
+    return [
+        [
+            enums.CommandsToClient.SetGameBoardCell.value,
+            index // 9,
+            index % 9,
+            message[1],
+        ]
+        for index in server.get_set_game_board_cells_indexes(message)
+    ]
+
+
+def get_board_messages_bytes(messages):
+    # the bytes of the board cell messages as sent, and as a SetGameBoardCell per cell
+    board_command_ids = {
+        enums.CommandsToClient.SetGameBoardCell.value,
+        enums.CommandsToClient.SetGameBoardCells.value,
+    }
+    board_messages = [x for x in messages if x[0] in board_command_ids]
+    per_cell_messages = [y for x in board_messages for y in get_per_cell_messages(x)]
+    return (
+        sum(len(ujson.dumps(x)) + 1 for x in board_messages),
+        sum(len(ujson.dumps(x)) + 1 for x in per_cell_messages),
+    )
+
+
+def benchmark_board_messages(num_boards=200, num_games=200):
+    # bytes of the cells changed by fill_cells, grouped into one message versus a
+    # SetGameBoardCell per cell. the + 1 counts the comma between messages in a line.
+    messages = []
+    for board, tile in [get_merger_benchmark_board(seed) for seed in range(num_boards)]:
+        game = types.SimpleNamespace(
+            client_ids=set(),
+            add_pending_messages=lambda messages_, client_ids=None: messages.extend(
+                messages_
+            ),
+            headless=False,
+        )
+        game_board = server.GameBoard(game, board)
+        game_board.fill_cells(tile, enums.GameBoardTypes.Luxor.value)
+    num_bytes, num_per_cell_bytes = get_board_messages_bytes(messages)
+    print(
+        "merger: %.1f bytes/fill_cells per cell, %.1f bytes/fill_cells grouped"
+        % (num_per_cell_bytes / num_boards, num_bytes / num_boards)
+    )
+
+    num_bytes = 0
+    num_per_cell_bytes = 0
+    num_all_bytes = 0
+    for tile_bag, num_players, actions in [
+        get_random_game(seed) for seed in range(num_games)
+    ]:
+        messages = []
+        play_game(
+            tile_bag,
+            num_players,
+            actions,
+            False,
+            lambda messages_, client_ids=None: messages.extend(messages_),
+        )
+        game_num_bytes, game_num_per_cell_bytes = get_board_messages_bytes(messages)
+        num_bytes += game_num_bytes
+        num_per_cell_bytes += game_num_per_cell_bytes
+        num_all_bytes += sum(len(ujson.dumps(x)) + 1 for x in messages)
+    print(
+        "random games: %.0f board bytes/game per cell, %.0f board bytes/game grouped, %.0f bytes/game of all messages grouped"
+        % (
+            num_per_cell_bytes / num_games,
+            num_bytes / num_games,
+            num_all_bytes / num_games,
+        )
+    )
+
+
+def main():
+    command = sys.argv[1]
+    if command == "framing":
+        for chunk_size in [512, 4096, 65536]:
+            benchmark_framing(chunk_size=chunk_size)
+    elif command == "game_board":
+        benchmark_game_board()
+    elif command == "merger":
+        benchmark_merger()
+    elif command == "headless":
+        benchmark_headless()
+    elif command == "snapshot":
+        benchmark_snapshot()
+    elif command == "legal_actions":
+        benchmark_legal_actions()
+    elif command == "history":
+        benchmark_history()
+    elif command == "initialization":
+        benchmark_initialization()
+    elif command == "checkpoint":
+        benchmark_checkpoint()
+    elif command == "game_processes":
+        benchmark_game_processes()
+    elif command == "frontends":
+        benchmark_frontends()
+    elif command == "websocket":
+        benchmark_websocket()
+    elif command == "backpressure":
+        benchmark_backpressure()
+    elif command == "board_messages":
+        benchmark_board_messages()
+
+
+if __name__ == "__main__":
+    main()
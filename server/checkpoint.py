@@ -0,0 +1,154 @@
+import enum
+import os
+import pickle
+import struct
+
+# file layout: magic, then records of (header, payload), like the event log. a game's
+# latest record replaces its earlier ones, so the file is compacted when it is opened.
+magic = b"ACQUIRE-CHECKPOINTS-1\n"
+record_header = struct.Struct("<IBI")  # payload length, record type, internal game id
+
+
+class RecordTypes(enum.Enum):
+    Game = 0
+    GameRemoved = 1
+    # the internal game id is the last one given out. no payload.
+    LastInternalGameId = 2
+
+
+def read_checkpoints(file):
+    # returns the latest pickled checkpoint of each game that was not removed, by internal
+    # game id, and the last internal game id given out. a record that was still being
+    # written is ignored.
+    if file.read(len(magic)) != magic:
+        raise ValueError("not a checkpoint file")
+
+    internal_game_id_to_payload = {}
+    last_internal_game_id = 0
+    header_size = record_header.size
+    game_value = RecordTypes.Game.value
+    game_removed_value = RecordTypes.GameRemoved.value
+
+    while True:
+        header = file.read(header_size)
+        if len(header) < header_size:
+            break
+        payload_length, record_type_value, internal_game_id = record_header.unpack(
+            header
+        )
+        payload = file.read(payload_length)
+        if len(payload) < payload_length:
+            break
+
+        if record_type_value == game_value:
+            internal_game_id_to_payload[internal_game_id] = payload
+        elif record_type_value == game_removed_value:
+            internal_game_id_to_payload.pop(internal_game_id, None)
+        if internal_game_id > last_internal_game_id:
+            last_internal_game_id = internal_game_id
+
+    return internal_game_id_to_payload, last_internal_game_id
+
+
+class CheckpointWriter:
+    def __init__(self, min_compaction_size=1 << 20):
+        # the file is compacted while open once it is at least min_compaction_size bytes
+        # and more than half of it is replaced or removed checkpoints
+        self.min_compaction_size = min_compaction_size
+        self.file = None
+        self.filename = None
+        self.num_bytes = 0
+        self.internal_game_id_to_num_bytes = {}
+        self.compaction_count = 0
+
+    def open(self, filename):
+        # rewrites the file with only the latest checkpoint of each game, and returns those
+        # checkpoints by internal game id and the last internal game id given out
+        internal_game_id_to_payload = {}
+        last_internal_game_id = 0
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                internal_game_id_to_payload, last_internal_game_id = read_checkpoints(f)
+
+        self.filename = filename
+        self._rewrite(internal_game_id_to_payload, last_internal_game_id)
+
+        return (
+            {
+                internal_game_id: pickle.loads(payload)
+                for internal_game_id, payload in internal_game_id_to_payload.items()
+            },
+            last_internal_game_id,
+        )
+
+    def _rewrite(self, internal_game_id_to_payload, last_internal_game_id):
+        temporary_filename = self.filename + ".tmp"
+        with open(temporary_filename, "wb") as f:
+            f.write(magic)
+            f.write(
+                record_header.pack(
+                    0, RecordTypes.LastInternalGameId.value, last_internal_game_id
+                )
+            )
+            self.num_bytes = len(magic) + record_header.size
+            self.internal_game_id_to_num_bytes = {}
+            for internal_game_id, payload in internal_game_id_to_payload.items():
+                f.write(
+                    record_header.pack(
+                        len(payload), RecordTypes.Game.value, internal_game_id
+                    )
+                )
+                f.write(payload)
+                num_bytes = record_header.size + len(payload)
+                self.num_bytes += num_bytes
+                self.internal_game_id_to_num_bytes[internal_game_id] = num_bytes
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_filename, self.filename)
+
+        self.file = open(self.filename, "ab")
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+            if self.num_bytes >= self.min_compaction_size and self.num_bytes > 2 * (
+                len(magic)
+                + record_header.size
+                + sum(self.internal_game_id_to_num_bytes.values())
+            ):
+                self.compact()
+
+    def compact(self):
+        # rewrites the file with only the latest checkpoint of each game. as each
+        # compaction at least halves the file, the rewriting is proportional to the writes.
+        self.file.close()
+        with open(self.filename, "rb") as f:
+            internal_game_id_to_payload, last_internal_game_id = read_checkpoints(f)
+        self._rewrite(internal_game_id_to_payload, last_internal_game_id)
+        self.compaction_count += 1
+
+    def write_game(self, internal_game_id, data):
+        if self.file:
+            payload = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            self.file.write(
+                record_header.pack(
+                    len(payload), RecordTypes.Game.value, internal_game_id
+                )
+            )
+            self.file.write(payload)
+            num_bytes = record_header.size + len(payload)
+            self.num_bytes += num_bytes
+            self.internal_game_id_to_num_bytes[internal_game_id] = num_bytes
+
+    def remove_game(self, internal_game_id):
+        if self.file:
+            self.file.write(
+                record_header.pack(0, RecordTypes.GameRemoved.value, internal_game_id)
+            )
+            self.num_bytes += record_header.size
+            self.internal_game_id_to_num_bytes.pop(internal_game_id, None)
@@ -1,5 +1,6 @@
 import base64
 import collections
+import event_log
 import glob
 import orm
 import os
@@ -51,6 +52,20 @@ class Logs2DB:
                 len_last_line = len(line.encode())
         return file.tell() - len_last_line, self.completed_game_users
 
+    def process_event_log(self, file, log_time=None, offset=None):
+        self.completed_game_users = set()
+        reader = event_log.EventReader(file, offset)
+        for event in reader.events(
+            [event_log.EventTypes.Game, event_log.EventTypes.GamePlayer]
+        ):
+            params = event.data
+            if "log-time" not in params:
+                params["log-time"] = log_time
+            method = self.method_lookup.get(params.get("_"))
+            if method:
+                method(params)
+        return reader.offset, self.completed_game_users
+
     def process_game(self, params):
         game = self.lookup.get_game(params["log-time"], params["game-id"])
 
@@ -375,34 +390,43 @@ record_key_to_record_index = {
 }
 
 
-def process_logs(write_stats_files):
+def process_logs(write_stats_files, log_type="py"):
+    # log_type "events" reads the binary event logs instead of the text logs
     with orm.session_scope() as session:
         lookup = orm.Lookup(session)
         logs2db = Logs2DB(session, lookup)
 
-        kv_last_log_timestamp = lookup.get_key_value("cron last log timestamp")
+        key_prefix = "cron last event log " if log_type == "events" else "cron last "
+        kv_last_log_timestamp = lookup.get_key_value(key_prefix + "log timestamp")
         last_log_timestamp = (
             1408905413
             if kv_last_log_timestamp.value is None
             else int(kv_last_log_timestamp.value)
         )
-        kv_last_offset = lookup.get_key_value("cron last offset")
+        kv_last_offset = lookup.get_key_value(key_prefix + "offset")
         last_offset = 0 if kv_last_offset.value is None else int(kv_last_offset.value)
 
         completed_game_users = set()
         for log_timestamp, filename in util.get_log_file_filenames(
-            "py", begin=last_log_timestamp
+            log_type, begin=last_log_timestamp
         ):
             if log_timestamp != last_log_timestamp:
                 last_offset = 0
 
-            with util.open_possibly_gzipped_file(filename) as f:
-                if last_offset:
-                    f.seek(last_offset)
-                last_offset, new_completed_game_users = logs2db.process_logs(
-                    f, log_timestamp
-                )
-                completed_game_users.update(new_completed_game_users)
+            if log_type == "events":
+                with util.open_possibly_gzipped_file(filename, True) as f:
+                    (
+                        last_offset,
+                        new_completed_game_users,
+                    ) = logs2db.process_event_log(f, log_timestamp, last_offset)
+            else:
+                with util.open_possibly_gzipped_file(filename) as f:
+                    if last_offset:
+                        f.seek(last_offset)
+                    last_offset, new_completed_game_users = logs2db.process_logs(
+                        f, log_timestamp
+                    )
+            completed_game_users.update(new_completed_game_users)
 
             last_log_timestamp = log_timestamp
 
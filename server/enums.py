@@ -26,6 +26,8 @@ class CommandsToClient(enum.Enum):
     AddGlobalChatMessage = 21
     AddGameChatMessage = 22
     DestroyGame = 23
+    ResetLobby = 24
+    SetGameBoardCells = 25
 
 
 class CommandsToServer(enum.Enum):
@@ -37,6 +39,7 @@ class CommandsToServer(enum.Enum):
     DoGameAction = 5
     SendGlobalChatMessage = 6
     SendGameChatMessage = 7
+    SetInGameSubscriptions = 8
 
 
 class Errors(enum.Enum):
@@ -0,0 +1,115 @@
+import collections
+import enum
+import io
+import struct
+import ujson
+
+# file layout: magic, then records of (header, payload). the header holds the payload
+# length, so readers can skip records they are not interested in without decoding them.
+magic = b"ACQUIRE-EVENTS-1\n"
+record_header = struct.Struct("<IBdI")  # payload length, event type, time, game id
+
+
+class EventTypes(enum.Enum):
+    Game = 0
+    GamePlayer = 1
+    GameAction = 2
+    GameExpired = 3
+
+
+Event = collections.namedtuple(
+    "Event", ["offset", "event_type", "time", "internal_game_id", "data"]
+)
+
+
+class EventLogWriter:
+    def __init__(self):
+        self.file = None
+
+    def open(self, filename):
+        self.file = open(filename, "ab")
+        if self.file.tell() == 0:
+            self.file.write(magic)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def write(self, event_type, time, internal_game_id, data):
+        if self.file:
+            payload = ujson.dumps(data).encode()
+            self.file.write(
+                record_header.pack(
+                    len(payload), event_type.value, time, internal_game_id
+                )
+            )
+            self.file.write(payload)
+
+
+# reads the events in a binary file object, optionally resuming at an offset. offset is
+# kept just past the last complete record, so it can be stored and passed back in later.
+# a record that is still being written is not returned.
+class EventReader:
+    def __init__(self, file, offset=None):
+        self.file = file
+        if offset:
+            file.seek(offset)
+            self.offset = offset
+        else:
+            if file.read(len(magic)) != magic:
+                raise ValueError("not an event log")
+            self.offset = len(magic)
+
+    def events(self, event_types=None, internal_game_ids=None):
+        # only the payloads of events of event_types and internal_game_ids are decoded
+        file = self.file
+        event_type_values = (
+            None if event_types is None else {x.value for x in event_types}
+        )
+        header_size = record_header.size
+        skipped_record_offset = None
+
+        while True:
+            header = file.read(header_size)
+            if len(header) < header_size:
+                if skipped_record_offset is not None:
+                    # seeking past the end of a file does not fail, so check that the
+                    # skipped record was complete
+                    try:
+                        if file.seek(0, io.SEEK_END) < self.offset:
+                            self.offset = skipped_record_offset
+                    except (OSError, io.UnsupportedOperation):
+                        pass
+                return
+
+            (
+                payload_length,
+                event_type_value,
+                time,
+                internal_game_id,
+            ) = record_header.unpack(header)
+            record_offset = self.offset
+            if (
+                event_type_values is None or event_type_value in event_type_values
+            ) and (internal_game_ids is None or internal_game_id in internal_game_ids):
+                payload = file.read(payload_length)
+                if len(payload) < payload_length:
+                    return
+                self.offset += header_size + payload_length
+                skipped_record_offset = None
+                yield Event(
+                    record_offset,
+                    EventTypes(event_type_value),
+                    time,
+                    internal_game_id,
+                    ujson.decode(payload),
+                )
+            else:
+                file.seek(payload_length, io.SEEK_CUR)
+                self.offset += header_size + payload_length
+                skipped_record_offset = record_offset
@@ -1,6 +1,7 @@
 import collections
 import enum
 import enums
+import gzip
 import itertools
 import math
 import os
@@ -123,10 +124,11 @@ class LineTypes(enum.Enum):
     blank_line = 7
     connection_made = 8
     error = 9
+    frontend = 10
 
 
 class LogParser:
-    def __init__(self, log_timestamp, file):
+    def __init__(self, log_timestamp, file, checkpoint=None):
         self._file = file
 
         regexes_to_ignore = [
@@ -198,6 +200,14 @@ class LogParser:
                 re.compile(r"^connection_made$"),
                 self._handle_connection_made,
             ),
+            # the frontends connected to the server, of which there can be several
+            (
+                LineTypes.frontend,
+                re.compile(
+                    r"^(?:frontend_connected|frontend_disconnected|aborting frontend) (?P<frontend_id>\d+)(?: with \d+ bytes held)?$"
+                ),
+                self._handle_frontend,
+            ),
             (LineTypes.error, re.compile("|".join(regexes_to_ignore)), None),
         ]
 
@@ -206,9 +216,16 @@ class LogParser:
             enums_translations
         )
 
-        self._connection_made_count = 0
+        # a log index checkpoint says where in the file parsing starts
+        self._connection_made_count = (
+            checkpoint["connection-made-count"] if checkpoint else 0
+        )
+        self._first_line_number = checkpoint["line-number"] if checkpoint else 1
 
-        self._enum_set_game_board_cell = enums.CommandsToClient.SetGameBoardCell.value
+        self._enum_set_game_board_cell = {
+            enums.CommandsToClient.SetGameBoardCell.value,
+            enums.CommandsToClient.SetGameBoardCells.value,
+        }
         self._enum_set_game_player = {
             index
             for index, entry in enumerate(Enums.lookups["CommandsToClient"])
@@ -217,7 +234,7 @@ class LogParser:
 
     def go(self):
         handled_line_type = None
-        line_number = 0
+        line_number = self._first_line_number - 1
         stop_processing_file = False
 
         for line in self._file:
@@ -274,7 +291,7 @@ class LogParser:
         enum_set_game_board_cell_indexes = set()
         enum_set_game_player_indexes = set()
         for index, command in enumerate(commands):
-            if command[0] == self._enum_set_game_board_cell:
+            if command[0] in self._enum_set_game_board_cell:
                 enum_set_game_board_cell_indexes.add(index)
             elif command[0] in self._enum_set_game_player:
                 enum_set_game_player_indexes.add(index)
@@ -322,6 +339,9 @@ class LogParser:
     def _handle_game_expired(self, match):
         return (int(match.group("game_id")),)
 
+    def _handle_frontend(self, match):
+        return (int(match.group("frontend_id")),)
+
     def _handle_connection_made(self, match):
         self._connection_made_count += 1
         if self._connection_made_count == 1:
@@ -346,7 +366,14 @@ class LogProcessor:
         LineTypes.blank_line: 9,
     }
 
-    def __init__(self, log_timestamp, file, verbose=False, verbose_output_path=""):
+    def __init__(
+        self,
+        log_timestamp,
+        file,
+        verbose=False,
+        verbose_output_path="",
+        checkpoint=None,
+    ):
         self._log_timestamp = log_timestamp
         self._verbose = verbose
         self._verbose_output_path = verbose_output_path
@@ -356,7 +383,22 @@ class LogProcessor:
         self._client_id_to_game_id = {}
         self._game_id_to_game = {}
 
-        self._log_parser = LogParser(log_timestamp, file)
+        self._log_parser = LogParser(log_timestamp, file, checkpoint)
+
+        # games that started before the checkpoint are incomplete
+        if checkpoint:
+            for client_id, username in checkpoint["clients"]:
+                self._client_id_to_username[client_id] = username
+                self._username_to_client_id[username] = client_id
+            self._client_id_to_game_id.update(checkpoint["client-games"])
+            for game_id, internal_game_id, players in checkpoint["games"]:
+                game = Game(log_timestamp, game_id, internal_game_id, verbose)
+                for player_id, username in players:
+                    game.player_id_to_username[player_id] = username
+                    game.username_to_player_id[username] = player_id
+                    game.player_join_order.append(username)
+                    game.username_to_game_history[username] = []
+                self._game_id_to_game[game_id] = game
 
         self._line_type_to_handler = {
             LineTypes.time: self._handle_time,
@@ -377,6 +419,7 @@ class LogProcessor:
             # SetClientIdToData
             # SetGameState
             enums.CommandsToClient.SetGameBoardCell.value: self._handle_command_to_client__set_game_board_cell,
+            enums.CommandsToClient.SetGameBoardCells.value: self._handle_command_to_client__set_game_board_cells,
             # SetGameBoard
             enums.CommandsToClient.SetScoreSheetCell.value: self._handle_command_to_client__set_score_sheet_cell,
             enums.CommandsToClient.SetScoreSheet.value: self._handle_command_to_client__set_score_sheet,
@@ -514,6 +557,21 @@ class LogProcessor:
 
         game.board[x][y] = game_board_type_id
 
+    def _handle_command_to_client__set_game_board_cells(self, client_ids, command):
+        # the played tile, if any, is the first cell
+        game_board_type_id = command[1]
+        for index in server.get_set_game_board_cells_indexes(command):
+            x, y = divmod(index, 9)
+            self._handle_command_to_client__set_game_board_cell(
+                client_ids,
+                [
+                    enums.CommandsToClient.SetGameBoardCell.value,
+                    x,
+                    y,
+                    game_board_type_id,
+                ],
+            )
+
     def _handle_command_to_client__set_score_sheet_cell(self, client_ids, command):
         client_id, row, index, value = client_ids[0], command[1], command[2], command[3]
 
@@ -829,6 +887,7 @@ class Game:
             Game._add_pending_messages,
             False,
             tile_bag,
+            headless=True,
         )
 
         self._server_game_player_id_to_client = [
@@ -1077,6 +1136,7 @@ class Game:
         game_data["history_messages"] = self.server_game.history_messages
 
         # game_data['add_pending_messages'] -- exclude
+        # game_data['headless'] -- exclude
         # game_data['logging_enabled'] -- exclude
         # game_data['client_ids'] -- exclude
         # game_data['watcher_client_ids'] -- exclude
@@ -1130,14 +1190,14 @@ class Client:
 
 
 class IndividualGameLogMaker:
-    def __init__(self, log_timestamp, file):
+    def __init__(self, log_timestamp, file, checkpoint=None):
         self._log_timestamp = log_timestamp
 
         self._client_id_to_username = {}
         self._username_to_client_id = {}
         self._client_id_to_game_id = {}
 
-        self._log_parser = LogParser(log_timestamp, file)
+        self._log_parser = LogParser(log_timestamp, file, checkpoint)
 
         self._line_type_to_handler = {
             LineTypes.connect: self._handle_connect,
@@ -1157,6 +1217,7 @@ class IndividualGameLogMaker:
             # SetClientIdToData
             # SetGameState
             enums.CommandsToClient.SetGameBoardCell.value: self._handle_command_to_client__set_game_board_cell,
+            enums.CommandsToClient.SetGameBoardCells.value: self._handle_command_to_client__set_game_board_cells,
             # SetGameBoard
             enums.CommandsToClient.SetScoreSheetCell.value: self._handle_command_to_client__set_score_sheet_cell,
             enums.CommandsToClient.SetScoreSheet.value: self._handle_command_to_client__set_score_sheet,
@@ -1196,8 +1257,8 @@ class IndividualGameLogMaker:
 
         self._delayed_calls = []
 
-        self._line_number = 1
-        self._batch_line_number = 1
+        self._line_number = checkpoint["line-number"] if checkpoint else 1
+        self._batch_line_number = self._line_number
         self._batch = []
 
         self._game_id_to_game_log = {}
@@ -1211,6 +1272,26 @@ class IndividualGameLogMaker:
 
         self._completed_game_logs = []
 
+        # games that started before the checkpoint are incomplete. the connect lines of
+        # clients that connected before the checkpoint are not available, so stand-ins are
+        # made for them.
+        if checkpoint:
+            clients = checkpoint["clients"]
+            for index, (client_id, username) in enumerate(clients):
+                self._client_id_to_username[client_id] = username
+                self._username_to_client_id[username] = client_id
+                self._client_id_to_add_batch[client_id] = [
+                    self._line_number - len(clients) + index,
+                    ["%d connect %s 0.0.0.0 index" % (client_id, username), ""],
+                ]
+            self._client_id_to_game_id.update(checkpoint["client-games"])
+            for game_id, internal_game_id, players in checkpoint["games"]:
+                game_log = IndividualGameLog(log_timestamp, internal_game_id)
+                for player_id, username in players:
+                    game_log.player_id_to_username[player_id] = username
+                    game_log.username_to_player_id[username] = player_id
+                self._game_id_to_game_log[game_id] = game_log
+
     def go(self):
         for line_type, line_number, line, parse_line_data in self._log_parser.go():
             self._batch.append(line)
@@ -1269,6 +1350,9 @@ class IndividualGameLogMaker:
     def _handle_command_to_client__set_game_board_cell(self, client_ids, command):
         self._batch_game_id = self._client_id_to_game_id[client_ids[0]]
 
+    def _handle_command_to_client__set_game_board_cells(self, client_ids, command):
+        self._batch_game_id = self._client_id_to_game_id[client_ids[0]]
+
     def _handle_command_to_client__set_score_sheet_cell(self, client_ids, command):
         self._batch_game_id = self._client_id_to_game_id[client_ids[0]]
 
@@ -1431,6 +1515,204 @@ class IndividualGameLog:
                 f.write("\n")
 
 
+class OffsetTrackingLines:
+    def __init__(self, file):
+        self._file = file
+        self.offset = 0
+        self.next_offset = 0
+
+    def __iter__(self):
+        for line in self._file:
+            self.offset = self.next_offset
+            self.next_offset += len(line)
+            yield line.decode(errors="replace")
+
+
+class LogIndexer:
+    # checkpoints are taken at batch boundaries at least this many bytes apart
+    checkpoint_interval = 1 << 20
+
+    def __init__(self, log_timestamp, file):
+        self._lines = OffsetTrackingLines(file)
+        self._log_parser = LogParser(log_timestamp, self._lines)
+
+        self._client_id_to_username = {}
+        self._client_id_to_game_id = {}
+        self._game_id_to_internal_game_id_and_players = {}
+        self._internal_game_id_to_game = {}
+        self._time = None
+        self._batch_offset = 0
+        self._delayed_disconnects = []
+
+        self._set_game_player_ids = {
+            enums.CommandsToClient.SetGamePlayerJoin.value,
+            enums.CommandsToClient.SetGamePlayerRejoin.value,
+        }
+        self._set_game_player_leave = enums.CommandsToClient.SetGamePlayerLeave.value
+        self._set_game_watcher_client_id = (
+            enums.CommandsToClient.SetGameWatcherClientId.value
+        )
+        self._return_watcher_to_lobby = (
+            enums.CommandsToClient.ReturnWatcherToLobby.value
+        )
+        self._set_game_player_client_id = Enums.lookups["CommandsToClient"].index(
+            "SetGamePlayerClientId"
+        )
+
+    def go(self):
+        checkpoints = [self._get_checkpoint(0, 1)]
+
+        for line_type, line_number, line, parse_line_data in self._log_parser.go():
+            if line_type == LineTypes.time:
+                self._time = parse_line_data[0]
+            elif line_type == LineTypes.connect:
+                client_id, username = parse_line_data
+                self._client_id_to_username[client_id] = username
+            elif line_type == LineTypes.disconnect:
+                # disconnects are processed after the rest of the batch
+                self._delayed_disconnects.append(parse_line_data[0])
+            elif line_type == LineTypes.command_to_client:
+                self._handle_commands_to_client(parse_line_data[1])
+            elif line_type == LineTypes.log:
+                self._handle_log(parse_line_data[0])
+            elif line_type == LineTypes.game_expired:
+                self._handle_game_expired(parse_line_data[0])
+            elif line_type == LineTypes.blank_line:
+                for client_id in self._delayed_disconnects:
+                    self._client_id_to_username.pop(client_id, None)
+                    self._client_id_to_game_id.pop(client_id, None)
+                del self._delayed_disconnects[:]
+
+                self._batch_offset = self._lines.next_offset
+                if (
+                    self._batch_offset - checkpoints[-1]["offset"]
+                    >= LogIndexer.checkpoint_interval
+                ):
+                    checkpoints.append(
+                        self._get_checkpoint(self._batch_offset, line_number + 1)
+                    )
+
+        for game in self._internal_game_id_to_game.values():
+            if game["end-offset"] is None:
+                game["end-offset"] = self._lines.next_offset
+
+        return {
+            "checkpoints": checkpoints,
+            "games": sorted(self._internal_game_id_to_game.items()),
+        }
+
+    def _get_checkpoint(self, offset, line_number):
+        return {
+            "offset": offset,
+            "line-number": line_number,
+            "time": self._time,
+            "connection-made-count": self._log_parser._connection_made_count,
+            "clients": sorted(self._client_id_to_username.items()),
+            "client-games": sorted(self._client_id_to_game_id.items()),
+            "games": [
+                [game_id, internal_game_id, sorted(players.items())]
+                for game_id, (
+                    internal_game_id,
+                    players,
+                ) in sorted(self._game_id_to_internal_game_id_and_players.items())
+            ],
+        }
+
+    def _handle_commands_to_client(self, commands):
+        for command in commands:
+            command_id = command[0]
+            if command_id in self._set_game_player_ids:
+                self._client_id_to_game_id[command[3]] = command[1]
+            elif command_id == self._set_game_player_leave:
+                self._client_id_to_game_id.pop(command[3], None)
+            elif command_id == self._set_game_watcher_client_id:
+                self._client_id_to_game_id[command[2]] = command[1]
+            elif command_id == self._return_watcher_to_lobby:
+                self._client_id_to_game_id.pop(command[2], None)
+            elif command_id == self._set_game_player_client_id:
+                if command[3] is not None:
+                    self._client_id_to_game_id[command[3]] = command[1]
+
+    def _handle_log(self, entry):
+        game_id = (
+            entry["external-game-id"]
+            if "external-game-id" in entry
+            else entry["game-id"]
+        )
+        internal_game_id = entry["game-id"]
+
+        if game_id not in self._game_id_to_internal_game_id_and_players:
+            self._game_id_to_internal_game_id_and_players[game_id] = [
+                internal_game_id,
+                {},
+            ]
+            self._internal_game_id_to_game[internal_game_id] = {
+                "game-id": game_id,
+                "begin-offset": self._batch_offset,
+                "begin-time": self._time,
+                "end-offset": None,
+            }
+
+        if entry["_"] == "game-player":
+            players = self._game_id_to_internal_game_id_and_players[game_id][1]
+            players[entry["player-id"]] = entry["username"]
+
+    def _handle_game_expired(self, game_id):
+        internal_game_id_and_players = (
+            self._game_id_to_internal_game_id_and_players.pop(game_id, None)
+        )
+        if internal_game_id_and_players:
+            game = self._internal_game_id_to_game[internal_game_id_and_players[0]]
+            game["end-offset"] = self._lines.next_offset
+
+
+def index_log_file(log_timestamp, filename):
+    with util.open_possibly_gzipped_file(filename, True) as file:
+        index = LogIndexer(log_timestamp, file).go()
+    util.write_log_index(filename, index)
+    return index
+
+
+def gzip_log_file(filename):
+    # replaces filename with filename.gz, with a gzip member starting at each index
+    # checkpoint, so readers can start decompressing at any checkpoint
+    index = util.read_log_index(filename)
+    checkpoints = index["checkpoints"]
+    with open(filename, "rb") as input_file, open(
+        filename + ".gz", "wb"
+    ) as output_file:
+        for checkpoint, next_checkpoint in itertools.zip_longest(
+            checkpoints, checkpoints[1:]
+        ):
+            checkpoint["gzip-offset"] = output_file.tell()
+            if next_checkpoint:
+                data = input_file.read(next_checkpoint["offset"] - checkpoint["offset"])
+            else:
+                data = input_file.read()
+            output_file.write(gzip.compress(data))
+        output_file.flush()
+        os.fsync(output_file.fileno())
+    util.write_log_index(filename, index)
+    # otherwise get_log_file_filenames would list the log twice
+    os.remove(filename)
+
+
+def open_log_file_for_game(filename, internal_game_id):
+    # returns a log file positioned at the last checkpoint before the game began, if indexed
+    index = util.read_log_index(filename)
+    if index:
+        for indexed_internal_game_id, game in index["games"]:
+            if indexed_internal_game_id == internal_game_id:
+                checkpoint = util.get_log_index_checkpoint(
+                    index, offset=game["begin-offset"]
+                )
+                return (
+                    util.open_possibly_gzipped_file_at_checkpoint(filename, checkpoint),
+                    checkpoint,
+                )
+    return util.open_possibly_gzipped_file(filename), None
+
+
 def test_individual_game_log(output_dir):
     log_timestamp = 1432798259
 
@@ -1660,6 +1942,41 @@ def _generate_sync_logs(log_timestamp, filename, output_dir):
             print(*messages)
 
 
+def compare_game_board_classes(begin):
+    # replays logged games with each game board class and reports games that differ
+    game_board_classes = [
+        server.GameBoard,
+        server.BitboardGameBoard,
+        server.UnionFindGameBoard,
+    ]
+    default_game_board_class = server.Game.game_board_class
+
+    for log_timestamp, filename in util.get_log_file_filenames("py", begin=begin):
+        with util.open_possibly_gzipped_file(filename) as file:
+            log_processor = LogProcessor(log_timestamp, file)
+
+            for game in log_processor.go():
+                results = []
+                for game_board_class in game_board_classes:
+                    server.Game.game_board_class = game_board_class
+                    try:
+                        game.make_server_game()
+                    finally:
+                        server.Game.game_board_class = default_game_board_class
+                    server_game = game.server_game
+                    results.append(
+                        [
+                            server_game.game_board.x_to_y_to_board_type,
+                            [x[:8] for x in server_game.score_sheet.player_data],
+                            server_game.score_sheet.chain_size,
+                            server_game.history_messages,
+                        ]
+                    )
+
+                if any(result != results[0] for result in results[1:]):
+                    print(log_timestamp, game.internal_game_id, "differs")
+
+
 def output_server_game_files_for_all_in_progress_games(output_dir):
     log_file_filenames = util.get_log_file_filenames("py", begin=1408905413)
     last_log_timestamp = log_file_filenames[-1][0]
@@ -1877,8 +2194,11 @@ def make_individual_game_log(log_timestamp, internal_game_id, output_dir):
     for log_timestamp, filename in util.get_log_file_filenames(
         "py", begin=log_timestamp, end=log_timestamp
     ):
-        with util.open_possibly_gzipped_file(filename) as file:
-            individual_game_log_maker = IndividualGameLogMaker(log_timestamp, file)
+        file, checkpoint = open_log_file_for_game(filename, internal_game_id)
+        with file:
+            individual_game_log_maker = IndividualGameLogMaker(
+                log_timestamp, file, checkpoint
+            )
             for individual_game_log in individual_game_log_maker.go():
                 if individual_game_log.internal_game_id == internal_game_id:
                     filename = os.path.join(
@@ -1898,8 +2218,9 @@ def output_server_game_file_for_game(log_timestamp, internal_game_id, output_dir
     for log_timestamp, filename in util.get_log_file_filenames(
         "py", begin=log_timestamp, end=log_timestamp
     ):
-        with util.open_possibly_gzipped_file(filename) as file:
-            log_processor = LogProcessor(log_timestamp, file)
+        file, checkpoint = open_log_file_for_game(filename, internal_game_id)
+        with file:
+            log_processor = LogProcessor(log_timestamp, file, checkpoint=checkpoint)
 
             for game in log_processor.go():
                 if game.internal_game_id == internal_game_id:
@@ -1989,6 +2310,7 @@ def make_acquire2_game_test_files(log_timestamp, output_dir):
                     Game._add_pending_messages,
                     False,
                     tile_bag,
+                    headless=True,
                 )
 
                 server_game_player_id_to_client = [
@@ -2641,6 +2963,16 @@ def main():
         make_acquire2_game_test_files(int(sys.argv[2]), output_dir)
     elif command == "punycode_non_ascii_usernames_in_the_database":
         punycode_non_ascii_usernames_in_the_database()
+    elif command == "index_log_files":
+        for log_timestamp, filename in util.get_log_file_filenames(
+            "py", begin=int(sys.argv[2]) if len(sys.argv) > 2 else None
+        ):
+            print(filename)
+            index_log_file(log_timestamp, filename)
+    elif command == "gzip_log_file":
+        gzip_log_file(sys.argv[2])
+    elif command == "compare_game_board_classes":
+        compare_game_board_classes(int(sys.argv[2]) if len(sys.argv) > 2 else None)
 
 
 if __name__ == "__main__":
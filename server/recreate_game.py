@@ -27,14 +27,21 @@ def recreate_game(server_, filename):
         "turns_without_played_tiles_count"
     ]
     game.history_messages = game_data["history_messages"]
+    game.history_player_id_to_json = {}
 
+    game.headless = False
     game.add_pending_messages = server_.add_pending_messages
+    game.add_pending_batch = server_.add_pending_batch
+    game.lobby_client_ids = server_.lobby_client_ids
     game.logging_enabled = True
     game.client_ids = set()
     game.watcher_client_ids = set()
     game.expiration_time = None
+    game.state_version = 0
+    game.initialization_json = None
+    game.initialization_json_state_version = None
 
-    game.game_board = server.GameBoard(game, game_data["game_board"])
+    game.game_board = server.Game.game_board_class(game, game_data["game_board"])
 
     game.score_sheet = server.ScoreSheet.__new__(server.ScoreSheet)
     game.score_sheet.game = game
@@ -46,6 +53,7 @@ def recreate_game(server_, filename):
         game.tile_racks = server.TileRacks.__new__(server.TileRacks)
         game.tile_racks.game = game
         game.tile_racks.racks = game_data["tile_racks"]
+        game.tile_racks.index_racks()
 
     game.actions = []
     for action_data in game_data["actions"]:
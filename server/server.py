@@ -1,90 +1,659 @@
+import argparse
 import asyncio
+import checkpoint
 import collections
 import enums
+import event_log
+import functools
+import gc
 import heapq
+import io
+import itertools
 import json
 import math
+import multiprocessing
+import queue
 import random
 import re
+import signal
+import socket
+import sys
+import threading
 import time
 import traceback
 import ujson
+import websocket
+
+
+class LogWriter:
+    categories = [
+        "time",
+        "connection",
+        "client",
+        "command-to-server",
+        "command-to-client",
+        "game",
+        "metrics",
+    ]
+    # full payload tracing is dropped once max_queue_size lines are waiting. everything
+    # else is always queued, so the event loop never waits for the writer thread.
+    droppable_categories = {"command-to-server", "command-to-client"}
+
+    def __init__(self, file=None):
+        self.file = file
+        self.enabled_categories = set(LogWriter.categories)
+        self.queue = None
+        self.max_queue_size = None
+        self.thread = None
+        self.dropped_count = 0
+        self._batch_has_lines = False
+
+    def start(self, max_queue_size=100000, max_batch_size=1000):
+        self.queue = queue.Queue()
+        self.max_queue_size = max_queue_size
+        self.thread = threading.Thread(
+            target=self._write_lines_loop, args=(max_batch_size,), daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.queue = None
+
+    def log(self, category, *args):
+        # same output as print(*args)
+        if category in self.enabled_categories:
+            self._write(
+                " ".join([str(x) for x in args]) + "\n",
+                category in LogWriter.droppable_categories,
+            )
+            self._batch_has_lines = True
+
+    def end_batch(self):
+        if self._batch_has_lines:
+            self._write("\n", False)
+            self._batch_has_lines = False
+
+    def _write(self, line, droppable):
+        if self.queue is None:
+            file = self.file or sys.stdout
+            file.write(line)
+        elif droppable and self.queue.qsize() >= self.max_queue_size:
+            self.dropped_count += 1
+        else:
+            self.queue.put(line)
+
+    def _write_lines_loop(self, max_batch_size):
+        file = self.file or sys.stdout
+        while True:
+            lines = [self.queue.get()]
+            try:
+                while len(lines) < max_batch_size and lines[-1] is not None:
+                    lines.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = lines[-1] is None
+            if stop:
+                lines.pop()
+            file.write("".join(lines))
+            file.flush()
+            if stop:
+                return
+
+
+log_writer = LogWriter()
+event_log_writer = event_log.EventLogWriter()
+checkpoint_writer = checkpoint.CheckpointWriter()
 
 
-class ServerProtocol(asyncio.Protocol):
+frontend_ids = itertools.count(1)
+
+
+class Frontend(asyncio.Protocol):
+    # what ServerProtocol and WebSocketProtocol have in common as the frontends of clients.
+    # while the transport's write buffer is over its high-water mark, the messages for the
+    # frontend's clients are held instead of written, and nothing is read from it.
+    kind = None
+
     def __init__(self, server):
         self.server = server
+        self.frontend_id = next(frontend_ids)
         self.transport = None
-        self.unprocessed_data = []
+        self.client_ids = set()
+        self.writing_paused = False
+        self.held_messages = HeldMessages()
+        self.pause_count = 0
 
     def connection_made(self, transport):
         self.transport = transport
-        self.server.transport_write = transport.write
-        print("time:", time.time())
-        print("connection_made")
-        print()
+        if self.server.write_buffer_limit:
+            transport.set_write_buffer_limits(self.server.write_buffer_limit)
+        self.server.frontends.add(self)
 
     def connection_lost(self, exc):
-        print("time:", time.time())
-        print("connection_lost")
-        print()
+        # the frontend's clients are gone with it
+        self.transport = None
+        self.server.frontends.discard(self)
+        for client_id in sorted(self.client_ids):
+            self.server.client_id_to_client[client_id].disconnect()
+
+    def pause_writing(self):
+        self.writing_paused = True
+        self.pause_count += 1
+        if self.transport:
+            self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.transport:
+            self.transport.resume_reading()
+        self.server.write_held_messages(self)
+
+    def abort(self):
+        # for a frontend that fell too far behind. connection_lost disconnects its clients.
+        if self.transport:
+            log_writer.log("time", "time:", time.time())
+            log_writer.log(
+                "connection",
+                "aborting frontend",
+                self.frontend_id,
+                "with",
+                self.held_messages.num_bytes,
+                "bytes held",
+            )
+            log_writer.end_batch()
+            self.transport.abort()
+
+    def get_metrics(self):
+        return [
+            ("frontend", self.frontend_id),
+            ("kind", self.kind),
+            ("clients", len(self.client_ids)),
+            (
+                "write_buffer",
+                self.transport.get_write_buffer_size() if self.transport else 0,
+            ),
+            ("paused", int(self.writing_paused)),
+            ("pauses", self.pause_count),
+            ("held_lines", len(self.held_messages.messages_jsons)),
+            ("held_bytes", self.held_messages.num_bytes),
+            ("coalesced", self.held_messages.coalesced_count),
+        ]
+
+
+class ServerProtocol(Frontend):
+    # one per frontend connection. a frontend is sent the lines of the clients it connected,
+    # and only its lines for those clients are handled.
+    kind = "unix"
+
+    def __init__(self, server):
+        super().__init__(server)
+        self.receive_buffer = bytearray()
+
+    def connection_made(self, transport):
+        log_writer.log("time", "time:", time.time())
+        # logs_to_games takes another connection_made to be a restart of the server
+        if not self.server.connection_made_logged:
+            log_writer.log("connection", "connection_made")
+            self.server.connection_made_logged = True
+        log_writer.log("connection", "frontend_connected", self.frontend_id)
+        log_writer.end_batch()
+        super().connection_made(transport)
+
+    def connection_lost(self, exc):
+        log_writer.log("time", "time:", time.time())
+        log_writer.log("connection", "frontend_disconnected", self.frontend_id)
+        log_writer.end_batch()
+        super().connection_lost(exc)
+
+    def write(self, data):
+        if self.transport:
+            self.transport.write(data)
 
     def data_received(self, data):
-        start_index = 0
-        len_data = len(data)
-        while start_index < len_data:
-            index = data.find(b"\n", start_index)
-            if index >= 0:
-                key_and_value = data[start_index:index]
-                start_index = index + 1
-
-                if self.unprocessed_data:
-                    key_and_value = b"".join(self.unprocessed_data) + key_and_value
-                    del self.unprocessed_data[:]
-
-                key, value = key_and_value.split(b" ", 1)
-                if key == b"connect":
-                    value = ujson.decode(value.decode())
-                    Client(self.server, *value)
-                elif key == b"disconnect":
-                    client = self.server.client_id_to_client.get(
-                        int(value.decode()), None
-                    )
-                    if client:
-                        client.disconnect()
+        if data.find(b"\n") < 0:
+            self.receive_buffer += data
+            return
+
+        if self.receive_buffer:
+            self.receive_buffer += data
+            data = self.receive_buffer
+
+        lines = data.split(b"\n")
+        self.receive_buffer = bytearray(lines.pop())
+
+        handle_line = self.handle_line
+        for line in lines:
+            key, separator, value = line.partition(b" ")
+            if separator:
+                handle_line(key, value)
+
+    def handle_line(self, key, value):
+        if key == b"connect":
+            value = ujson.decode(value.decode())
+            Client(self.server, *value, frontend=self)
+        elif key == b"disconnect":
+            client_id = int(value)
+            if client_id in self.client_ids:
+                if self.held_messages.num_bytes:
+                    self.held_messages.discard([client_id])
+                self.server.client_id_to_client[client_id].disconnect()
+        else:
+            client_id = int(key)
+            if client_id in self.client_ids:
+                self.server.client_id_to_client[client_id].on_message(value)
+
+
+# replaced with the client files' version when distribution files are generated, like the
+# one in server.js
+server_version = "VERSION"
+
+websocket_socket_ids = itertools.count(1)
+re_whitespace = re.compile(rb"\s+")
+
+
+def lookup_user_password(username):
+    # returns None if there is no such user, else [password], which may be [None]. blocks,
+    # so it is run in an executor.
+    import orm
+
+    with orm.session_scope() as session:
+        user = session.query(orm.User).filter_by(name=username).one_or_none()
+        return None if user is None else [user.password]
+
+
+class WebSocketProtocol(Frontend):
+    # a browser connected straight to the server instead of through server.js. it logs in
+    # the way server.js does, then it is the frontend of that one client: it is written
+    # the same lines as a ServerProtocol and sends the messages in them as websocket
+    # frames. lookup_user is like lookup_user_password. without it, users are treated as
+    # not having passwords. the x-real-ip header is only believed from the addresses in
+    # trusted_proxies, as anyone else could say they are anyone.
+    kind = "websocket"
+
+    def __init__(self, server, lookup_user=None, trusted_proxies=()):
+        super().__init__(server)
+        self.lookup_user = lookup_user
+        self.trusted_proxies = trusted_proxies
+        self.handshake_buffer = bytearray()
+        self.frame_decoder = None
+        self.sockjs = False
+        self.ip_address = None
+        self.socket_id = "websocket-%d" % next(websocket_socket_ids)
+        self.logging_in = False
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        peername = transport.get_extra_info("peername")
+        if isinstance(peername, tuple):
+            self.ip_address = peername[0]
+
+    def close(self, code=1000):
+        if self.transport:
+            self.transport.write(websocket.encode_close_frame(code))
+            self.transport.close()
+            self.transport = None
+
+    def write(self, data):
+        if not self.transport:
+            return
+        for line in data.splitlines():
+            key, separator, value = line.partition(b" ")
+            if key == b"disconnect":
+                self.close()
+            elif key != b"connect":
+                self.send_messages_json(value)
+
+    def send_messages_json(self, messages_json):
+        if self.sockjs:
+            payload = websocket.encode_sockjs_messages(messages_json.decode())
+        else:
+            payload = messages_json
+        self.transport.write(websocket.encode_frame(payload))
+
+    def data_received(self, data):
+        if self.frame_decoder is None:
+            self.handshake_buffer += data
+            try:
+                handshake = websocket.parse_handshake(self.handshake_buffer)
+            except websocket.HandshakeError:
+                self.transport.write(
+                    b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n"
+                )
+                self.transport.close()
+                self.transport = None
+                return
+            if handshake is None:
+                return
+
+            path, headers, size = handshake
+            data = bytes(self.handshake_buffer[size:])
+            self.handshake_buffer = None
+            self.frame_decoder = websocket.FrameDecoder()
+            self.sockjs = bool(websocket.re_sockjs_path.match(path))
+            if self.ip_address in self.trusted_proxies:
+                self.ip_address = headers.get("x-real-ip", self.ip_address)
+            self.transport.write(
+                websocket.get_handshake_response(headers["sec-websocket-key"])
+            )
+            if self.sockjs:
+                self.transport.write(websocket.encode_frame(b"o"))
+            if not data:
+                return
+
+        try:
+            frames = self.frame_decoder.feed(data)
+        except websocket.ProtocolError:
+            self.close(1002)
+            return
+
+        for opcode, payload in frames:
+            if not self.transport:
+                break
+            if opcode == websocket.Opcodes.Text or opcode == websocket.Opcodes.Binary:
+                if self.sockjs:
+                    try:
+                        messages = websocket.decode_sockjs_messages(payload)
+                    except (ValueError, websocket.ProtocolError):
+                        self.close(1002)
+                        break
+                    for message in messages:
+                        self.handle_message(message.encode())
                 else:
-                    client = self.server.client_id_to_client.get(
-                        int(key.decode()), None
-                    )
-                    if client:
-                        client.on_message(value)
+                    self.handle_message(payload)
+            elif opcode == websocket.Opcodes.Ping:
+                self.transport.write(
+                    websocket.encode_frame(payload, websocket.Opcodes.Pong)
+                )
+            elif opcode == websocket.Opcodes.Close:
+                self.close()
+
+    def handle_message(self, message):
+        if self.client_ids:
+            # like server.js, so a message is always one line of the log
+            message = re_whitespace.sub(b" ", message)
+            # on_message can disconnect the client
+            for client_id in tuple(self.client_ids):
+                self.server.client_id_to_client[client_id].on_message(message)
+        elif not self.logging_in and self.transport:
+            # later messages are ignored until logged in, like in server.js
+            self.logging_in = True
+            try:
+                version, username, password = ujson.decode(message.decode())[:3]
+                version = re.sub(r"\s+", " ", version).strip()
+                username = re.sub(r"\s+", " ", username).strip()
+                password = re.sub(r"\s+", " ", password).strip()
+            except:
+                traceback.print_exc()
+                self.close()
+                return
+            self.log_in(version, username, password)
+
+    def log_in(self, version, username, password):
+        if version != server_version:
+            self.send_fatal_error(enums.Errors.NotUsingLatestVersion.value)
+        elif (
+            len(username) < 1
+            or len(username) > 32
+            or not all(32 <= ord(x) <= 126 for x in username)
+        ):
+            self.send_fatal_error(enums.Errors.InvalidUsername.value)
+        elif self.lookup_user:
+            future = asyncio.get_event_loop().run_in_executor(
+                None, self.lookup_user, username
+            )
+            future.add_done_callback(
+                lambda future: self.on_lookup_user_done(future, username, password)
+            )
+        else:
+            self.on_user_found(None, username, password)
+
+    def on_lookup_user_done(self, future, username, password):
+        if not self.transport:
+            return
+        try:
+            user = future.result()
+        except:
+            traceback.print_exc()
+            self.send_fatal_error(enums.Errors.GenericError.value)
+            return
+        self.on_user_found(user, username, password)
+
+    def on_user_found(self, user, username, password):
+        # same checks as server.js
+        if user is None or user[0] is None:
+            if password:
+                self.send_fatal_error(enums.Errors.ProvidedPassword.value)
             else:
-                self.unprocessed_data.append(data[start_index:])
-                break
+                self.connect_client(username, False)
+        elif not password:
+            self.send_fatal_error(enums.Errors.MissingPassword.value)
+        elif password != user[0]:
+            self.send_fatal_error(enums.Errors.IncorrectPassword.value)
+        else:
+            self.connect_client(username, True)
+
+    def connect_client(self, username, replace_existing_user):
+        Client(
+            self.server,
+            username,
+            self.ip_address,
+            self.socket_id,
+            replace_existing_user,
+            frontend=self,
+        )
+
+    def send_fatal_error(self, error):
+        self.send_messages_json(
+            ujson.dumps([[enums.CommandsToClient.FatalError.value, error]]).encode()
+        )
+        self.close()
+
+
+# messages that only set some state. when later ones set the same state, the earlier
+# one can be dropped. SetGameBoard sets every cell.
+set_game_board_cell_command_id = enums.CommandsToClient.SetGameBoardCell.value
+set_game_board_cells_command_id = enums.CommandsToClient.SetGameBoardCells.value
+set_game_board_command_id = enums.CommandsToClient.SetGameBoard.value
+set_score_sheet_cell_command_id = enums.CommandsToClient.SetScoreSheetCell.value
+set_tile_game_board_type_command_id = enums.CommandsToClient.SetTileGameBoardType.value
+
+
+def get_state_keys(message):
+    # returns, for each piece of state message sets, the keys of the messages that set it
+    # too, its own first. returns None if message does more than set some state.
+    command_id = message[0]
+    if command_id == set_game_board_cell_command_id:
+        return [((command_id, message[1], message[2]), (set_game_board_command_id,))]
+    if command_id == set_game_board_cells_command_id:
+        return [
+            (
+                (set_game_board_cell_command_id,) + divmod(index, 9),
+                (set_game_board_command_id,),
+            )
+            for index in get_set_game_board_cells_indexes(message)
+        ]
+    if command_id == set_score_sheet_cell_command_id:
+        return [((command_id, message[1], message[2]),)]
+    if command_id == set_tile_game_board_type_command_id:
+        return [((command_id, message[1]),)]
+    if command_id == set_game_board_command_id:
+        return [((command_id,),)]
+    return None
+
+
+class HeldMessages:
+    # the lines for a frontend's clients while it is not written to, as the client ids
+    # and messages_json of flush_pending_messages' lines
+    def __init__(self):
+        self.client_id_sets = []
+        self.messages_jsons = []
+        self.num_bytes = 0
+        self.coalesced_count = 0
+
+    def add(self, client_ids, messages_json):
+        self.client_id_sets.append(set(client_ids))
+        self.messages_jsons.append(messages_json)
+        self.num_bytes += len(messages_json)
+
+    def _take(self, client_ids):
+        if client_ids is None:
+            lines = list(zip(self.client_id_sets, self.messages_jsons))
+            del self.client_id_sets[:]
+            del self.messages_jsons[:]
+            self.num_bytes = 0
+        else:
+            # a line is dropped once no client is left on it
+            client_ids = set(client_ids)
+            lines = []
+            client_id_sets = []
+            messages_jsons = []
+            for client_id_set, messages_json in zip(
+                self.client_id_sets, self.messages_jsons
+            ):
+                line_client_ids = client_id_set & client_ids
+                if line_client_ids:
+                    client_id_set -= line_client_ids
+                    lines.append((line_client_ids, messages_json))
+                if client_id_set:
+                    client_id_sets.append(client_id_set)
+                    messages_jsons.append(messages_json)
+                else:
+                    self.num_bytes -= len(messages_json)
+            self.client_id_sets = client_id_sets
+            self.messages_jsons = messages_jsons
+        return lines
+
+    def discard(self, client_ids):
+        # for clients that are already gone from the frontend
+        self._take(client_ids)
+
+    def pop_lines(self, client_ids=None):
+        # returns (client_ids_string, messages_json) pairs for the given clients, or for
+        # all of them. the lines stay shared between clients, and a message is dropped if
+        # all its clients are sent a later message that sets the same state.
+        lines = self._take(client_ids)
+
+        client_id_to_later_keys = collections.defaultdict(set)
+        coalesced_lines = []
+        for line_client_ids, messages_json in reversed(lines):
+            messages = ujson.decode(messages_json)
+            later_keys_list = [client_id_to_later_keys[x] for x in line_client_ids]
+            line_keys = set()
+            kept = []
+            for message in reversed(messages):
+                state_keys = get_state_keys(message)
+                if state_keys is not None:
+                    if all(
+                        any(x in line_keys for x in keys)
+                        or all(
+                            any(x in later_keys for x in keys)
+                            for later_keys in later_keys_list
+                        )
+                        for keys in state_keys
+                    ):
+                        continue
+                    line_keys.update(keys[0] for keys in state_keys)
+                kept.append(message)
+            for later_keys in later_keys_list:
+                later_keys.update(line_keys)
+
+            if len(kept) < len(messages):
+                self.coalesced_count += len(messages) - len(kept)
+                kept.reverse()
+                messages_json = ujson.dumps(kept)
+            if not kept:
+                continue
+            coalesced_lines.append((line_client_ids, messages_json))
+        coalesced_lines.reverse()
+
+        # consecutive lines for the same clients become one
+        result = []
+        previous_client_ids = None
+        for line_client_ids, messages_json in coalesced_lines:
+            if line_client_ids == previous_client_ids:
+                client_ids_string, previous_messages_json = result[-1]
+                result[-1] = (
+                    client_ids_string,
+                    previous_messages_json[:-1] + "," + messages_json[1:],
+                )
+            else:
+                result.append(
+                    (",".join(str(x) for x in sorted(line_client_ids)), messages_json)
+                )
+                previous_client_ids = line_client_ids
+        return result
+
+
+class TimerHeap:
+    def __init__(self):
+        self._timers = []
+        self._next_sequence = 0
+
+    def schedule(self, when, callback, *args):
+        # the sequence number keeps timers for the same time in the order they were scheduled
+        timer = [when, self._next_sequence, callback, args]
+        self._next_sequence += 1
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        # cancelled timers stay in the heap until they are due and are skipped then
+        timer[2] = None
+
+    def run(self, current_time):
+        timers = self._timers
+        while timers and timers[0][0] <= current_time:
+            _, _, callback, args = heapq.heappop(timers)
+            if callback:
+                callback(*args)
 
 
 class ReuseIdManager:
-    def __init__(self, return_wait):
+    def __init__(self, return_wait, timers=None):
         self.return_wait = return_wait
         self._used = set()
         self._unused = []
-        self._unused_wait = []
+        self._num_waiting = 0
+
+        # returned ids become available when their timer runs. timers shared with their owner
+        # are run by the owner, otherwise they are run on each get_id.
+        self._timers = TimerHeap() if timers is None else timers
+        self._run_timers_in_get_id = timers is None
 
     def get_id(self):
-        current_time = time.time()
-        while len(self._unused_wait) and self._unused_wait[0][0] <= current_time:
-            heapq.heappush(self._unused, heapq.heappop(self._unused_wait)[1])
+        if self._run_timers_in_get_id:
+            self._timers.run(time.time())
 
         if len(self._unused):
             next_id = heapq.heappop(self._unused)
         else:
-            next_id = len(self._used) + len(self._unused_wait) + 1
+            next_id = len(self._used) + self._num_waiting + 1
         self._used.add(next_id)
         return next_id
 
     def return_id(self, returned_id):
         self._used.remove(returned_id)
-        heapq.heappush(self._unused_wait, (time.time() + self.return_wait, returned_id))
+        self._num_waiting += 1
+        self._timers.schedule(
+            time.time() + self.return_wait, self._make_available, returned_id
+        )
+
+    def _make_available(self, returned_id):
+        self._num_waiting -= 1
+        heapq.heappush(self._unused, returned_id)
+
+    def set_used_ids(self, used_ids):
+        # for restoring, before any id is given out. the ids below the highest used one
+        # are available.
+        self._used = set(used_ids)
+        self._unused = [
+            x for x in range(1, max(self._used, default=0)) if x not in self._used
+        ]
 
 
 class IncrementIdManager:
@@ -98,103 +667,495 @@ class IncrementIdManager:
     def return_id(self, returned_id):
         pass
 
+    def set_last_id(self, last_id):
+        self._last_id = last_id
+
 
 def dummy_transport_write(data):
     pass
 
 
+class LobbySnapshot:
+    # what a newly connected client is told about the other clients and all games, encoded
+    # like Server.pending_batches. each client's and game's messages are encoded once and
+    # kept until they change.
+    def __init__(self, server):
+        self._server = server
+        self._client_id_to_json = {}
+        self._clients_json = ""
+        self._game_id_to_json = {}
+        self._games_json = None
+        self._username_to_game_ids = collections.defaultdict(set)
+
+    def get_clients_json(self):
+        if self._clients_json is None:
+            self._clients_json = ",".join(self._client_id_to_json.values())
+        return self._clients_json
+
+    def get_games_json(self):
+        if self._games_json is None:
+            games_json = []
+            for game in sorted(
+                self._server.game_id_to_game.values(),
+                key=lambda x: x.internal_game_id,
+            ):
+                game_json = self._game_id_to_json.get(game.game_id)
+                if game_json is None:
+                    game_json = self._get_game_json(game)
+                    self._game_id_to_json[game.game_id] = game_json
+                if game_json:
+                    games_json.append(game_json)
+            self._games_json = ",".join(games_json)
+        return self._games_json
+
+    def add_client(self, client):
+        client_json = ujson.dumps(
+            [
+                enums.CommandsToClient.SetClientIdToData.value,
+                client.client_id,
+                client.username,
+                client.ip_address,
+            ]
+        )
+        self._client_id_to_json[client.client_id] = client_json
+        if self._clients_json is not None:
+            if self._clients_json:
+                self._clients_json += "," + client_json
+            else:
+                self._clients_json = client_json
+        self._update_username(client.username)
+
+    def remove_client(self, client):
+        del self._client_id_to_json[client.client_id]
+        self._clients_json = None
+        self._update_username(client.username)
+
+    def update_game(self, game):
+        # also called for new games
+        self._game_id_to_json.pop(game.game_id, None)
+        self._games_json = None
+
+    def remove_game(self, game):
+        self.update_game(game)
+        for username, client_id in game.get_lobby_players():
+            game_ids = self._username_to_game_ids[username]
+            game_ids.discard(game.game_id)
+            if not game_ids:
+                del self._username_to_game_ids[username]
+
+    def _update_username(self, username):
+        # games list players without a client by client id if they are connected
+        for game_id in self._username_to_game_ids.get(username, ()):
+            if self._game_id_to_json.pop(game_id, None) is not None:
+                self._games_json = None
+
+    def _get_game_json(self, game):
+        game_id = game.game_id
+        messages = [
+            [
+                enums.CommandsToClient.SetGameState.value,
+                game_id,
+                game.state,
+                game.mode,
+                game.max_players,
+            ]
+        ]
+        for player_id, (username, client_id) in enumerate(game.get_lobby_players()):
+            self._username_to_game_ids[username].add(game_id)
+            if client_id:
+                messages.append(
+                    [
+                        enums.CommandsToClient.SetGamePlayerJoin.value,
+                        game_id,
+                        player_id,
+                        client_id,
+                    ]
+                )
+            else:
+                client = self._server.username_to_client.get(username)
+                messages.append(
+                    [
+                        enums.CommandsToClient.SetGamePlayerJoinMissing.value,
+                        game_id,
+                        player_id,
+                        client.client_id if client else username,
+                    ]
+                )
+        for client_id in game.watcher_client_ids:
+            messages.append(
+                [
+                    enums.CommandsToClient.SetGameWatcherClientId.value,
+                    game_id,
+                    client_id,
+                ]
+            )
+        return ",".join([ujson.dumps(message) for message in messages])
+
+
 class Server:
     re_camelcase = re.compile(r"(.)([A-Z])")
 
-    def __init__(self):
-        self.next_client_id_manager = ReuseIdManager(60)
+    def __init__(
+        self,
+        flush_delay=None,
+        checkpoint_interval=None,
+        write_buffer_limit=None,
+        max_held_bytes=None,
+    ):
+        # game expirations and id returns, run by destroy_expired_games
+        self.timers = TimerHeap()
+        self.game_id_to_expiration_timer = {}
+        self.expired_games = []
+
+        self.next_client_id_manager = ReuseIdManager(60, self.timers)
         self.client_id_to_client = {}
         self.client_ids = set()
+        # clients receiving lobby changes and global chat. clients in a game are only in
+        # these if they asked to be with SetInGameSubscriptions.
+        self.lobby_client_ids = set()
+        self.global_chat_client_ids = set()
         self.username_to_client = {}
-        self.next_game_id_manager = ReuseIdManager(60)
+        self.next_game_id_manager = ReuseIdManager(60, self.timers)
         self.next_internal_game_id_manager = IncrementIdManager()
         self.game_id_to_game = {}
-        self.client_ids_and_messages = []
+        self.lobby_snapshot = LobbySnapshot(self)
+        self.pending_batches = []
+        self.client_id_to_pending_batch_indexes = {}
+
+        # None: flush on every request. 0: flush once per event loop iteration.
+        # otherwise: coalesce flushes for at most this many seconds.
+        self.flush_delay = flush_delay
+        self.flush_handle = None
 
         self.transport_write = dummy_transport_write
 
-    def add_pending_messages(self, messages, client_ids=None):
+        # connected ServerProtocols and WebSocketProtocols. write_buffer_limit is their
+        # transports' high-water mark, None for asyncio's default. a frontend that is held
+        # more than max_held_bytes of messages is aborted, unless it is None.
+        self.frontends = set()
+        self.connection_made_logged = False
+        self.write_buffer_limit = write_buffer_limit
+        self.max_held_bytes = max_held_bytes
+
+        # None: checkpoint a game as soon as it changed. otherwise: checkpoint_games is
+        # called every this many seconds.
+        self.checkpoint_interval = checkpoint_interval
+        self.internal_game_id_to_checkpoint_state_version = {}
+        self.checkpoint_pending_games = {}
+
+        # GameProcessProtocol of each game process. without any, games run in this process.
+        self.game_processes = []
+
+    def create_game(self, game_id, internal_game_id, mode, max_players):
+        if self.game_processes:
+            return GameProxy(
+                self.game_processes[(game_id - 1) % len(self.game_processes)],
+                game_id,
+                internal_game_id,
+                mode,
+                max_players,
+            )
+        return Game(
+            game_id,
+            internal_game_id,
+            mode,
+            max_players,
+            self.add_pending_messages,
+            lobby_client_ids=self.lobby_client_ids,
+            add_pending_batch=self.add_pending_batch,
+        )
+
+    def add_pending_messages(self, messages, client_ids=None, more_client_ids=None):
+        # encode each batch of messages once, no matter how many clients it goes to
+        self.add_pending_batch(
+            ",".join([ujson.dumps(message) for message in messages]),
+            client_ids,
+            more_client_ids,
+        )
+
+    def add_pending_batch(self, batch_json, client_ids=None, more_client_ids=None):
+        # batch_json is comma separated encoded messages. it goes to the clients in
+        # client_ids and more_client_ids, once to clients in both.
         if client_ids is None:
             client_ids = self.client_ids
-        client_ids = client_ids.copy()
-        new_list = []
-        for client_ids2, messages2 in self.client_ids_and_messages:
-            client_ids_in_group = client_ids2 & client_ids
-            if len(client_ids_in_group) == len(client_ids2):
-                messages2.extend(messages)
-                new_list.append([client_ids2, messages2])
-            elif client_ids_in_group:
-                new_list.append([client_ids_in_group, messages2 + messages])
-                client_ids2 -= client_ids_in_group
-                new_list.append([client_ids2, messages2])
+        batch_index = len(self.pending_batches)
+        self.pending_batches.append(batch_json)
+        client_id_to_batch_indexes = self.client_id_to_pending_batch_indexes
+        for client_id in client_ids:
+            batch_indexes = client_id_to_batch_indexes.get(client_id)
+            if batch_indexes is None:
+                client_id_to_batch_indexes[client_id] = [batch_index]
             else:
-                new_list.append([client_ids2, messages2])
-            client_ids -= client_ids_in_group
-        if client_ids:
-            new_list.append([client_ids, messages])
-        self.client_ids_and_messages = new_list
+                batch_indexes.append(batch_index)
+        if more_client_ids:
+            for client_id in more_client_ids:
+                batch_indexes = client_id_to_batch_indexes.get(client_id)
+                if batch_indexes is None:
+                    client_id_to_batch_indexes[client_id] = [batch_index]
+                elif batch_indexes[-1] != batch_index:
+                    batch_indexes.append(batch_index)
+
+    def request_flush(self):
+        if self.flush_delay is None:
+            self.flush_pending_messages()
+        elif self.flush_handle is None:
+            loop = asyncio.get_event_loop()
+            if self.flush_delay:
+                self.flush_handle = loop.call_later(
+                    self.flush_delay, self.flush_pending_messages
+                )
+            else:
+                self.flush_handle = loop.call_soon(self.flush_pending_messages)
 
-    def flush_pending_messages(self):
+    def write_held_messages(self, frontend, client_ids=None):
+        # writes what was held for the frontend's clients, or only for the given ones
         outgoing = []
-        for client_ids, messages in self.client_ids_and_messages:
-            client_ids_string = ",".join(str(x) for x in sorted(client_ids))
-            messages_json = ujson.dumps(messages)
-            print(client_ids_string, "<-", messages_json)
+        for client_ids_string, messages_json in frontend.held_messages.pop_lines(
+            client_ids
+        ):
+            log_writer.log("command-to-client", client_ids_string, "<-", messages_json)
+            outgoing.append(client_ids_string)
+            outgoing.append(" ")
+            outgoing.append(messages_json)
+            outgoing.append("\n")
+        log_writer.end_batch()
+
+        if outgoing:
+            frontend.write("".join(outgoing).encode())
+
+    def log_frontend_metrics(self):
+        log_writer.log("time", "time:", time.time())
+        for frontend in sorted(self.frontends, key=lambda x: x.frontend_id):
+            log_writer.log(
+                "metrics",
+                " ".join("%s=%s" % item for item in frontend.get_metrics()),
+            )
+        log_writer.end_batch()
+
+    def write_to_frontend(self, frontend, data):
+        # clients made without a frontend are written to with transport_write
+        if frontend:
+            frontend.write(data)
+        else:
+            self.transport_write(data)
+
+    def flush_pending_messages(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        # clients that were sent the same batches share an outgoing line
+        batch_indexes_to_client_ids = collections.defaultdict(list)
+        for client_id, batch_indexes in self.client_id_to_pending_batch_indexes.items():
+            batch_indexes_to_client_ids[tuple(batch_indexes)].append(client_id)
+
+        # and each frontend is only sent the lines for its own clients
+        frontend_to_outgoing = collections.defaultdict(list)
+        held_frontends = set()
+        client_id_to_client = self.client_id_to_client
+        pending_batches = self.pending_batches
+        for batch_indexes, client_ids in batch_indexes_to_client_ids.items():
+            messages_json = (
+                "["
+                + ",".join(
+                    [pending_batches[x] for x in batch_indexes if pending_batches[x]]
+                )
+                + "]"
+            )
+
+            frontend_to_client_ids = collections.defaultdict(list)
+            for client_id in client_ids:
+                client = client_id_to_client.get(client_id)
+                frontend_to_client_ids[client.frontend if client else None].append(
+                    client_id
+                )
+
+            for frontend, frontend_client_ids in frontend_to_client_ids.items():
+                if frontend and frontend.writing_paused:
+                    frontend.held_messages.add(frontend_client_ids, messages_json)
+                    held_frontends.add(frontend)
+                    continue
+
+                client_ids_string = ",".join(
+                    str(x) for x in sorted(frontend_client_ids)
+                )
+                log_writer.log(
+                    "command-to-client", client_ids_string, "<-", messages_json
+                )
+
+                outgoing = frontend_to_outgoing[frontend]
+                outgoing.append(client_ids_string)
+                outgoing.append(" ")
+                outgoing.append(messages_json)
+                outgoing.append("\n")
+
+        del self.pending_batches[:]
+        self.client_id_to_pending_batch_indexes.clear()
+        log_writer.end_batch()
 
-            outgoing.append(client_ids_string.encode())
-            outgoing.append(b" ")
-            outgoing.append(messages_json.encode())
-            outgoing.append(b"\n")
+        for frontend, outgoing in frontend_to_outgoing.items():
+            self.write_to_frontend(frontend, "".join(outgoing).encode())
 
-        del self.client_ids_and_messages[:]
-        print()
+        if self.max_held_bytes is not None:
+            for frontend in held_frontends:
+                if frontend.held_messages.num_bytes > self.max_held_bytes:
+                    frontend.abort()
 
-        self.transport_write(b"".join(outgoing))
+        for game_process in self.game_processes:
+            game_process.flush()
+
+    def checkpoint_game(self, game):
+        # called after a client created or joined a game or did a game action
+        if (
+            checkpoint_writer.file
+            and game.state_version
+            != self.internal_game_id_to_checkpoint_state_version.get(
+                game.internal_game_id
+            )
+        ):
+            self.checkpoint_pending_games[game.internal_game_id] = game
+            if not self.checkpoint_interval:
+                self.checkpoint_games()
+
+    def checkpoint_games(self):
+        if self.checkpoint_pending_games:
+            for internal_game_id, game in self.checkpoint_pending_games.items():
+                checkpoint_writer.write_game(
+                    internal_game_id, tuple(game.get_checkpoint())
+                )
+                self.internal_game_id_to_checkpoint_state_version[
+                    internal_game_id
+                ] = game.state_version
+            self.checkpoint_pending_games.clear()
+            checkpoint_writer.flush()
+
+    def restore_games(self, checkpoints, last_internal_game_id):
+        # checkpoints are the tuples written by checkpoint_games. called before any client
+        # connects, so the games are without clients and expire like abandoned games.
+        expiration_time = time.time() + 300
+        for data in checkpoints:
+            game_checkpoint = GameCheckpoint._make(data)
+            game = Game(
+                game_checkpoint.game_id,
+                game_checkpoint.internal_game_id,
+                game_checkpoint.mode,
+                game_checkpoint.max_players,
+                self.add_pending_messages,
+                False,
+                game_checkpoint.tile_bag,
+                self.lobby_client_ids,
+                add_pending_batch=self.add_pending_batch,
+            )
+            game.logging_enabled = True
+            game.restore_checkpoint(game_checkpoint)
+            game.expiration_time = expiration_time
+            self.game_id_to_game[game.game_id] = game
+            self.internal_game_id_to_checkpoint_state_version[
+                game.internal_game_id
+            ] = game.state_version
+            self.update_game_expiration(game)
+            self.lobby_snapshot.update_game(game)
+
+        self.next_game_id_manager.set_used_ids(self.game_id_to_game.keys())
+        self.next_internal_game_id_manager.set_last_id(last_internal_game_id)
+
+    def update_game_expiration(self, game):
+        # called after a client joins, rejoins, watches or leaves a game
+        timer = self.game_id_to_expiration_timer.pop(game.game_id, None)
+        if timer:
+            self.timers.cancel(timer)
+        if game.expiration_time:
+            self.game_id_to_expiration_timer[game.game_id] = self.timers.schedule(
+                game.expiration_time, self._expire_game, game
+            )
+
+    def _expire_game(self, game):
+        del self.game_id_to_expiration_timer[game.game_id]
+        self.expired_games.append(game)
 
     def destroy_expired_games(self):
         current_time = time.time()
-        expired_games = []
-
-        for game in self.game_id_to_game.values():
-            if game.expiration_time and game.expiration_time <= current_time:
-                expired_games.append(game)
+        self.timers.run(current_time)
+        expired_games = self.expired_games
+        self.expired_games = []
 
         if expired_games:
-            messages = []
-            print("time:", current_time)
+            games = []
             for game in expired_games:
-                game_id = game.game_id
-                internal_game_id = game.internal_game_id
-                print("game #%d expired (internal #%d)" % (game_id, internal_game_id))
-                self.next_game_id_manager.return_id(game_id)
-                self.next_internal_game_id_manager.return_id(internal_game_id)
-                del self.game_id_to_game[game_id]
-                messages.append([enums.CommandsToClient.DestroyGame.value, game_id])
-            self.add_pending_messages(messages)
-            self.flush_pending_messages()
+                if isinstance(game, GameProxy):
+                    # destroyed when its game process replies that it expired there too
+                    game.expire()
+                else:
+                    games.append(game)
+            if games:
+                self.destroy_games(games, current_time)
+            self.request_flush()
+
+    def destroy_games(self, games, current_time):
+        messages = []
+        log_writer.log("time", "time:", current_time)
+        for game in games:
+            game_id = game.game_id
+            internal_game_id = game.internal_game_id
+            log_writer.log(
+                "game",
+                "game #%d expired (internal #%d)" % (game_id, internal_game_id),
+            )
+            if event_log_writer.file:
+                log = collections.OrderedDict()
+                log["_"] = "game-expired"
+                log["game-id"] = internal_game_id
+                log["external-game-id"] = game_id
+                event_log_writer.write(
+                    event_log.EventTypes.GameExpired,
+                    current_time,
+                    internal_game_id,
+                    log,
+                )
+            self.next_game_id_manager.return_id(game_id)
+            self.next_internal_game_id_manager.return_id(internal_game_id)
+            if checkpoint_writer.file:
+                checkpoint_writer.remove_game(internal_game_id)
+                self.internal_game_id_to_checkpoint_state_version.pop(
+                    internal_game_id, None
+                )
+                self.checkpoint_pending_games.pop(internal_game_id, None)
+            del self.game_id_to_game[game_id]
+            self.lobby_snapshot.remove_game(game)
+            messages.append([enums.CommandsToClient.DestroyGame.value, game_id])
+        self.add_pending_messages(messages, self.lobby_client_ids)
 
 
 class Client:
-    def __init__(self, server, username, ip_address, socket_id, replace_existing_user):
+    def __init__(
+        self,
+        server,
+        username,
+        ip_address,
+        socket_id,
+        replace_existing_user,
+        frontend=None,
+    ):
         self._server = server
+        self.frontend = frontend
         self.username = username
         self.ip_address = ip_address
         self.client_id = self._server.next_client_id_manager.get_id()
         self._logged_in = False
         self.game_id = None
         self.player_id = None
+        self.lobby_in_game = False
+        self.global_chat_in_game = False
 
         self._server.client_id_to_client[self.client_id] = self
+        if frontend:
+            frontend.client_ids.add(self.client_id)
         messages_client = []
 
         def output_connect_messages():
-            print("time:", time.time())
-            print(
+            log_writer.log("time", "time:", time.time())
+            log_writer.log(
+                "client",
                 self.client_id,
                 "connect",
                 self.username,
@@ -202,8 +1163,9 @@ class Client:
                 socket_id,
                 replace_existing_user,
             )
-            self._server.transport_write(
-                b"connect " + ujson.dumps([socket_id, self.client_id]).encode() + b"\n"
+            self._server.write_to_frontend(
+                self.frontend,
+                b"connect " + ujson.dumps([socket_id, self.client_id]).encode() + b"\n",
             )
 
         if self.username in self._server.username_to_client:
@@ -218,13 +1180,15 @@ class Client:
                     ]
                 )
                 self._server.add_pending_messages(messages_client, {self.client_id})
-                self._server.flush_pending_messages()
+                self._server.request_flush()
                 self.disconnect()
                 return
 
         output_connect_messages()
 
         self._server.client_ids.add(self.client_id)
+        self._server.lobby_client_ids.add(self.client_id)
+        self._server.global_chat_client_ids.add(self.client_id)
 
         self._logged_in = True
         self.on_message_lookup = []
@@ -243,22 +1207,16 @@ class Client:
         messages_client.append(
             [enums.CommandsToClient.SetClientId.value, self.client_id]
         )
+        self._server.add_pending_messages(messages_client, {self.client_id})
 
         # tell client about other clients' data
-        for client in self._server.client_id_to_client.values():
-            if client is not self:
-                messages_client.append(
-                    [
-                        enums.CommandsToClient.SetClientIdToData.value,
-                        client.client_id,
-                        client.username,
-                        client.ip_address,
-                    ]
-                )
-        self._server.add_pending_messages(messages_client, {self.client_id})
-        messages_client = []
+        lobby_snapshot = self._server.lobby_snapshot
+        self._server.add_pending_batch(
+            lobby_snapshot.get_clients_json(), {self.client_id}
+        )
+        lobby_snapshot.add_client(self)
 
-        # tell all clients about client's data
+        # tell lobby clients about client's data
         self._server.add_pending_messages(
             [
                 [
@@ -267,75 +1225,53 @@ class Client:
                     self.username,
                     self.ip_address,
                 ]
-            ]
+            ],
+            self._server.lobby_client_ids,
         )
 
         # tell client about all games
-        for game in sorted(
-            self._server.game_id_to_game.values(), key=lambda x: x.internal_game_id
-        ):
-            game_id = game.game_id
-            messages_client.append(
-                [
-                    enums.CommandsToClient.SetGameState.value,
-                    game_id,
-                    game.state,
-                    game.mode,
-                    game.max_players,
-                ]
-            )
-            for player_id, player_datum in enumerate(game.score_sheet.player_data):
-                if player_datum[enums.ScoreSheetIndexes.Client.value]:
-                    messages_client.append(
-                        [
-                            enums.CommandsToClient.SetGamePlayerJoin.value,
-                            game_id,
-                            player_id,
-                            player_datum[
-                                enums.ScoreSheetIndexes.Client.value
-                            ].client_id,
-                        ]
-                    )
-                else:
-                    username = player_datum[enums.ScoreSheetIndexes.Username.value]
-                    client = self._server.username_to_client.get(username)
-                    messages_client.append(
-                        [
-                            enums.CommandsToClient.SetGamePlayerJoinMissing.value,
-                            game_id,
-                            player_id,
-                            client.client_id if client else username,
-                        ]
-                    )
-            for client_id in game.watcher_client_ids:
-                messages_client.append(
-                    [
-                        enums.CommandsToClient.SetGameWatcherClientId.value,
-                        game_id,
-                        client_id,
-                    ]
-                )
-        self._server.add_pending_messages(messages_client, {self.client_id})
+        self._server.add_pending_batch(
+            lobby_snapshot.get_games_json(), {self.client_id}
+        )
 
-        self._server.flush_pending_messages()
+        self._server.request_flush()
 
     def disconnect(self):
-        print("time:", time.time())
-        print(self.client_id, "disconnect")
+        # the frontend closes the socket upon "disconnect", so send what is pending first
+        if self._server.flush_handle:
+            self._server.flush_pending_messages()
 
-        self._server.transport_write(
-            b"disconnect " + str(self.client_id).encode() + b"\n"
+        # and what was held for it, unless the frontend disconnected it
+        if self.frontend and self.frontend.held_messages.num_bytes:
+            self._server.write_held_messages(self.frontend, [self.client_id])
+
+        log_writer.log("time", "time:", time.time())
+        log_writer.log("client", self.client_id, "disconnect")
+
+        self._server.write_to_frontend(
+            self.frontend, b"disconnect " + str(self.client_id).encode() + b"\n"
         )
 
+        if self.frontend:
+            self.frontend.client_ids.discard(self.client_id)
         del self._server.client_id_to_client[self.client_id]
         self._server.client_ids.discard(self.client_id)
+        self._server.lobby_client_ids.discard(self.client_id)
+        self._server.global_chat_client_ids.discard(self.client_id)
         self._server.next_client_id_manager.return_id(self.client_id)
 
+        game = None
         if self.game_id:
-            self._server.game_id_to_game[self.game_id].leave_game(self)
+            game = self._server.game_id_to_game[self.game_id]
+            game.leave_game(self)
+            self._server.update_game_expiration(game)
+            self._server.lobby_snapshot.update_game(game)
 
         if self._logged_in:
             del self._server.username_to_client[self.username]
+            self._server.lobby_snapshot.remove_client(self)
+            # the clients in the game may have been sent this client's data without being
+            # in the lobby
             self._server.add_pending_messages(
                 [
                     [
@@ -344,17 +1280,19 @@ class Client:
                         None,
                         None,
                     ]
-                ]
+                ],
+                self._server.lobby_client_ids,
+                game.client_ids if game else None,
             )
-            self._server.flush_pending_messages()
+            self._server.request_flush()
         else:
-            print()
+            log_writer.end_batch()
 
     def on_message(self, payload):
         try:
             message = payload.decode()
-            print("time:", time.time())
-            print(self.client_id, "->", message)
+            log_writer.log("time", "time:", time.time())
+            log_writer.log("command-to-server", self.client_id, "->", message)
             message = ujson.decode(message)
             method = self.on_message_lookup[message[0]]
             arguments = message[1:]
@@ -365,7 +1303,7 @@ class Client:
 
         try:
             method(*arguments)
-            self._server.flush_pending_messages()
+            self._server.request_flush()
         except TypeError:
             traceback.print_exc()
             self.disconnect()
@@ -380,49 +1318,81 @@ class Client:
         ):
             game_id = self._server.next_game_id_manager.get_id()
             internal_game_id = self._server.next_internal_game_id_manager.get_id()
-            game = Game(
-                game_id,
-                internal_game_id,
-                mode,
-                max_players,
-                self._server.add_pending_messages,
+            game = self._server.create_game(
+                game_id, internal_game_id, mode, max_players
             )
             game.join_game(self)
             self._server.game_id_to_game[game_id] = game
+            self._server.update_game_expiration(game)
+            self._server.lobby_snapshot.update_game(game)
+            self._server.checkpoint_game(game)
+            self._update_subscriptions()
 
     def _on_message_join_game(self, game_id):
         if not self.game_id and game_id in self._server.game_id_to_game:
-            self._server.game_id_to_game[game_id].join_game(self)
+            game = self._server.game_id_to_game[game_id]
+            self._send_client_data_to_game(game)
+            game.join_game(self)
+            self._server.update_game_expiration(game)
+            self._server.lobby_snapshot.update_game(game)
+            self._server.checkpoint_game(game)
+            self._update_subscriptions()
 
     def _on_message_rejoin_game(self, game_id):
         if not self.game_id and game_id in self._server.game_id_to_game:
-            self._server.game_id_to_game[game_id].rejoin_game(self)
+            game = self._server.game_id_to_game[game_id]
+            self._send_client_data_to_game(game)
+            game.rejoin_game(self)
+            self._server.update_game_expiration(game)
+            self._server.lobby_snapshot.update_game(game)
+            self._update_subscriptions()
 
     def _on_message_watch_game(self, game_id):
         if not self.game_id and game_id in self._server.game_id_to_game:
-            self._server.game_id_to_game[game_id].watch_game(self)
+            game = self._server.game_id_to_game[game_id]
+            self._send_client_data_to_game(game)
+            game.watch_game(self)
+            self._server.update_game_expiration(game)
+            self._server.lobby_snapshot.update_game(game)
+            self._update_subscriptions()
 
     def _on_message_leave_game(self):
         if self.game_id:
-            self._server.game_id_to_game[self.game_id].leave_game(self)
+            game = self._server.game_id_to_game[self.game_id]
+            # subscribe first, so the client is told it left the game
+            was_in_lobby = self.client_id in self._server.lobby_client_ids
+            self._server.lobby_client_ids.add(self.client_id)
+            game.leave_game(self)
+            self._server.update_game_expiration(game)
+            self._server.lobby_snapshot.update_game(game)
+            if not was_in_lobby:
+                self._send_lobby_catch_up()
+            self._update_subscriptions()
 
     def _on_message_do_game_action(self, game_action_id, *data):
         if self.game_id:
-            self._server.game_id_to_game[self.game_id].do_game_action(
-                self, game_action_id, data
-            )
+            game = self._server.game_id_to_game[self.game_id]
+            state = game.state
+            if game.do_game_action(self, game_action_id, data):
+                if game.state != state:
+                    self._server.lobby_snapshot.update_game(game)
+                self._server.checkpoint_game(game)
 
     def _on_message_send_global_chat_message(self, chat_message):
         chat_message = " ".join(chat_message.split())
         if chat_message:
+            # the username is included for clients that are in a game and not
+            # receiving lobby changes, who might not know this client
             self._server.add_pending_messages(
                 [
                     [
                         enums.CommandsToClient.AddGlobalChatMessage.value,
                         self.client_id,
                         chat_message,
+                        self.username,
                     ]
-                ]
+                ],
+                self._server.global_chat_client_ids,
             )
 
     def _on_message_send_game_chat_message(self, chat_message):
@@ -440,6 +1410,272 @@ class Client:
                     self._server.game_id_to_game[self.game_id].client_ids,
                 )
 
+    def _on_message_set_in_game_subscriptions(self, lobby, global_chat):
+        if isinstance(lobby, bool) and isinstance(global_chat, bool):
+            self.lobby_in_game = lobby
+            self.global_chat_in_game = global_chat
+            self._update_subscriptions()
+
+    def _update_subscriptions(self):
+        in_lobby = not self.game_id or self.lobby_in_game
+        lobby_client_ids = self._server.lobby_client_ids
+        if in_lobby and self.client_id not in lobby_client_ids:
+            lobby_client_ids.add(self.client_id)
+            self._send_lobby_catch_up()
+        elif not in_lobby:
+            lobby_client_ids.discard(self.client_id)
+
+        if not self.game_id or self.global_chat_in_game:
+            self._server.global_chat_client_ids.add(self.client_id)
+        else:
+            self._server.global_chat_client_ids.discard(self.client_id)
+
+    def _send_lobby_catch_up(self):
+        # the client missed lobby changes while it was in a game, so replace its lobby
+        lobby_snapshot = self._server.lobby_snapshot
+        self._server.add_pending_messages(
+            [[enums.CommandsToClient.ResetLobby.value]], {self.client_id}
+        )
+        self._server.add_pending_batch(
+            lobby_snapshot.get_clients_json(), {self.client_id}
+        )
+        self._server.add_pending_batch(
+            lobby_snapshot.get_games_json(), {self.client_id}
+        )
+
+    def _send_client_data_to_game(self, game):
+        # clients in the game that are not receiving lobby changes need this client's data
+        client_ids = game.client_ids - self._server.lobby_client_ids
+        if client_ids:
+            self._server.add_pending_messages(
+                [
+                    [
+                        enums.CommandsToClient.SetClientIdToData.value,
+                        self.client_id,
+                        self.username,
+                        self.ip_address,
+                    ]
+                ],
+                client_ids,
+            )
+
+
+class GameProxy:
+    # stands in for a game run by a game process. requests go to the game process, which
+    # replies with what the lobby needs to know about the game. clients are taken to be in
+    # the game right away, and the game process replies if they could not join after all.
+    def __init__(self, game_process, game_id, internal_game_id, mode, max_players):
+        self.game_process = game_process
+        self.game_id = game_id
+        self.internal_game_id = internal_game_id
+        self.state = enums.GameStates.Starting.value
+        self.mode = mode
+        self.max_players = max_players if mode == enums.GameModes.Singles.value else 4
+        self.lobby_players = []
+        self.client_ids = set()
+        self.watcher_client_ids = set()
+        self.expiration_time = None
+        game_process.send(
+            "create-game", [game_id, internal_game_id, mode, max_players, None]
+        )
+
+    def get_lobby_players(self):
+        return self.lobby_players
+
+    def join_game(self, client):
+        self._send_client_request("join-game", client)
+
+    def rejoin_game(self, client):
+        self._send_client_request("rejoin-game", client)
+
+    def watch_game(self, client):
+        self._send_client_request("watch-game", client)
+
+    def leave_game(self, client):
+        client.game_id = None
+        self.client_ids.discard(client.client_id)
+        self.game_process.send("leave-game", [self.game_id, client.client_id])
+
+    def do_game_action(self, client, game_action_id, data):
+        self.game_process.send(
+            "do-game-action",
+            [self.game_id, client.client_id, game_action_id, list(data)],
+        )
+
+    def expire(self):
+        self.game_process.send("expire-game", [self.game_id])
+
+    def update(self, data):
+        # data is from GameShard.get_game_data
+        (
+            _,
+            _,
+            self.state,
+            self.mode,
+            self.max_players,
+            self.lobby_players,
+            watcher_client_ids,
+            client_ids,
+            self.expiration_time,
+        ) = data
+        self.watcher_client_ids = set(watcher_client_ids)
+        self.client_ids = set(client_ids)
+
+    def _send_client_request(self, key, client):
+        client.game_id = self.game_id
+        self.client_ids.add(client.client_id)
+        self.expiration_time = None
+        self.game_process.send(key, [self.game_id, client.client_id, client.username])
+
+
+class GameProcessProtocol(asyncio.Protocol):
+    # the lobby's connection to a game process. requests and replies are lines of a key, a
+    # space and JSON. replies are messages for clients, in the output format of Server, with
+    # "lobby:<game id>" in front of the client ids for messages that also go to the lobby
+    # and to the clients the lobby has in the game, and these:
+    #   game [game id, internal game id, ...]: the game changed, see GameShard.get_game_data
+    #   game [game id, internal game id]: the game expired and was destroyed
+    #   not-in-game [client id, game id]: the client could not join or watch the game
+    #   log "...": lines the game process logged
+    #   end <count>: the replies to count requests are complete
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.receive_buffer = bytearray()
+        self.pending = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, key, data):
+        self.pending.append(key + " " + ujson.dumps(data) + "\n")
+
+    def flush(self):
+        if self.pending:
+            data = "".join(self.pending).encode()
+            del self.pending[:]
+            self.transport.write(data)
+
+    def data_received(self, data):
+        if data.find(b"\n") < 0:
+            self.receive_buffer += data
+            return
+
+        if self.receive_buffer:
+            self.receive_buffer += data
+            data = self.receive_buffer
+
+        lines = data.split(b"\n")
+        self.receive_buffer = bytearray(lines.pop())
+
+        handle_line = self.handle_line
+        for line in lines:
+            key, separator, value = line.partition(b" ")
+            if separator:
+                handle_line(key, value)
+
+    def handle_line(self, key, value):
+        server = self.server
+        if key == b"end":
+            server.request_flush()
+        elif key == b"game":
+            data = ujson.decode(value)
+            game = server.game_id_to_game.get(data[0])
+            if game is None or game.internal_game_id != data[1]:
+                return
+            if len(data) == 2:
+                for client_id in game.client_ids:
+                    client = server.client_id_to_client.get(client_id)
+                    if client and client.game_id == game.game_id:
+                        client.game_id = None
+                        client._update_subscriptions()
+                server.destroy_games([game], time.time())
+            else:
+                game.update(data)
+                server.update_game_expiration(game)
+                server.lobby_snapshot.update_game(game)
+        elif key == b"not-in-game":
+            client_id, game_id = ujson.decode(value)
+            client = server.client_id_to_client.get(client_id)
+            if client and client.game_id == game_id:
+                client.game_id = None
+                client._update_subscriptions()
+        elif key == b"log":
+            log_writer.log("time", "time:", time.time())
+            for line in ujson.decode(value).splitlines():
+                log_writer.log("game", line)
+            log_writer.end_batch()
+        else:
+            client_ids = key.decode().split(",")
+            batch_json = value[1:-1].decode()
+            if client_ids[0].startswith("lobby:"):
+                # like Game, also to the clients in the game as far as the lobby knows
+                more_client_ids = {int(x) for x in client_ids[1:]}
+                game = server.game_id_to_game.get(int(client_ids[0][6:]))
+                if game:
+                    more_client_ids.update(game.client_ids)
+                server.add_pending_batch(
+                    batch_json, server.lobby_client_ids, more_client_ids
+                )
+            else:
+                server.add_pending_batch(batch_json, [int(x) for x in client_ids])
+
+
+# the cells next to each cell, in the order fill_cells visits them
+coordinates_to_neighbors = {}
+for x in range(12):
+    for y in range(9):
+        neighbors = []
+        if x:
+            neighbors.append((x - 1, y))
+        if x < 11:
+            neighbors.append((x + 1, y))
+        if y:
+            neighbors.append((x, y - 1))
+        if y < 8:
+            neighbors.append((x, y + 1))
+        coordinates_to_neighbors[(x, y)] = neighbors
+
+
+def get_set_game_board_cells_message(board_type, indexes):
+    # indexes are x * 9 + y of the cells, the starting cell first. more than one cell is
+    # sent as [SetGameBoardCells, board_type, index, ...], where -n after an index stands
+    # for the n indexes following it, which is smaller than a SetGameBoardCell per cell.
+    if len(indexes) == 1:
+        x, y = divmod(indexes[0], 9)
+        return [enums.CommandsToClient.SetGameBoardCell.value, x, y, board_type]
+
+    message = [enums.CommandsToClient.SetGameBoardCells.value, board_type]
+    run_start = indexes[0]
+    run_end = run_start
+    for index in indexes[1:]:
+        if index == run_end + 1:
+            run_end = index
+            continue
+        message.append(run_start)
+        if run_end != run_start:
+            message.append(run_start - run_end)
+        run_start = index
+        run_end = index
+    message.append(run_start)
+    if run_end != run_start:
+        message.append(run_start - run_end)
+    return message
+
+
+def get_set_game_board_cells_indexes(message):
+    # the indexes of the cells in a SetGameBoardCells message, in order
+    indexes = []
+    index = None
+    for value in message[2:]:
+        if value >= 0:
+            index = value
+            indexes.append(index)
+        else:
+            indexes.extend(range(index + 1, index - value + 1))
+            index -= value
+    return indexes
+
 
 class GameBoard:
     def __init__(self, game, board=None):
@@ -459,8 +1695,12 @@ class GameBoard:
             for y in range(9):
                 self.board_type_to_coordinates[board[x][y]].add((x, y))
 
+        # cells changed since TileRacks last looked, as a mask of bits x * 9 + y
+        self.changed_cells_mask = 0
+
     def _set_cell(self, coordinates, board_type):
         x, y = coordinates
+        self.changed_cells_mask |= 1 << (x * 9 + y)
         old_board_type = self.x_to_y_to_board_type[x][y]
         self.board_type_to_coordinates[old_board_type].remove(coordinates)
         self.x_to_y_to_board_type[x][y] = board_type
@@ -468,48 +1708,306 @@ class GameBoard:
         return [enums.CommandsToClient.SetGameBoardCell.value, x, y, board_type]
 
     def set_cell(self, coordinates, board_type):
-        self.game.add_pending_messages(
-            [self._set_cell(coordinates, board_type)], self.game.client_ids
+        message = self._set_cell(coordinates, board_type)
+        if not self.game.headless:
+            self.game.add_pending_messages([message], self.game.client_ids)
+
+    def get_chain_size(self, board_type):
+        return len(self.board_type_to_coordinates[board_type])
+
+    def snapshot(self):
+        return (
+            tuple(tuple(column) for column in self.x_to_y_to_board_type),
+            tuple(frozenset(x) for x in self.board_type_to_coordinates),
+            self.changed_cells_mask,
         )
 
+    def restore(self, snapshot):
+        board, board_type_to_coordinates, self.changed_cells_mask = snapshot
+        self.x_to_y_to_board_type = [list(column) for column in board]
+        self.board_type_to_coordinates = [set(x) for x in board_type_to_coordinates]
+
     def fill_cells(self, coordinates, board_type):
         pending = [coordinates]
         found = {coordinates}
-        messages = []
         excluded_board_types = {
             enums.GameBoardTypes.Nothing.value,
             enums.GameBoardTypes.CantPlayEver.value,
             board_type,
         }
 
-        while pending:
-            new_pending = []
-            for coords in pending:
-                messages.append(self._set_cell(coords, board_type))
-
-                x, y = coords
-                possibilities = []
-                if x:
-                    possibilities.append((x - 1, y))
-                if x < 11:
-                    possibilities.append((x + 1, y))
-                if y:
-                    possibilities.append((x, y - 1))
-                if y < 8:
-                    possibilities.append((x, y + 1))
-
-                for coords2 in possibilities:
-                    if (
-                        coords2 not in found
-                        and self.x_to_y_to_board_type[coords2[0]][coords2[1]]
-                        not in excluded_board_types
-                    ):
-                        new_pending.append(coords2)
-                        found.add(coords2)
+        while pending:
+            new_pending = []
+            for coords in pending:
+                self._set_cell(coords, board_type)
+
+                for coords2 in coordinates_to_neighbors[coords]:
+                    if (
+                        coords2 not in found
+                        and self.x_to_y_to_board_type[coords2[0]][coords2[1]]
+                        not in excluded_board_types
+                    ):
+                        new_pending.append(coords2)
+                        found.add(coords2)
+
+            pending = new_pending
+
+        if not self.game.headless:
+            x, y = coordinates
+            start_index = x * 9 + y
+            indexes = sorted(x * 9 + y for x, y in found if x * 9 + y != start_index)
+            self.game.add_pending_messages(
+                [get_set_game_board_cells_message(board_type, [start_index] + indexes)],
+                self.game.client_ids,
+            )
+
+
+# cell (x, y) is bit x * 9 + y, so moving one cell in x is a shift by 9 and moving one
+# cell in y is a shift by 1 that must not cross into the next column
+bitboard_all_cells = (1 << 108) - 1
+bitboard_not_y0 = 0
+bitboard_not_y8 = 0
+for x in range(12):
+    for y in range(9):
+        if y:
+            bitboard_not_y0 |= 1 << (x * 9 + y)
+        if y < 8:
+            bitboard_not_y8 |= 1 << (x * 9 + y)
+bitboard_index_to_coordinates = [(x, y) for x in range(12) for y in range(9)]
+
+
+def get_bitboard_neighbors(mask):
+    return (
+        (mask << 9)
+        | (mask >> 9)
+        | ((mask & bitboard_not_y8) << 1)
+        | ((mask & bitboard_not_y0) >> 1)
+    ) & bitboard_all_cells
+
+
+class BitboardGameBoard(GameBoard):
+    # same as GameBoard, but the cells of each board type are kept as a bitmask instead of a
+    # set of coordinates, so filling a chain is a few operations on ints
+    def __init__(self, game, board=None):
+        self.game = game
+
+        self.board_type_to_mask = [0] * enums.GameBoardTypes.Max.value
+        self.board_type_to_count = [0] * enums.GameBoardTypes.Max.value
+        if board is None:
+            nothing = enums.GameBoardTypes.Nothing.value
+            board = [[nothing] * 9 for x in range(12)]
+            self.board_type_to_mask[nothing] = bitboard_all_cells
+            self.board_type_to_count[nothing] = 108
+        else:
+            board_type_to_mask = self.board_type_to_mask
+            board_type_to_count = self.board_type_to_count
+            for index, (x, y) in enumerate(bitboard_index_to_coordinates):
+                board_type = board[x][y]
+                board_type_to_mask[board_type] |= 1 << index
+                board_type_to_count[board_type] += 1
+        self.x_to_y_to_board_type = board
+
+        self.changed_cells_mask = 0
+
+    def _set_cell(self, coordinates, board_type):
+        x, y = coordinates
+        old_board_type = self.x_to_y_to_board_type[x][y]
+        bit = 1 << (x * 9 + y)
+        self.changed_cells_mask |= bit
+        self.board_type_to_mask[old_board_type] &= ~bit
+        self.board_type_to_count[old_board_type] -= 1
+        self.x_to_y_to_board_type[x][y] = board_type
+        self.board_type_to_mask[board_type] |= bit
+        self.board_type_to_count[board_type] += 1
+        return [enums.CommandsToClient.SetGameBoardCell.value, x, y, board_type]
+
+    def get_chain_size(self, board_type):
+        return self.board_type_to_count[board_type]
+
+    def snapshot(self):
+        return (
+            tuple(tuple(column) for column in self.x_to_y_to_board_type),
+            tuple(self.board_type_to_mask),
+            tuple(self.board_type_to_count),
+            self.changed_cells_mask,
+        )
+
+    def restore(self, snapshot):
+        (
+            board,
+            board_type_to_mask,
+            board_type_to_count,
+            self.changed_cells_mask,
+        ) = snapshot
+        self.x_to_y_to_board_type = [list(column) for column in board]
+        self.board_type_to_mask = list(board_type_to_mask)
+        self.board_type_to_count = list(board_type_to_count)
+
+    def fill_cells(self, coordinates, board_type):
+        board_type_to_mask = self.board_type_to_mask
+        fillable = bitboard_all_cells & ~(
+            board_type_to_mask[enums.GameBoardTypes.Nothing.value]
+            | board_type_to_mask[enums.GameBoardTypes.CantPlayEver.value]
+            | board_type_to_mask[board_type]
+        )
+
+        x, y = coordinates
+        start = 1 << (x * 9 + y)
+        found = start
+        frontier = found
+        while frontier:
+            frontier = get_bitboard_neighbors(frontier) & fillable & ~found
+            found |= frontier
+
+        self._move_cells(coordinates, found, board_type)
+
+    def _move_cells(self, coordinates, found, board_type):
+        # sets the cells in the found mask to board_type, starting cell included
+        board_type_to_mask = self.board_type_to_mask
+        board_type_to_count = self.board_type_to_count
+        x, y = coordinates
+        start = 1 << (x * 9 + y)
+
+        found_and_start = found | start
+        for old_board_type, mask in enumerate(board_type_to_mask):
+            if mask & found_and_start and old_board_type != board_type:
+                board_type_to_count[old_board_type] -= bin(
+                    mask & found_and_start
+                ).count("1")
+                board_type_to_mask[old_board_type] = mask & ~found_and_start
+        board_type_to_count[board_type] += bin(
+            found_and_start & ~board_type_to_mask[board_type]
+        ).count("1")
+        board_type_to_mask[board_type] |= found_and_start
+        self.changed_cells_mask |= found_and_start
+
+        # the starting cell first, then the rest in board order
+        x_to_y_to_board_type = self.x_to_y_to_board_type
+        x_to_y_to_board_type[x][y] = board_type
+        found &= ~start
+        if self.game.headless:
+            while found:
+                bit = found & -found
+                x, y = bitboard_index_to_coordinates[bit.bit_length() - 1]
+                x_to_y_to_board_type[x][y] = board_type
+                found ^= bit
+            return
+
+        indexes = [x * 9 + y]
+        while found:
+            bit = found & -found
+            index = bit.bit_length() - 1
+            x, y = bitboard_index_to_coordinates[index]
+            x_to_y_to_board_type[x][y] = board_type
+            indexes.append(index)
+            found ^= bit
+
+        self.game.add_pending_messages(
+            [get_set_game_board_cells_message(board_type, indexes)],
+            self.game.client_ids,
+        )
+
+
+bitboard_index_to_neighbor_indexes = [
+    [x * 9 + y for x, y in coordinates_to_neighbors[coordinates]]
+    for coordinates in bitboard_index_to_coordinates
+]
 
-            pending = new_pending
+not_tile_game_board_type_ids = frozenset(
+    [enums.GameBoardTypes.Nothing.value, enums.GameBoardTypes.CantPlayEver.value]
+)
+
+
+class UnionFindGameBoard(BitboardGameBoard):
+    # same as BitboardGameBoard, but groups of connected tiles are also kept in a disjoint-set
+    # forest with the mask of each group's cells at its root. tiles never leave the board,
+    # so groups only ever get joined, and fill_cells looks up the cells to change instead of
+    # flooding. this relies on every group being a single chain or only NothingYet cells,
+    # apart from the tile being played, which holds in a game.
+    def __init__(self, game, board=None):
+        super().__init__(game, board)
+        self._make_groups()
+
+    def _make_groups(self):
+        self.index_to_parent = list(range(108))
+        self.index_to_group_size = [1] * 108
+        self.index_to_group_mask = [1 << index for index in range(108)]
+        tiles_mask = bitboard_all_cells & ~(
+            self.board_type_to_mask[enums.GameBoardTypes.Nothing.value]
+            | self.board_type_to_mask[enums.GameBoardTypes.CantPlayEver.value]
+        )
+        for index in range(108):
+            if tiles_mask >> index & 1:
+                self._join_neighbors(index)
+
+    @staticmethod
+    def _is_tile(board_type):
+        return board_type not in not_tile_game_board_type_ids
+
+    def _find(self, index):
+        index_to_parent = self.index_to_parent
+        while index_to_parent[index] != index:
+            index_to_parent[index] = index_to_parent[index_to_parent[index]]
+            index = index_to_parent[index]
+        return index
+
+    def _join_neighbors(self, index):
+        # joins the cell at index with the groups of the tiles next to it, returns the root
+        index_to_parent = self.index_to_parent
+        index_to_group_size = self.index_to_group_size
+        index_to_group_mask = self.index_to_group_mask
+        x_to_y_to_board_type = self.x_to_y_to_board_type
+
+        root = self._find(index)
+        for neighbor_index in bitboard_index_to_neighbor_indexes[index]:
+            x, y = bitboard_index_to_coordinates[neighbor_index]
+            if x_to_y_to_board_type[x][y] not in not_tile_game_board_type_ids:
+                neighbor_root = self._find(neighbor_index)
+                if neighbor_root != root:
+                    if index_to_group_size[root] < index_to_group_size[neighbor_root]:
+                        root, neighbor_root = neighbor_root, root
+                    index_to_parent[neighbor_root] = root
+                    index_to_group_size[root] += index_to_group_size[neighbor_root]
+                    index_to_group_mask[root] |= index_to_group_mask[neighbor_root]
+        return root
+
+    def _set_cell(self, coordinates, board_type):
+        x, y = coordinates
+        was_tile = self._is_tile(self.x_to_y_to_board_type[x][y])
+        message = super()._set_cell(coordinates, board_type)
+        if self._is_tile(board_type):
+            if not was_tile:
+                self._join_neighbors(x * 9 + y)
+        elif was_tile:
+            # groups can't be split, so start over. does not happen in a game.
+            self._make_groups()
+        return message
+
+    def snapshot(self):
+        return (
+            super().snapshot(),
+            tuple(self.index_to_parent),
+            tuple(self.index_to_group_size),
+            tuple(self.index_to_group_mask),
+        )
 
-        self.game.add_pending_messages(messages, self.game.client_ids)
+    def restore(self, snapshot):
+        (
+            bitboard_snapshot,
+            index_to_parent,
+            index_to_group_size,
+            index_to_group_mask,
+        ) = snapshot
+        super().restore(bitboard_snapshot)
+        self.index_to_parent = list(index_to_parent)
+        self.index_to_group_size = list(index_to_group_size)
+        self.index_to_group_mask = list(index_to_group_mask)
+
+    def fill_cells(self, coordinates, board_type):
+        x, y = coordinates
+        root = self._join_neighbors(x * 9 + y)
+        found = self.index_to_group_mask[root] & ~self.board_type_to_mask[board_type]
+        self._move_cells(coordinates, found | 1 << (x * 9 + y), board_type)
 
 
 class ScoreSheet:
@@ -524,6 +2022,40 @@ class ScoreSheet:
         self.creator_username = None
         self.username_to_player_id = {}
 
+    def snapshot(self):
+        # clients are not part of a snapshot
+        client_index = enums.ScoreSheetIndexes.Client.value
+        return (
+            tuple(tuple(row[:client_index]) for row in self.player_data),
+            tuple(self.available),
+            tuple(self.chain_size),
+            tuple(self.price),
+            self.creator_username,
+            tuple(self.username_to_player_id.items()),
+        )
+
+    def restore(self, snapshot):
+        # players keep their clients, by player id
+        clients = [
+            row[enums.ScoreSheetIndexes.Client.value] for row in self.player_data
+        ]
+        (
+            player_data,
+            available,
+            chain_size,
+            price,
+            self.creator_username,
+            username_to_player_id,
+        ) = snapshot
+        self.player_data = [
+            list(row) + [clients[player_id] if player_id < len(clients) else None]
+            for player_id, row in enumerate(player_data)
+        ]
+        self.available = list(available)
+        self.chain_size = list(chain_size)
+        self.price = list(price)
+        self.username_to_player_id = dict(username_to_player_id)
+
     def join_game(self, client, position_tile):
         messages_client = []
 
@@ -555,7 +2087,13 @@ class ScoreSheet:
                     log["external-game-id"] = self.game.game_id
                     log["player-id"] = player_id
                     log["username"] = username
-                    print(json.dumps(log, separators=(",", ":")))
+                    log_writer.log("game", json.dumps(log, separators=(",", ":")))
+                    event_log_writer.write(
+                        event_log.EventTypes.GamePlayer,
+                        time.time(),
+                        self.game.internal_game_id,
+                        log,
+                    )
 
             # tell client about other position tiles
             if player_id != client.player_id:
@@ -569,7 +2107,7 @@ class ScoreSheet:
                     ]
                 )
 
-        self.game.add_pending_messages(
+        self.game.add_pending_lobby_messages(
             [
                 [
                     enums.CommandsToClient.SetGamePlayerJoin.value,
@@ -579,14 +2117,14 @@ class ScoreSheet:
                 ]
             ]
         )
-        if messages_client:
+        if messages_client and not self.game.headless:
             self.game.add_pending_messages(messages_client, {client.client_id})
 
     def rejoin_game(self, client):
         player_id = self.username_to_player_id[client.username]
         client.player_id = player_id
         self.player_data[player_id][enums.ScoreSheetIndexes.Client.value] = client
-        self.game.add_pending_messages(
+        self.game.add_pending_lobby_messages(
             [
                 [
                     enums.CommandsToClient.SetGamePlayerRejoin.value,
@@ -601,7 +2139,7 @@ class ScoreSheet:
         player_id = client.player_id
         client.player_id = None
         self.player_data[player_id][enums.ScoreSheetIndexes.Client.value] = None
-        self.game.add_pending_messages(
+        self.game.add_pending_lobby_messages(
             [
                 [
                     enums.CommandsToClient.SetGamePlayerLeave.value,
@@ -628,17 +2166,18 @@ class ScoreSheet:
         if score_sheet_index <= enums.ScoreSheetIndexes.Imperial.value:
             self.available[score_sheet_index] -= adjustment
 
-        self.game.add_pending_messages(
-            [
+        if not self.game.headless:
+            self.game.add_pending_messages(
                 [
-                    enums.CommandsToClient.SetScoreSheetCell.value,
-                    player_id,
-                    score_sheet_index,
-                    self.player_data[player_id][score_sheet_index],
-                ]
-            ],
-            self.game.client_ids,
-        )
+                    [
+                        enums.CommandsToClient.SetScoreSheetCell.value,
+                        player_id,
+                        score_sheet_index,
+                        self.player_data[player_id][score_sheet_index],
+                    ]
+                ],
+                self.game.client_ids,
+            )
 
     def set_chain_size(self, game_board_type_id, chain_size):
         self.chain_size[game_board_type_id] = chain_size
@@ -658,17 +2197,18 @@ class ScoreSheet:
         if new_price != old_price:
             self.price[game_board_type_id] = new_price
 
-        self.game.add_pending_messages(
-            [
+        if not self.game.headless:
+            self.game.add_pending_messages(
                 [
-                    enums.CommandsToClient.SetScoreSheetCell.value,
-                    enums.ScoreSheetRows.ChainSize.value,
-                    game_board_type_id,
-                    chain_size,
-                ]
-            ],
-            self.game.client_ids,
-        )
+                    [
+                        enums.CommandsToClient.SetScoreSheetCell.value,
+                        enums.ScoreSheetRows.ChainSize.value,
+                        game_board_type_id,
+                        chain_size,
+                    ]
+                ],
+                self.game.client_ids,
+            )
 
     def get_bonuses(self, game_board_type_id):
         price = self.price[game_board_type_id]
@@ -723,14 +2263,7 @@ class ScoreSheet:
             if price:
                 for player_id, player_datum in enumerate(self.player_data):
                     net_worths[player_id] += player_datum[game_board_type_id] * price
-                if (
-                    len(
-                        self.game.game_board.board_type_to_coordinates[
-                            game_board_type_id
-                        ]
-                    )
-                    > 0
-                ):
+                if self.game.game_board.get_chain_size(game_board_type_id) > 0:
                     for player_ids, bonus in self.get_bonuses(game_board_type_id):
                         for player_id in player_ids:
                             net_worths[player_id] += bonus
@@ -745,10 +2278,50 @@ class TileRacks:
         self.racks = []
         for player_id in range(self.game.num_players):
             self.racks.append([None, None, None, None, None, None])
+        self.index_racks()
+        for player_id in range(self.game.num_players):
             self.draw_tile(player_id)
 
+    def index_racks(self):
+        # determine_tile_game_board_types only recomputes the tiles next to cells changed on
+        # the game board, and whole racks when the chain size thresholds change. this
+        # (re)builds its bookkeeping, after which every tile gets recomputed.
+        self.tile_to_rack_slot = {}
+        self.dirty_tile_indexes = []
+        self.rack_thresholds = []
+        for player_id, rack in enumerate(self.racks):
+            for tile_index, tile_data in enumerate(rack):
+                if tile_data:
+                    self.tile_to_rack_slot[tile_data[0]] = (player_id, tile_index)
+            self.dirty_tile_indexes.append(set(range(len(rack))))
+            self.rack_thresholds.append(None)
+
+    def snapshot(self):
+        return (
+            tuple(
+                tuple(tile_data and tuple(tile_data) for tile_data in rack)
+                for rack in self.racks
+            ),
+            tuple(self.tile_to_rack_slot.items()),
+            tuple(frozenset(x) for x in self.dirty_tile_indexes),
+            tuple(self.rack_thresholds),
+        )
+
+    def restore(self, snapshot):
+        racks, tile_to_rack_slot, dirty_tile_indexes, rack_thresholds = snapshot
+        self.racks = [
+            [tile_data and list(tile_data) for tile_data in rack] for rack in racks
+        ]
+        self.tile_to_rack_slot = dict(tile_to_rack_slot)
+        self.dirty_tile_indexes = [set(x) for x in dirty_tile_indexes]
+        self.rack_thresholds = list(rack_thresholds)
+
     def remove_tile(self, player_id, tile_index):
+        tile_data = self.racks[player_id][tile_index]
+        if tile_data:
+            del self.tile_to_rack_slot[tile_data[0]]
         self.racks[player_id][tile_index] = None
+        self.dirty_tile_indexes[player_id].add(tile_index)
 
     def draw_tile(self, player_id):
         rack = self.racks[player_id]
@@ -757,17 +2330,26 @@ class TileRacks:
             if not tile_data:
                 len_tile_bag = len(self.game.tile_bag)
                 if len_tile_bag:
-                    rack[tile_index] = [
-                        self.game.tile_bag.pop(),
-                        None,
-                        len_tile_bag == 1,
-                    ]
+                    tile = self.game.tile_bag.pop()
+                    rack[tile_index] = [tile, None, len_tile_bag == 1]
+                    self.tile_to_rack_slot[tile] = (player_id, tile_index)
+                    self.dirty_tile_indexes[player_id].add(tile_index)
+
+    def _mark_changed_cells(self):
+        game_board = self.game.game_board
+        if game_board.changed_cells_mask:
+            border_mask = get_bitboard_neighbors(game_board.changed_cells_mask)
+            game_board.changed_cells_mask = 0
+            for (x, y), (player_id, tile_index) in self.tile_to_rack_slot.items():
+                if border_mask >> (x * 9 + y) & 1:
+                    self.dirty_tile_indexes[player_id].add(tile_index)
 
     def determine_tile_game_board_types(self, player_ids=None):
-        chain_sizes = [
-            len(self.game.game_board.board_type_to_coordinates[t]) for t in range(7)
-        ]
+        self._mark_changed_cells()
+
+        chain_sizes = [self.game.game_board.get_chain_size(t) for t in range(7)]
         can_start_new_chain = 0 in chain_sizes
+        thresholds = (can_start_new_chain, [size >= 11 for size in chain_sizes])
         x_to_y_to_board_type = self.game.game_board.x_to_y_to_board_type
 
         if player_ids is None:
@@ -775,69 +2357,86 @@ class TileRacks:
 
         for player_id in player_ids:
             rack = self.racks[player_id]
+            dirty_tile_indexes = self.dirty_tile_indexes[player_id]
+            if thresholds != self.rack_thresholds[player_id]:
+                self.rack_thresholds[player_id] = thresholds
+                dirty_tile_indexes.update(range(len(rack)))
+            if not dirty_tile_indexes:
+                continue
 
             old_types = [t[1] if t else None for t in rack]
-            new_types = []
+            new_types = list(old_types)
             lonely_tile_indexes = []
             lonely_tile_border_tiles = set()
             drew_last_tile = False
             for tile_index, tile_data in enumerate(rack):
-                if tile_data:
-                    x, y = tile_data[0]
-                    if tile_data[2] is True:
-                        drew_last_tile = True
-                        tile_data[2] = False
-
-                    border_tiles = set()
-                    if x:
-                        border_tiles.add((x - 1, y))
-                    if x < 11:
-                        border_tiles.add((x + 1, y))
-                    if y:
-                        border_tiles.add((x, y - 1))
-                    if y < 8:
-                        border_tiles.add((x, y + 1))
-
-                    border_types = {x_to_y_to_board_type[x][y] for x, y in border_tiles}
-                    border_types.discard(enums.GameBoardTypes.Nothing.value)
-                    border_types.discard(enums.GameBoardTypes.CantPlayEver.value)
-                    if len(border_types) > 1:
-                        border_types.discard(enums.GameBoardTypes.NothingYet.value)
-
-                    len_border_types = len(border_types)
-                    new_type = enums.GameBoardTypes.WillPutLonelyTileDown.value
-                    if len_border_types == 0:
+                if not tile_data:
+                    continue
+
+                border_tiles = coordinates_to_neighbors[tile_data[0]]
+                if tile_index not in dirty_tile_indexes:
+                    if (
+                        old_types[tile_index]
+                        == enums.GameBoardTypes.WillPutLonelyTileDown.value
+                        or old_types[tile_index]
+                        == enums.GameBoardTypes.HaveNeighboringTileToo.value
+                    ):
                         lonely_tile_indexes.append(tile_index)
-                        lonely_tile_border_tiles |= border_tiles
-                    elif len_border_types == 1:
-                        if enums.GameBoardTypes.NothingYet.value in border_types:
-                            if can_start_new_chain:
-                                new_type = enums.GameBoardTypes.WillFormNewChain.value
-                            else:
-                                new_type = enums.GameBoardTypes.CantPlayNow.value
-                        else:
-                            new_type = border_types.pop()
-                    elif len_border_types > 1:
-                        safe_count = 0
-                        for border_type in border_types:
-                            if chain_sizes[border_type] >= 11:
-                                safe_count += 1
-                        if safe_count < 2:
-                            new_type = enums.GameBoardTypes.WillMergeChains.value
-                            tile_data[2] = border_types
+                        lonely_tile_border_tiles.update(border_tiles)
+                    continue
+
+                if tile_data[2] is True:
+                    drew_last_tile = True
+                    tile_data[2] = False
+
+                border_types = {x_to_y_to_board_type[x][y] for x, y in border_tiles}
+                border_types.discard(enums.GameBoardTypes.Nothing.value)
+                border_types.discard(enums.GameBoardTypes.CantPlayEver.value)
+                if len(border_types) > 1:
+                    border_types.discard(enums.GameBoardTypes.NothingYet.value)
+
+                len_border_types = len(border_types)
+                new_type = enums.GameBoardTypes.WillPutLonelyTileDown.value
+                if len_border_types == 0:
+                    lonely_tile_indexes.append(tile_index)
+                    lonely_tile_border_tiles.update(border_tiles)
+                elif len_border_types == 1:
+                    if enums.GameBoardTypes.NothingYet.value in border_types:
+                        if can_start_new_chain:
+                            new_type = enums.GameBoardTypes.WillFormNewChain.value
                         else:
-                            new_type = enums.GameBoardTypes.CantPlayEver.value
-                else:
-                    new_type = None
+                            new_type = enums.GameBoardTypes.CantPlayNow.value
+                    else:
+                        new_type = border_types.pop()
+                elif len_border_types > 1:
+                    safe_count = 0
+                    for border_type in border_types:
+                        if chain_sizes[border_type] >= 11:
+                            safe_count += 1
+                    if safe_count < 2:
+                        new_type = enums.GameBoardTypes.WillMergeChains.value
+                        tile_data[2] = border_types
+                    else:
+                        new_type = enums.GameBoardTypes.CantPlayEver.value
+
+                new_types[tile_index] = new_type
 
-                new_types.append(new_type)
+            dirty_tile_indexes.clear()
 
-            if can_start_new_chain:
-                for tile_index in lonely_tile_indexes:
-                    if rack[tile_index][0] in lonely_tile_border_tiles:
-                        new_types[
-                            tile_index
-                        ] = enums.GameBoardTypes.HaveNeighboringTileToo.value
+            # whether a lonely tile has a neighbor depends on the other tiles in the rack, so
+            # lonely tiles are always redone
+            for tile_index in lonely_tile_indexes:
+                if (
+                    can_start_new_chain
+                    and rack[tile_index][0] in lonely_tile_border_tiles
+                ):
+                    new_types[
+                        tile_index
+                    ] = enums.GameBoardTypes.HaveNeighboringTileToo.value
+                else:
+                    new_types[
+                        tile_index
+                    ] = enums.GameBoardTypes.WillPutLonelyTileDown.value
 
             for tile_index, tile_data in enumerate(rack):
                 if tile_data:
@@ -846,7 +2445,9 @@ class TileRacks:
             client = self.game.score_sheet.player_data[player_id][
                 enums.ScoreSheetIndexes.Client.value
             ]
-            client_ids = {client.client_id} if client else None
+            client_ids = (
+                {client.client_id} if client and not self.game.headless else None
+            )
 
             for tile_index, old_type in enumerate(old_types):
                 new_type = new_types[tile_index]
@@ -902,11 +2503,11 @@ class TileRacks:
                     and tile_data[1] == enums.GameBoardTypes.CantPlayEver.value
                 ):
                     # remove tile from player's tile rack
-                    rack[tile_index] = None
+                    self.remove_tile(player_id, tile_index)
                     client = self.game.score_sheet.player_data[player_id][
                         enums.ScoreSheetIndexes.Client.value
                     ]
-                    if client:
+                    if client and not self.game.headless:
                         self.game.add_pending_messages(
                             [[enums.CommandsToClient.RemoveTile.value, tile_index]],
                             {client.client_id},
@@ -954,24 +2555,38 @@ class Action:
     def prepare(self):
         pass
 
+    def get_legal_parameters(self):
+        # every list of parameters that execute accepts
+        return []
+
+    def copy(self, game):
+        # actions change some of their attributes in place, so subclasses copy those too
+        action = self.__class__.__new__(self.__class__)
+        action.__dict__.update(self.__dict__)
+        action.game = game
+        action.additional_params = list(self.additional_params)
+        return action
+
+    def get_message(self):
+        return [
+            enums.CommandsToClient.SetGameAction.value,
+            self.game_action_id,
+            self.player_id,
+        ] + self.additional_params
+
     def send_message(self, client_ids):
-        self.game.add_pending_messages(
-            [
-                [
-                    enums.CommandsToClient.SetGameAction.value,
-                    self.game_action_id,
-                    self.player_id,
-                ]
-                + self.additional_params
-            ],
-            client_ids,
-        )
+        if self.game.headless:
+            return
+        self.game.add_pending_messages([self.get_message()], client_ids)
 
 
 class ActionStartGame(Action):
     def __init__(self, game, player_id):
         super().__init__(game, player_id, enums.GameActions.StartGame.value)
 
+    def get_legal_parameters(self):
+        return [[]]
+
     def execute(self):
         self.game.add_history_message(
             enums.GameHistoryMessages.StartedGame.value, self.player_id
@@ -984,12 +2599,27 @@ class ActionStartGame(Action):
         else:
             self.game.set_state(enums.GameStates.InProgress.value)
 
-        self.game.tile_racks = TileRacks(self.game)
+        self.game.tile_racks = self.game.tile_racks_class(self.game)
         self.game.tile_racks.determine_tile_game_board_types()
 
         return [ActionPlayTile(self.game, 0), ActionPurchaseShares(self.game, 0)]
 
 
+playable_tile_game_board_type_ids = {
+    enums.GameBoardTypes.Luxor.value,
+    enums.GameBoardTypes.Tower.value,
+    enums.GameBoardTypes.American.value,
+    enums.GameBoardTypes.Festival.value,
+    enums.GameBoardTypes.Worldwide.value,
+    enums.GameBoardTypes.Continental.value,
+    enums.GameBoardTypes.Imperial.value,
+    enums.GameBoardTypes.WillPutLonelyTileDown.value,
+    enums.GameBoardTypes.HaveNeighboringTileToo.value,
+    enums.GameBoardTypes.WillFormNewChain.value,
+    enums.GameBoardTypes.WillMergeChains.value,
+}
+
+
 class ActionPlayTile(Action):
     def __init__(self, game, player_id):
         super().__init__(game, player_id, enums.GameActions.PlayTile.value)
@@ -997,10 +2627,11 @@ class ActionPlayTile(Action):
     def prepare(self):
         self.game.turn_player_id = self.player_id
 
-        self.game.add_pending_messages(
-            [[enums.CommandsToClient.SetTurn.value, self.player_id]],
-            self.game.client_ids,
-        )
+        if not self.game.headless:
+            self.game.add_pending_messages(
+                [[enums.CommandsToClient.SetTurn.value, self.player_id]],
+                self.game.client_ids,
+            )
         self.game.add_history_message(
             enums.GameHistoryMessages.TurnBegan.value, self.player_id
         )
@@ -1024,6 +2655,15 @@ class ActionPlayTile(Action):
             )
             return True
 
+    def get_legal_parameters(self):
+        return [
+            [tile_index]
+            for tile_index, tile_data in enumerate(
+                self.game.tile_racks.racks[self.player_id]
+            )
+            if tile_data and tile_data[1] in playable_tile_game_board_type_ids
+        ]
+
     def execute(self, tile_index):
         if not isinstance(tile_index, int):
             return
@@ -1041,7 +2681,7 @@ class ActionPlayTile(Action):
             self.game.game_board.fill_cells(tile, game_board_type_id)
             self.game.score_sheet.set_chain_size(
                 game_board_type_id,
-                len(self.game.game_board.board_type_to_coordinates[game_board_type_id]),
+                self.game.game_board.get_chain_size(game_board_type_id),
             )
         elif (
             game_board_type_id == enums.GameBoardTypes.WillPutLonelyTileDown.value
@@ -1093,6 +2733,9 @@ class ActionSelectNewChain(Action):
             )
             self.game.tile_racks.determine_tile_game_board_types()
 
+    def get_legal_parameters(self):
+        return [[x] for x in self.game_board_type_ids]
+
     def execute(self, game_board_type_id):
         if game_board_type_id in self.game_board_type_ids:
             return self._create_new_chain(game_board_type_id)
@@ -1101,7 +2744,7 @@ class ActionSelectNewChain(Action):
         self.game.game_board.fill_cells(self.tile, game_board_type_id)
         self.game.score_sheet.set_chain_size(
             game_board_type_id,
-            len(self.game.game_board.board_type_to_coordinates[game_board_type_id]),
+            self.game.game_board.get_chain_size(game_board_type_id),
         )
         if self.game.score_sheet.available[game_board_type_id]:
             self.game.score_sheet.adjust_player_data(
@@ -1132,6 +2775,11 @@ class ActionSelectMergerSurvivor(Action):
             x[1] for x in sorted(chain_size_to_type_ids.items(), reverse=True)
         ]
 
+    def copy(self, game):
+        action = super().copy(game)
+        action.type_id_sets = [set(x) for x in self.type_id_sets]
+        return action
+
     def prepare(self):
         self.game.add_history_message(
             enums.GameHistoryMessages.MergedChains.value,
@@ -1149,6 +2797,9 @@ class ActionSelectMergerSurvivor(Action):
             self.game.tile_racks.determine_tile_game_board_types()
             self.additional_params.append(sorted(largest_type_ids))
 
+    def get_legal_parameters(self):
+        return [[x] for x in sorted(self.type_id_sets[0])]
+
     def execute(self, type_id):
         if type_id in self.type_id_sets[0]:
             self.game.add_history_message(
@@ -1165,7 +2816,7 @@ class ActionSelectMergerSurvivor(Action):
         self.game.game_board.fill_cells(self.tile, controlling_type_id)
         self.game.score_sheet.set_chain_size(
             controlling_type_id,
-            len(self.game.game_board.board_type_to_coordinates[controlling_type_id]),
+            self.game.game_board.get_chain_size(controlling_type_id),
         )
         self.game.tile_racks.determine_tile_game_board_types()
 
@@ -1210,12 +2861,20 @@ class ActionSelectChainToDisposeOfNext(Action):
         self.defunct_type_ids = defunct_type_ids
         self.controlling_type_id = controlling_type_id
 
+    def copy(self, game):
+        action = super().copy(game)
+        action.defunct_type_ids = set(self.defunct_type_ids)
+        return action
+
     def prepare(self):
         if len(self.defunct_type_ids) == 1:
             return self._prepare_next_actions(self.defunct_type_ids.pop())
         else:
             self.additional_params.append(sorted(self.defunct_type_ids))
 
+    def get_legal_parameters(self):
+        return [[x] for x in sorted(self.defunct_type_ids)]
+
     def execute(self, type_id):
         if type_id in self.defunct_type_ids:
             self.game.add_history_message(
@@ -1271,6 +2930,16 @@ class ActionDisposeOfShares(Action):
             self.controlling_type_id
         ]
 
+    def get_legal_parameters(self):
+        parameters = []
+        max_trade_amount = min(
+            self.defunct_type_count, self.controlling_type_available * 2
+        )
+        for trade_amount in range(0, max_trade_amount + 1, 2):
+            for sell_amount in range(self.defunct_type_count - trade_amount + 1):
+                parameters.append([trade_amount, sell_amount])
+        return parameters
+
     def execute(self, trade_amount, sell_amount):
         if (
             not isinstance(trade_amount, int)
@@ -1311,6 +2980,28 @@ class ActionDisposeOfShares(Action):
         return True
 
 
+# every purchase of up to 3 shares, as sorted game board type ids -> ((game board type id,
+# count), ...) in game board type id order
+share_purchase_type_ids_to_counts = {}
+for num_shares in range(4):
+    for game_board_type_ids in itertools.combinations_with_replacement(
+        range(7), num_shares
+    ):
+        share_purchase_type_ids_to_counts[game_board_type_ids] = tuple(
+            (game_board_type_id, game_board_type_ids.count(game_board_type_id))
+            for game_board_type_id in sorted(set(game_board_type_ids))
+        )
+
+# for each set of game board type ids as a bitmask, the purchases of only those types
+share_purchases_by_type_ids_mask = [[] for mask in range(1 << 7)]
+for mask in range(1 << 7):
+    for game_board_type_ids, counts in share_purchase_type_ids_to_counts.items():
+        if all(
+            mask & 1 << game_board_type_id for game_board_type_id in game_board_type_ids
+        ):
+            share_purchases_by_type_ids_mask[mask].append((game_board_type_ids, counts))
+
+
 class ActionPurchaseShares(Action):
     def __init__(self, game, player_id):
         super().__init__(game, player_id, enums.GameActions.PurchaseShares.value)
@@ -1320,10 +3011,7 @@ class ActionPurchaseShares(Action):
 
     def prepare(self):
         for type_id, chain_size in enumerate(self.game.score_sheet.chain_size):
-            if (
-                chain_size
-                and not self.game.game_board.board_type_to_coordinates[type_id]
-            ):
+            if chain_size and not self.game.game_board.get_chain_size(type_id):
                 self.game.score_sheet.set_chain_size(type_id, 0)
 
         self.game.tile_racks.determine_tile_game_board_types()
@@ -1358,20 +3046,58 @@ class ActionPurchaseShares(Action):
                 )
             return self._complete_action()
 
+    def get_legal_parameters(self):
+        score_sheet = self.game.score_sheet
+        chain_size = score_sheet.chain_size
+        available = score_sheet.available
+        price = score_sheet.price
+        cash = score_sheet.player_data[self.player_id][
+            enums.ScoreSheetIndexes.Cash.value
+        ]
+        end_game_values = [0, 1] if self.can_end_game else [0]
+
+        # the types of which at least one share can be bought
+        mask = 0
+        for game_board_type_id in range(7):
+            if (
+                chain_size[game_board_type_id]
+                and available[game_board_type_id]
+                and price[game_board_type_id] <= cash
+            ):
+                mask |= 1 << game_board_type_id
+
+        parameters = []
+        for (
+            game_board_type_ids,
+            game_board_type_id_counts,
+        ) in share_purchases_by_type_ids_mask[mask]:
+            cost = 0
+            for game_board_type_id, count in game_board_type_id_counts:
+                if count > available[game_board_type_id]:
+                    break
+                cost += price[game_board_type_id] * count
+            else:
+                if cost <= cash:
+                    for end_game in end_game_values:
+                        parameters.append([list(game_board_type_ids), end_game])
+        return parameters
+
     def execute(self, game_board_type_ids, end_game):
         if end_game != 0 and end_game != 1:
             return
         if not isinstance(game_board_type_ids, list) or len(game_board_type_ids) > 3:
             return
-        game_board_type_id_to_count = collections.defaultdict(int)
         for game_board_type_id in game_board_type_ids:
-            if isinstance(game_board_type_id, int) and 0 <= game_board_type_id < 7:
-                game_board_type_id_to_count[game_board_type_id] += 1
-            else:
+            if not isinstance(game_board_type_id, int) or not (
+                0 <= game_board_type_id < 7
+            ):
                 return
+        game_board_type_id_counts = share_purchase_type_ids_to_counts[
+            tuple(sorted(game_board_type_ids))
+        ]
 
         cost = 0
-        for game_board_type_id, count in game_board_type_id_to_count.items():
+        for game_board_type_id, count in game_board_type_id_counts:
             if (
                 self.game.score_sheet.chain_size[game_board_type_id]
                 and count <= self.game.score_sheet.available[game_board_type_id]
@@ -1388,7 +3114,7 @@ class ActionPurchaseShares(Action):
             return
 
         if cost:
-            for game_board_type_id, count in game_board_type_id_to_count.items():
+            for game_board_type_id, count in game_board_type_id_counts:
                 self.game.score_sheet.adjust_player_data(
                     self.player_id, game_board_type_id, count
                 )
@@ -1404,7 +3130,7 @@ class ActionPurchaseShares(Action):
             self.game.add_history_message(
                 enums.GameHistoryMessages.PurchasedShares.value,
                 self.player_id,
-                sorted(list(x) for x in game_board_type_id_to_count.items()),
+                [list(x) for x in game_board_type_id_counts],
             )
 
         if end_game and self.can_end_game:
@@ -1456,13 +3182,63 @@ class ActionGameOver(Action):
     def __init__(self, game, player_id):
         super().__init__(game, player_id, enums.GameActions.GameOver.value)
         game.turn_player_id = None
-        game.add_pending_messages(
-            [[enums.CommandsToClient.SetTurn.value, None]], game.client_ids
-        )
+        if not game.headless:
+            game.add_pending_messages(
+                [[enums.CommandsToClient.SetTurn.value, None]], game.client_ids
+            )
         game.set_state(enums.GameStates.Completed.value)
 
 
+# the state of a game without its clients. the parts are tuples and frozensets, or objects
+# that Game.restore copies, so a snapshot is never changed and can be restored many times.
+GameSnapshot = collections.namedtuple(
+    "GameSnapshot",
+    [
+        "state",
+        "mode",
+        "max_players",
+        "num_players",
+        "tile_bag",
+        "turn_player_id",
+        "turns_without_played_tiles_count",
+        "history_messages",
+        "game_board",
+        "score_sheet",
+        "tile_racks",
+        "actions",
+    ],
+)
+
+
+# the state of a game without its clients as plain data, for storing across restarts.
+# unlike a snapshot, it does not depend on the game board and tile racks classes. actions
+# are (class name, attributes without game) pairs.
+GameCheckpoint = collections.namedtuple(
+    "GameCheckpoint",
+    [
+        "game_id",
+        "internal_game_id",
+        "state",
+        "mode",
+        "max_players",
+        "num_players",
+        "tile_bag",
+        "turn_player_id",
+        "turns_without_played_tiles_count",
+        "history_messages",
+        "game_board",
+        "score_sheet",
+        "tile_racks",
+        "actions",
+        "log_data_overrides",
+    ],
+)
+
+
 class Game:
+    game_board_class = UnionFindGameBoard
+    tile_racks_class = TileRacks
+
     def __init__(
         self,
         game_id,
@@ -1472,19 +3248,29 @@ class Game:
         add_pending_messages,
         logging_enabled=True,
         tile_bag=None,
+        lobby_client_ids=None,
+        headless=False,
+        add_pending_batch=None,
     ):
         self.game_id = game_id
         self.internal_game_id = internal_game_id
         self.state = enums.GameStates.Starting.value
         self.mode = mode
         self.max_players = max_players if mode == enums.GameModes.Singles.value else 4
+        # a headless game skips building the messages for clients, for replaying and
+        # simulating games. add_pending_messages then only gets the odd lobby message.
+        self.headless = headless
         self.add_pending_messages = add_pending_messages
+        if add_pending_batch is None:
+            add_pending_batch = self._add_pending_batch_as_messages
+        self.add_pending_batch = add_pending_batch
+        self.lobby_client_ids = lobby_client_ids
         self.logging_enabled = logging_enabled
         self.num_players = 0
         self.client_ids = set()
         self.watcher_client_ids = set()
 
-        self.game_board = GameBoard(self)
+        self.game_board = self.game_board_class(self)
         self.score_sheet = ScoreSheet(self)
         if tile_bag is None:
             tiles = [(x, y) for x in range(12) for y in range(9)]
@@ -1498,23 +3284,160 @@ class Game:
         self.turn_player_id = None
         self.turns_without_played_tiles_count = 0
         self.history_messages = []
+        # history player id (None: messages for everybody) -> [comma separated encoded
+        # history messages for that player, number of history messages looked at]
+        self.history_player_id_to_json = {}
         self.expiration_time = None
 
+        # incremented whenever the board, score sheet, turn or action may have changed
+        self.state_version = 0
+        # the encoded messages of _send_initialization_messages that are the same for all
+        # clients, and the state_version they are for
+        self.initialization_json = None
+        self.initialization_json_state_version = None
+
         self.log_data_overrides = {}
 
         self.set_state(self.state, self.mode, self.max_players)
 
+    def snapshot(self):
+        return GameSnapshot(
+            self.state,
+            self.mode,
+            self.max_players,
+            self.num_players,
+            tuple(self.tile_bag),
+            self.turn_player_id,
+            self.turns_without_played_tiles_count,
+            tuple(self.history_messages),
+            self.game_board.snapshot(),
+            self.score_sheet.snapshot(),
+            self.tile_racks.snapshot() if self.tile_racks else None,
+            tuple(action.copy(self) for action in self.actions),
+        )
+
+    def restore(self, snapshot):
+        # puts the game back in the state of a snapshot from this game or one of its
+        # restored copies. nothing is sent to clients, and nothing is logged.
+        self.state = snapshot.state
+        self.mode = snapshot.mode
+        self.max_players = snapshot.max_players
+        self.num_players = snapshot.num_players
+        self.tile_bag = list(snapshot.tile_bag)
+        self.turn_player_id = snapshot.turn_player_id
+        self.turns_without_played_tiles_count = (
+            snapshot.turns_without_played_tiles_count
+        )
+        self.history_messages = list(snapshot.history_messages)
+        self.history_player_id_to_json.clear()
+        self.game_board.restore(snapshot.game_board)
+        self.score_sheet.restore(snapshot.score_sheet)
+        if snapshot.tile_racks is None:
+            self.tile_racks = None
+        else:
+            if not self.tile_racks:
+                self.tile_racks = self.tile_racks_class.__new__(self.tile_racks_class)
+                self.tile_racks.game = self
+            self.tile_racks.restore(snapshot.tile_racks)
+        self.actions = [action.copy(self) for action in snapshot.actions]
+        self.state_version += 1
+
+    def get_checkpoint(self):
+        # the parts are not copied, so the checkpoint is to be stored right away
+        return GameCheckpoint(
+            self.game_id,
+            self.internal_game_id,
+            self.state,
+            self.mode,
+            self.max_players,
+            self.num_players,
+            self.tile_bag,
+            self.turn_player_id,
+            self.turns_without_played_tiles_count,
+            self.history_messages,
+            self.game_board.x_to_y_to_board_type,
+            self.score_sheet.snapshot(),
+            self.tile_racks.racks if self.tile_racks else None,
+            [
+                (
+                    action.__class__.__name__,
+                    {x: y for x, y in action.__dict__.items() if x != "game"},
+                )
+                for action in self.actions
+            ],
+            self.log_data_overrides,
+        )
+
+    def restore_checkpoint(self, game_checkpoint):
+        # for a new game with the ids of the checkpoint. the checkpoint's parts are used,
+        # not copied. nothing is sent to clients, and nothing is logged.
+        self.state = game_checkpoint.state
+        self.mode = game_checkpoint.mode
+        self.max_players = game_checkpoint.max_players
+        self.num_players = game_checkpoint.num_players
+        self.tile_bag = game_checkpoint.tile_bag
+        self.turn_player_id = game_checkpoint.turn_player_id
+        self.turns_without_played_tiles_count = (
+            game_checkpoint.turns_without_played_tiles_count
+        )
+        self.history_messages = game_checkpoint.history_messages
+        self.history_player_id_to_json.clear()
+        self.game_board = self.game_board_class(self, game_checkpoint.game_board)
+        self.score_sheet.restore(game_checkpoint.score_sheet)
+        if game_checkpoint.tile_racks is None:
+            self.tile_racks = None
+        else:
+            self.tile_racks = self.tile_racks_class.__new__(self.tile_racks_class)
+            self.tile_racks.game = self
+            self.tile_racks.racks = game_checkpoint.tile_racks
+            self.tile_racks.index_racks()
+        self.actions = []
+        for name, attributes in game_checkpoint.actions:
+            cls = globals()[name]
+            action = cls.__new__(cls)
+            action.__dict__.update(attributes)
+            action.game = self
+            self.actions.append(action)
+        self.log_data_overrides = game_checkpoint.log_data_overrides
+        self.state_version += 1
+
+    def get_lobby_players(self):
+        # [username, client id or None] of each player
+        return [
+            [
+                player_datum[enums.ScoreSheetIndexes.Username.value],
+                player_datum[enums.ScoreSheetIndexes.Client.value].client_id
+                if player_datum[enums.ScoreSheetIndexes.Client.value]
+                else None,
+            ]
+            for player_datum in self.score_sheet.player_data
+        ]
+
+    def legal_actions(self, player_id):
+        # the [game action id, parameter, ...] lists that do_game_action accepts from the
+        # player, in the format of logged game actions
+        action = self.actions[-1]
+        if player_id is None or player_id != action.player_id:
+            return []
+        return [
+            [action.game_action_id] + parameters
+            for parameters in action.get_legal_parameters()
+        ]
+
     def join_game(self, client):
         if (
             self.state == enums.GameStates.Starting.value
             and not self.score_sheet.is_username_in_game(client.username)
         ):
             self.num_players += 1
+            self.state_version += 1
             client.game_id = self.game_id
             self.client_ids.add(client.client_id)
             position_tile = self.tile_bag.pop()
             previous_creator_player_id = self.score_sheet.get_creator_player_id()
             self.score_sheet.join_game(client, position_tile)
+            # player ids were reassigned
+            self.history_player_id_to_json.clear()
             self._send_past_history_messages(client)
             self.game_board.set_cell(
                 position_tile, enums.GameBoardTypes.NothingYet.value
@@ -1550,7 +3473,7 @@ class Game:
             client.game_id = self.game_id
             self.client_ids.add(client.client_id)
             self.watcher_client_ids.add(client.client_id)
-            self.add_pending_messages(
+            self.add_pending_lobby_messages(
                 [
                     [
                         enums.CommandsToClient.SetGameWatcherClientId.value,
@@ -1569,7 +3492,7 @@ class Game:
             self.client_ids.discard(client.client_id)
             if client.client_id in self.watcher_client_ids:
                 self.watcher_client_ids.discard(client.client_id)
-                self.add_pending_messages(
+                self.add_pending_lobby_messages(
                     [
                         [
                             enums.CommandsToClient.ReturnWatcherToLobby.value,
@@ -1591,6 +3514,25 @@ class Game:
             and game_action_id == action.game_action_id
         ):
             new_actions = action.execute(*data)
+            completed = bool(new_actions)
+            # invalid actions return before changing anything
+            if completed:
+                self.state_version += 1
+            # only valid actions are recorded, so this follows any records the action caused
+            if completed and self.logging_enabled and event_log_writer.file:
+                log = collections.OrderedDict()
+                log["_"] = "game-action"
+                log["game-id"] = self.internal_game_id
+                log["external-game-id"] = self.game_id
+                log["player-id"] = action.player_id
+                log["game-action-id"] = game_action_id
+                log["data"] = data
+                event_log_writer.write(
+                    event_log.EventTypes.GameAction,
+                    time.time(),
+                    self.internal_game_id,
+                    log,
+                )
             while new_actions:
                 self.actions.pop()
                 if isinstance(new_actions, list):
@@ -1599,6 +3541,8 @@ class Game:
                 action = self.actions[-1]
                 new_actions = action.prepare()
             action.send_message(self.client_ids)
+            return completed
+        return False
 
     def set_state(self, state, mode=None, max_players=None):
         log = collections.OrderedDict()
@@ -1645,16 +3589,29 @@ class Game:
             message.append(self.max_players)
         if score:
             message.append(score)
-        self.add_pending_messages([message])
+        self.add_pending_lobby_messages([message])
 
         if self.logging_enabled:
-            print(json.dumps(log, separators=(",", ":")))
+            log_writer.log("game", json.dumps(log, separators=(",", ":")))
+            event_log_writer.write(
+                event_log.EventTypes.Game, time.time(), self.internal_game_id, log
+            )
+
+    def add_pending_lobby_messages(self, messages):
+        # changes shown in the lobby go to the lobby and to the game's clients
+        if self.lobby_client_ids is None:
+            self.add_pending_messages(messages)
+        else:
+            self.add_pending_messages(messages, self.lobby_client_ids, self.client_ids)
 
     def add_history_message(self, *data, player_id=None):
         data = list(data)
 
         self.history_messages.append([player_id, data])
 
+        if self.headless:
+            return
+
         if player_id is None:
             client_ids = self.client_ids
         else:
@@ -1673,40 +3630,88 @@ class Game:
                 message[2] = self.score_sheet.username_to_player_id[message[2]]
             self.add_pending_messages([message], client_ids)
 
+    def _add_pending_batch_as_messages(self, batch_json, client_ids=None):
+        # for add_pending_messages functions without a matching add_pending_batch
+        self.add_pending_messages(ujson.decode("[" + batch_json + "]"), client_ids)
+
+    def _get_past_history_messages_json(self, player_id):
+        # the history messages for player_id are encoded once, and the encoded ones are
+        # extended with the history messages added since the last time
+        json_and_length = self.history_player_id_to_json.get(player_id)
+        if json_and_length is None:
+            json_and_length = ["", 0]
+            self.history_player_id_to_json[player_id] = json_and_length
+        history_messages_json, length = json_and_length
+
+        if length < len(self.history_messages):
+            encoded_messages = [history_messages_json] if history_messages_json else []
+            for target_player_id, message in itertools.islice(
+                self.history_messages, length, None
+            ):
+                if target_player_id is None or target_player_id == player_id:
+                    if isinstance(message[1], str):
+                        message = list(message)
+                        message[1] = self.score_sheet.username_to_player_id[message[1]]
+                    encoded_messages.append(ujson.dumps(message))
+            json_and_length[0] = ",".join(encoded_messages)
+            json_and_length[1] = len(self.history_messages)
+
+        return json_and_length[0]
+
     def _send_past_history_messages(self, client):
-        player_id = client.player_id
-        messages = []
-        for target_player_id, message in self.history_messages:
-            if target_player_id is None or target_player_id == player_id:
-                if isinstance(message[1], str):
-                    message = list(message)
-                    message[1] = self.score_sheet.username_to_player_id[message[1]]
-                messages.append(message)
-
-        if messages:
-            self.add_pending_messages(
-                [[enums.CommandsToClient.AddGameHistoryMessages.value, messages]],
+        if self.headless:
+            return
+
+        history_messages_json = self._get_past_history_messages_json(client.player_id)
+        if history_messages_json:
+            self.add_pending_batch(
+                "[%d,[%s]]"
+                % (
+                    enums.CommandsToClient.AddGameHistoryMessages.value,
+                    history_messages_json,
+                ),
                 {client.client_id},
             )
 
-    def _send_initialization_messages(self, client):
-        # game board
-        messages = [
-            [
-                enums.CommandsToClient.SetGameBoard.value,
-                self.game_board.x_to_y_to_board_type,
+    def _get_initialization_json(self):
+        # the encoded messages before and after the player's tiles
+        if self.initialization_json_state_version != self.state_version:
+            score_sheet_data = [
+                [
+                    x[: enums.ScoreSheetIndexes.Cash.value + 1]
+                    for x in self.score_sheet.player_data
+                ],
+                self.score_sheet.chain_size,
             ]
-        ]
+            before_tiles = [
+                # game board
+                [
+                    enums.CommandsToClient.SetGameBoard.value,
+                    self.game_board.x_to_y_to_board_type,
+                ],
+                # score sheet
+                [enums.CommandsToClient.SetScoreSheet.value, score_sheet_data],
+            ]
+            after_tiles = [
+                # turn
+                [enums.CommandsToClient.SetTurn.value, self.turn_player_id],
+                # action
+                self.actions[-1].get_message(),
+            ]
+            self.initialization_json = (
+                ",".join([ujson.dumps(message) for message in before_tiles]),
+                ",".join([ujson.dumps(message) for message in after_tiles]),
+            )
+            self.initialization_json_state_version = self.state_version
 
-        # score sheet
-        score_sheet_data = [
-            [
-                x[: enums.ScoreSheetIndexes.Cash.value + 1]
-                for x in self.score_sheet.player_data
-            ],
-            self.score_sheet.chain_size,
-        ]
-        messages.append([enums.CommandsToClient.SetScoreSheet.value, score_sheet_data])
+        return self.initialization_json
+
+    def _send_initialization_messages(self, client):
+        if self.headless:
+            return
+
+        before_tiles_json, after_tiles_json = self._get_initialization_json()
+        batch_json_parts = [before_tiles_json]
 
         # player's tiles
         if client.player_id is not None and self.tile_racks:
@@ -1715,50 +3720,425 @@ class Game:
             ):
                 if tile_data:
                     x, y = tile_data[0]
-                    messages.append(
-                        [
-                            enums.CommandsToClient.SetTile.value,
-                            tile_index,
-                            x,
-                            y,
-                            tile_data[1],
-                        ]
+                    batch_json_parts.append(
+                        ujson.dumps(
+                            [
+                                enums.CommandsToClient.SetTile.value,
+                                tile_index,
+                                x,
+                                y,
+                                tile_data[1],
+                            ]
+                        )
                     )
 
-        # turn
-        messages.append([enums.CommandsToClient.SetTurn.value, self.turn_player_id])
+        batch_json_parts.append(after_tiles_json)
+        self.add_pending_batch(",".join(batch_json_parts), {client.client_id})
 
-        self.add_pending_messages(messages, {client.client_id})
 
-        # action
-        self.actions[-1].send_message({client.client_id})
+class GameShardClient:
+    # what a game needs of a client, in a game process
+    def __init__(self, client_id, username):
+        self.client_id = client_id
+        self.username = username
+        self.game_id = None
+        self.player_id = None
+
+
+class GameShard:
+    # the games of a game process. handles the requests of GameProxy objects, and returns
+    # the replies that GameProcessProtocol handles.
+    def __init__(self, event_log_filename=None):
+        self.game_id_to_game = {}
+        self.client_id_to_client = {}
+        # stands for Server.lobby_client_ids, which only the lobby knows
+        self.lobby_client_ids = set()
+        self.outgoing = []
+
+        # for run_game_process to log with. the lines go to the lobby.
+        self.log_file = io.StringIO()
+        self.log_writer = LogWriter(self.log_file)
+        self.event_log_writer = event_log.EventLogWriter()
+        if event_log_filename:
+            self.event_log_writer.open(event_log_filename)
+        self.event_log_flush_time = time.time() + 15
+
+        self.key_to_handler = {
+            b"create-game": self._create_game,
+            b"join-game": self._join_game,
+            b"rejoin-game": self._rejoin_game,
+            b"watch-game": self._watch_game,
+            b"leave-game": self._leave_game,
+            b"do-game-action": self._do_game_action,
+            b"expire-game": self._expire_game,
+        }
+
+    def handle_lines(self, lines):
+        key_to_handler = self.key_to_handler
+        for line in lines:
+            key, separator, value = line.partition(b" ")
+            try:
+                key_to_handler[key](*ujson.decode(value))
+            except:
+                # like an exception in the lobby's event loop, it only stops this request
+                traceback.print_exc()
+
+        log_lines = self.log_file.getvalue()
+        if log_lines:
+            self.outgoing.append("log " + ujson.dumps(log_lines) + "\n")
+            self.log_file.seek(0)
+            self.log_file.truncate()
+        if self.event_log_writer.file and time.time() >= self.event_log_flush_time:
+            self.event_log_writer.flush()
+            self.event_log_flush_time = time.time() + 15
+        self.outgoing.append("end %d\n" % len(lines))
+
+        data = "".join(self.outgoing).encode()
+        del self.outgoing[:]
+        return data
+
+    def close(self):
+        self.event_log_writer.close()
+
+    def add_pending_messages(
+        self, game_id, messages, client_ids=None, more_client_ids=None
+    ):
+        self.add_pending_batch(
+            game_id,
+            ",".join([ujson.dumps(message) for message in messages]),
+            client_ids,
+            more_client_ids,
+        )
+
+    def add_pending_batch(
+        self, game_id, batch_json, client_ids=None, more_client_ids=None
+    ):
+        if client_ids is self.lobby_client_ids:
+            keys = ["lobby:%d" % game_id]
+            if more_client_ids:
+                keys.extend([str(x) for x in more_client_ids])
+        else:
+            client_ids = set(client_ids)
+            if more_client_ids:
+                client_ids.update(more_client_ids)
+            if not client_ids:
+                return
+            keys = [str(x) for x in client_ids]
+        self.outgoing.append(",".join(keys) + " [" + batch_json + "]\n")
+
+    def get_game_data(self, game):
+        return [
+            game.game_id,
+            game.internal_game_id,
+            game.state,
+            game.mode,
+            game.max_players,
+            game.get_lobby_players(),
+            list(game.watcher_client_ids),
+            list(game.client_ids),
+            game.expiration_time,
+        ]
+
+    def _add_game_data(self, game):
+        self.outgoing.append("game " + ujson.dumps(self.get_game_data(game)) + "\n")
+
+    def _create_game(self, game_id, internal_game_id, mode, max_players, tile_bag):
+        self.game_id_to_game[game_id] = Game(
+            game_id,
+            internal_game_id,
+            mode,
+            max_players,
+            functools.partial(self.add_pending_messages, game_id),
+            tile_bag=None if tile_bag is None else [tuple(x) for x in tile_bag],
+            lobby_client_ids=self.lobby_client_ids,
+            add_pending_batch=functools.partial(self.add_pending_batch, game_id),
+        )
+
+    def _join_game(self, game_id, client_id, username):
+        self._do_client_request(Game.join_game, game_id, client_id, username)
+
+    def _rejoin_game(self, game_id, client_id, username):
+        self._do_client_request(Game.rejoin_game, game_id, client_id, username)
+
+    def _watch_game(self, game_id, client_id, username):
+        self._do_client_request(Game.watch_game, game_id, client_id, username)
+
+    def _do_client_request(self, method, game_id, client_id, username):
+        game = self.game_id_to_game.get(game_id)
+        client = GameShardClient(client_id, username)
+        if game:
+            method(game, client)
+        if client.game_id is None:
+            self.outgoing.append("not-in-game [%d,%d]\n" % (client_id, game_id))
+        else:
+            self.client_id_to_client[client_id] = client
+        if game:
+            self._add_game_data(game)
+
+    def _leave_game(self, game_id, client_id):
+        game = self.game_id_to_game.get(game_id)
+        client = self.client_id_to_client.pop(client_id, None)
+        if game and client:
+            game.leave_game(client)
+            self._add_game_data(game)
+
+    def _do_game_action(self, game_id, client_id, game_action_id, data):
+        game = self.game_id_to_game.get(game_id)
+        client = self.client_id_to_client.get(client_id)
+        if game and client and client.game_id == game_id:
+            state = game.state
+            game.do_game_action(client, game_action_id, data)
+            if game.state != state:
+                self._add_game_data(game)
+
+    def _expire_game(self, game_id):
+        game = self.game_id_to_game.get(game_id)
+        if game is None:
+            return
+        current_time = time.time()
+        if game.expiration_time is None or game.expiration_time > current_time:
+            # a client came back in the meantime
+            self._add_game_data(game)
+            return
+
+        if self.event_log_writer.file:
+            log = collections.OrderedDict()
+            log["_"] = "game-expired"
+            log["game-id"] = game.internal_game_id
+            log["external-game-id"] = game_id
+            self.event_log_writer.write(
+                event_log.EventTypes.GameExpired,
+                current_time,
+                game.internal_game_id,
+                log,
+            )
+        del self.game_id_to_game[game_id]
+        self.outgoing.append("game [%d,%d]\n" % (game_id, game.internal_game_id))
+
+
+def run_game_process(game_process_socket, event_log_filename=None, lobby_socket=None):
+    # runs until the lobby closes its end of the socket, so this process' copy of the
+    # lobby's end is closed. interrupts are for the lobby.
+    if lobby_socket:
+        lobby_socket.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    game_shard = GameShard(event_log_filename)
+    # the games log with the module's writers
+    global log_writer, event_log_writer
+    log_writer = game_shard.log_writer
+    event_log_writer = game_shard.event_log_writer
+    receive_buffer = bytearray()
+    while True:
+        data = game_process_socket.recv(262144)
+        if not data:
+            break
+        receive_buffer += data
+        end = receive_buffer.rfind(b"\n")
+        if end >= 0:
+            lines = bytes(receive_buffer[:end]).split(b"\n")
+            del receive_buffer[: end + 1]
+            game_process_socket.sendall(game_shard.handle_lines(lines))
+    game_shard.close()
+
+
+def start_game_process(event_log_filename=None):
+    # returns the process and the lobby's end of a socket pair connected to it
+    lobby_socket, game_process_socket = socket.socketpair()
+    process = multiprocessing.Process(
+        target=run_game_process,
+        args=(game_process_socket, event_log_filename, lobby_socket),
+        daemon=True,
+    )
+    process.start()
+    game_process_socket.close()
+    return process, lobby_socket
 
 
 def main():
-    server = Server()
-    server_protocol = ServerProtocol(server)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--flush-delay",
+        type=float,
+        help="coalesce outgoing messages for up to this many seconds (0: once per event loop iteration)",
+    )
+    parser.add_argument(
+        "--disable-log-category",
+        action="append",
+        choices=LogWriter.categories,
+        default=[],
+        help="do not log this category of lines. can be repeated.",
+    )
+    parser.add_argument(
+        "--log-queue-size",
+        type=int,
+        default=100000,
+        help="number of log lines waiting to be written after which command lines are dropped",
+    )
+    parser.add_argument(
+        "--event-log",
+        help="also write game events to this binary event log file",
+    )
+    parser.add_argument(
+        "--checkpoint-store",
+        help="checkpoint games to this file, and restore the games in it at startup",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        help="checkpoint changed games every this many seconds instead of after every change",
+    )
+    parser.add_argument(
+        "--game-processes",
+        type=int,
+        default=0,
+        help="run the games in this many processes besides the lobby's. the event log of each is the --event-log file with its number appended. games are not checkpointed, so they do not survive a restart: --checkpoint-store can not be used with it.",
+    )
+    parser.add_argument(
+        "--websocket-port",
+        type=int,
+        help="also accept browsers on this port with websockets, without server.js",
+    )
+    parser.add_argument(
+        "--websocket-host",
+        default="127.0.0.1",
+        help="address for --websocket-port",
+    )
+    parser.add_argument(
+        "--websocket-without-passwords",
+        action="store_true",
+        help="for testing only: treat websocket users as not having passwords instead of checking logins against the user table like server.js",
+    )
+    parser.add_argument(
+        "--websocket-trusted-proxy",
+        action="append",
+        default=[],
+        help="address of a proxy in front of --websocket-port whose X-Real-IP header is used as the client address. can be given more than once.",
+    )
+    parser.add_argument(
+        "--write-buffer-limit",
+        type=int,
+        help="high-water mark in bytes of each frontend's write buffer. past it, messages are held and coalesced, and the frontend is not read from. default: asyncio's.",
+    )
+    parser.add_argument(
+        "--max-held-bytes",
+        type=int,
+        help="abort a frontend, disconnecting its clients, when more than this many bytes of messages are held for it",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        help="log the write buffer and held messages of each frontend every this many seconds",
+    )
+    args = parser.parse_args()
+    if args.game_processes and args.checkpoint_store:
+        # the games are only in the game processes, which do not checkpoint them
+        parser.error(
+            "--checkpoint-store does not work with --game-processes, whose games are not checkpointed"
+        )
+
+    # game processes are forked before the log writer thread is started
+    game_processes = [
+        start_game_process(
+            "%s.%d" % (args.event_log, index + 1) if args.event_log else None
+        )
+        for index in range(args.game_processes)
+    ]
+
+    log_writer.enabled_categories.difference_update(args.disable_log_category)
+    log_writer.start(args.log_queue_size)
+    if args.event_log and not game_processes:
+        event_log_writer.open(args.event_log)
+
+    server = Server(
+        args.flush_delay,
+        args.checkpoint_interval,
+        args.write_buffer_limit,
+        args.max_held_bytes,
+    )
+
+    if args.checkpoint_store:
+        # the restored games are many objects that stay around, so the garbage collector
+        # is kept from going through them while they are created and afterwards
+        start = time.time()
+        gc.disable()
+        internal_game_id_to_checkpoint, last_internal_game_id = checkpoint_writer.open(
+            args.checkpoint_store
+        )
+        server.restore_games(
+            internal_game_id_to_checkpoint.values(), last_internal_game_id
+        )
+        gc.freeze()
+        gc.enable()
+        log_writer.log("time", "time:", time.time())
+        log_writer.log(
+            "game",
+            "restored %d games in %.3fs"
+            % (len(internal_game_id_to_checkpoint), time.time() - start),
+        )
+        log_writer.end_batch()
 
     # import recreate_game
     # recreate_game.recreate_some_games(server)
 
     loop = asyncio.get_event_loop()
 
+    for process, lobby_socket in game_processes:
+        _, game_process_protocol = loop.run_until_complete(
+            loop.create_unix_connection(
+                lambda: GameProcessProtocol(server), sock=lobby_socket
+            )
+        )
+        server.game_processes.append(game_process_protocol)
+
     loop.run_until_complete(
-        loop.create_unix_server(lambda: server_protocol, "python.sock")
+        loop.create_unix_server(lambda: ServerProtocol(server), "python.sock")
     )
 
+    if args.websocket_port:
+        lookup_user = None if args.websocket_without_passwords else lookup_user_password
+        trusted_proxies = frozenset(args.websocket_trusted_proxy)
+        loop.run_until_complete(
+            loop.create_server(
+                lambda: WebSocketProtocol(server, lookup_user, trusted_proxies),
+                args.websocket_host,
+                args.websocket_port,
+            )
+        )
+
     def destroy_expired_games_loop():
         server.destroy_expired_games()
+        event_log_writer.flush()
         loop.call_later(15, destroy_expired_games_loop)
 
     loop.call_later(15, destroy_expired_games_loop)
 
+    if args.checkpoint_interval:
+
+        def checkpoint_games_loop():
+            server.checkpoint_games()
+            loop.call_later(args.checkpoint_interval, checkpoint_games_loop)
+
+        loop.call_later(args.checkpoint_interval, checkpoint_games_loop)
+
+    if args.metrics_interval:
+
+        def log_frontend_metrics_loop():
+            server.log_frontend_metrics()
+            loop.call_later(args.metrics_interval, log_frontend_metrics_loop)
+
+        loop.call_later(args.metrics_interval, log_frontend_metrics_loop)
+
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
     except:
         traceback.print_exc()
+    finally:
+        server.checkpoint_games()
+        log_writer.stop()
+        event_log_writer.close()
+        checkpoint_writer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+import argparse
+import collections
+import enums
+import multiprocessing
+import random
+import server
+import time
+import types
+
+
+def play_game(seed, num_players, mode, headless, stats):
+    # plays a game with random legal actions, adding [count, seconds] per action class to
+    # stats. returns the number of game actions.
+    rng = random.Random(seed)
+    tile_bag = [(x, y) for x in range(12) for y in range(9)]
+    rng.shuffle(tile_bag)
+
+    game = server.Game(
+        seed,
+        seed,
+        mode,
+        num_players,
+        lambda *args: None,
+        False,
+        tile_bag,
+        headless=headless,
+    )
+    for player_id in range(num_players):
+        client = types.SimpleNamespace(
+            client_id=player_id + 1,
+            username="player%d" % (player_id + 1),
+            game_id=None,
+            player_id=None,
+        )
+        game.join_game(client)
+
+    num_actions = 0
+    perf_counter = time.perf_counter
+    legal_actions_stats = stats["legal_actions"]
+    while True:
+        action = game.actions[-1]
+        if action.game_action_id == enums.GameActions.GameOver.value:
+            break
+        client = game.score_sheet.player_data[action.player_id][
+            enums.ScoreSheetIndexes.Client.value
+        ]
+
+        start = perf_counter()
+        legal_actions = game.legal_actions(action.player_id)
+        legal_actions_stats[0] += 1
+        legal_actions_stats[1] += perf_counter() - start
+
+        game_action = rng.choice(legal_actions)
+
+        start = perf_counter()
+        game.do_game_action(client, game_action[0], game_action[1:])
+        elapsed = perf_counter() - start
+        action_stats = stats[action.__class__.__name__]
+        action_stats[0] += 1
+        action_stats[1] += elapsed
+        num_actions += 1
+
+    return num_actions
+
+
+def play_games(games, mode, headless):
+    stats = collections.defaultdict(lambda: [0, 0.0])
+    num_actions = 0
+    for seed, num_players in games:
+        num_actions += play_game(seed, num_players, mode, headless, stats)
+    return len(games), num_actions, dict(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="plays games with random legal actions to measure the game engine"
+    )
+    parser.add_argument("--games", type=int, default=1000, help="number of games")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="number of worker processes",
+    )
+    parser.add_argument(
+        "--players",
+        type=int,
+        nargs="+",
+        default=[2, 3, 4, 5, 6],
+        help="player counts, used in turn",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=[x.name for x in enums.GameModes if x != enums.GameModes.Max],
+        default=enums.GameModes.Singles.name,
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument(
+        "--messages",
+        action="store_true",
+        help="build the messages for clients instead of running headless",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=20, help="games per task sent to a worker"
+    )
+    args = parser.parse_args()
+
+    mode = enums.GameModes[args.mode].value
+    if mode == enums.GameModes.Teams.value:
+        args.players = [4]
+    headless = not args.messages
+
+    games = [
+        (args.seed + index, args.players[index % len(args.players)])
+        for index in range(args.games)
+    ]
+    chunks = [
+        games[index : index + args.chunk_size]
+        for index in range(0, len(games), args.chunk_size)
+    ]
+
+    num_games = 0
+    num_actions = 0
+    stats = collections.defaultdict(lambda: [0, 0.0])
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        for chunk_num_games, chunk_num_actions, chunk_stats in pool.starmap(
+            play_games, [(chunk, mode, headless) for chunk in chunks]
+        ):
+            num_games += chunk_num_games
+            num_actions += chunk_num_actions
+            for name, (count, seconds) in chunk_stats.items():
+                stats[name][0] += count
+                stats[name][1] += seconds
+    elapsed = time.perf_counter() - start
+
+    print(
+        "%d games, %d actions in %.2fs with %d processes (%s)"
+        % (
+            num_games,
+            num_actions,
+            elapsed,
+            args.processes,
+            "headless" if headless else "messages",
+        )
+    )
+    print("%.1f games/s, %d actions/s" % (num_games / elapsed, num_actions / elapsed))
+    print()
+    print("%-34s %10s %12s %8s" % ("", "count", "us/call", "share"))
+    total_seconds = sum(seconds for count, seconds in stats.values())
+    for name, (count, seconds) in sorted(
+        stats.items(), key=lambda x: x[1][1], reverse=True
+    ):
+        print(
+            "%-34s %10d %12.1f %7.1f%%"
+            % (name, count, seconds / count * 1000000, seconds / total_seconds * 100)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,25 @@
+import asyncio
+import checkpoint
+import collections
+import enums
+import event_log
+import io
+import itertools
+import logs_to_games
+import os
+import pickle
+import queue
+import random
 import server
+import settings
+import simulate
+import tempfile
 import time
+import types
+import ujson
 import unittest
+import util
+import websocket
 
 
 class TestReuseIdManager(unittest.TestCase):
@@ -60,6 +79,14 @@ class TestReuseIdManager(unittest.TestCase):
         self.assertEqual(self.id_manager.get_id(), 1)
         self.assertEqual(self.id_manager.get_id(), 3)
 
+    def test_7(self):
+        self.id_manager.set_used_ids([5, 2, 3])
+        self.assertEqual(self.id_manager.get_id(), 1)
+        self.assertEqual(self.id_manager.get_id(), 4)
+        self.assertEqual(self.id_manager.get_id(), 6)
+        self.id_manager.return_id(3)
+        self.assertEqual(self.id_manager.get_id(), 3)
+
 
 class TestIncrementIdManager(unittest.TestCase):
     def setUp(self):
@@ -71,6 +98,2216 @@ class TestIncrementIdManager(unittest.TestCase):
         self.id_manager.return_id(99)
         self.assertEqual(self.id_manager.get_id(), 3)
 
+    def test_2(self):
+        self.id_manager.set_last_id(41)
+        self.assertEqual(self.id_manager.get_id(), 42)
+
+
+class TestTimerHeap(unittest.TestCase):
+    def setUp(self):
+        self.timers = server.TimerHeap()
+        self.calls = []
+
+    def test_1(self):
+        self.timers.schedule(3, self.calls.append, "c")
+        self.timers.schedule(1, self.calls.append, "a")
+        self.timers.schedule(1, self.calls.append, "b")
+        timer = self.timers.schedule(2, self.calls.append, "x")
+        self.timers.cancel(timer)
+        self.timers.run(0.5)
+        self.assertEqual(self.calls, [])
+        self.timers.run(2)
+        self.assertEqual(self.calls, ["a", "b"])
+        self.timers.run(3)
+        self.assertEqual(self.calls, ["a", "b", "c"])
+
+    def test_2(self):
+        id_manager = server.ReuseIdManager(10, self.timers)
+        self.assertEqual(id_manager.get_id(), 1)
+        self.assertEqual(id_manager.get_id(), 2)
+        id_manager.return_id(1)
+        self.assertEqual(id_manager.get_id(), 3)
+        self.timers.run(time.time() + 10)
+        self.assertEqual(id_manager.get_id(), 1)
+        self.assertEqual(id_manager.get_id(), 4)
+
+
+class TestServerProtocol(unittest.TestCase):
+    def setUp(self):
+        self.lines = []
+        self.server_protocol = server.ServerProtocol(None)
+        self.server_protocol.handle_line = lambda key, value: self.lines.append(
+            (bytes(key), bytes(value))
+        )
+
+    def test_1(self):
+        self.server_protocol.data_received(b"1 [0,0,4]\n2 [4]\n")
+        self.assertEqual(self.lines, [(b"1", b"[0,0,4]"), (b"2", b"[4]")])
+
+    def test_2(self):
+        data = b'connect ["a","1.2.3.4","x",false]\n12 [6,"a b  c"]\ndisconnect 12\n'
+        for chunk_size in range(1, len(data) + 1):
+            del self.lines[:]
+            for index in range(0, len(data), chunk_size):
+                self.server_protocol.data_received(data[index : index + chunk_size])
+            self.assertEqual(
+                self.lines,
+                [
+                    (b"connect", b'["a","1.2.3.4","x",false]'),
+                    (b"12", b'[6,"a b  c"]'),
+                    (b"disconnect", b"12"),
+                ],
+            )
+            self.assertEqual(self.server_protocol.receive_buffer, b"")
+
+    def test_3(self):
+        self.server_protocol.data_received(b"1 [4]\n2 [")
+        self.assertEqual(self.lines, [(b"1", b"[4]")])
+        self.assertEqual(self.server_protocol.receive_buffer, b"2 [")
+        self.server_protocol.data_received(b"4")
+        self.server_protocol.data_received(b"]\n")
+        self.assertEqual(self.lines, [(b"1", b"[4]"), (b"2", b"[4]")])
+
+
+class TestServerFrontends(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server()
+        self.default_written = []
+        self.server.transport_write = self.default_written.append
+        self.frontends = []
+        self.frontend_to_written = {}
+        for _ in range(2):
+            frontend = server.ServerProtocol(self.server)
+            written = []
+            frontend.connection_made(types.SimpleNamespace(write=written.append))
+            self.frontends.append(frontend)
+            self.frontend_to_written[frontend] = written
+
+    def get_lines(self, frontend):
+        written = self.frontend_to_written[frontend]
+        lines = b"".join(written).splitlines()
+        del written[:]
+        return lines
+
+    def get_client_ids(self, frontend):
+        # returns the client ids that were sent lines
+        client_ids = set()
+        for line in self.get_lines(frontend):
+            key, value = line.split(b" ", 1)
+            if key not in (b"connect", b"disconnect"):
+                client_ids.update(int(x) for x in key.split(b","))
+        return client_ids
+
+    def test_1(self):
+        frontend1, frontend2 = self.frontends
+        frontend1.data_received(b'connect ["a","1.2.3.4",10,false]\n')
+        frontend2.data_received(b'connect ["b","1.2.3.5",10,false]\n')
+        frontend1.data_received(b'connect ["c","1.2.3.6",11,false]\n')
+        self.assertEqual(frontend1.client_ids, {1, 3})
+        self.assertEqual(frontend2.client_ids, {2})
+        self.assertIn(b"connect [10,1]", self.get_lines(frontend1))
+        self.get_lines(frontend2)
+
+        # one message to all clients is split between the frontends
+        frontend2.data_received(b'2 [6,"hi"]\n')
+        self.assertEqual(self.get_lines(frontend1), [b'1,3 [[21,2,"hi","b"]]'])
+        self.assertEqual(self.get_lines(frontend2), [b'2 [[21,2,"hi","b"]]'])
+        self.assertEqual(self.default_written, [])
+
+    def test_2(self):
+        frontend1, frontend2 = self.frontends
+        frontend1.data_received(b'connect ["a","1.2.3.4",10,false]\n')
+        frontend2.data_received(b'connect ["b","1.2.3.5",10,false]\n')
+        self.get_lines(frontend1)
+        self.get_lines(frontend2)
+
+        # a frontend cannot speak for or disconnect another frontend's client
+        frontend1.data_received(b'2 [6,"hi"]\ndisconnect 2\n')
+        self.assertEqual(self.get_lines(frontend1), [])
+        self.assertEqual(self.get_lines(frontend2), [])
+        self.assertIn(2, self.server.client_id_to_client)
+
+        frontend2.data_received(b"disconnect 2\n")
+        self.assertEqual(self.get_lines(frontend2), [b"disconnect 2"])
+        self.assertEqual(frontend2.client_ids, set())
+        self.assertEqual(self.get_client_ids(frontend1), {1})
+
+    def test_3(self):
+        frontend1, frontend2 = self.frontends
+        frontend1.data_received(b'connect ["a","1.2.3.4",10,false]\n')
+        frontend2.data_received(b'connect ["b","1.2.3.5",10,false]\n')
+        frontend2.data_received(b'connect ["c","1.2.3.6",11,false]\n')
+        self.get_lines(frontend1)
+
+        # the clients of a lost frontend are disconnected, and it is not written to again
+        frontend2.connection_lost(None)
+        self.assertEqual(set(self.server.client_id_to_client), {1})
+        self.assertEqual(self.server.lobby_client_ids, {1})
+        self.assertEqual(self.get_client_ids(frontend1), {1})
+        del self.frontend_to_written[frontend2][:]
+
+        frontend1.data_received(b'1 [6,"hi"]\n')
+        self.assertEqual(self.get_client_ids(frontend1), {1})
+        self.assertEqual(self.get_lines(frontend2), [])
+
+        # client ids stay unique across frontends
+        frontend3 = server.ServerProtocol(self.server)
+        written = []
+        frontend3.connection_made(types.SimpleNamespace(write=written.append))
+        frontend3.data_received(b'connect ["d","1.2.3.7",10,false]\n')
+        self.assertEqual(frontend3.client_ids, {4})
+        self.assertIn(b"connect [10,4]", b"".join(written).splitlines())
+
+
+class FakeFrontendTransport:
+    def __init__(self):
+        self.written = []
+        self.calls = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def pause_reading(self):
+        self.calls.append("pause_reading")
+
+    def resume_reading(self):
+        self.calls.append("resume_reading")
+
+    def set_write_buffer_limits(self, high):
+        self.calls.append(("set_write_buffer_limits", high))
+
+    def get_write_buffer_size(self):
+        return 1234
+
+    def abort(self):
+        self.calls.append("abort")
+
+    def get_lines(self):
+        lines = b"".join(self.written).splitlines()
+        del self.written[:]
+        return lines
+
+
+class TestServerBackpressure(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server(write_buffer_limit=65536, max_held_bytes=5000)
+        self.transports = []
+        self.frontends = []
+        for _ in range(2):
+            transport = FakeFrontendTransport()
+            frontend = server.ServerProtocol(self.server)
+            frontend.connection_made(transport)
+            self.transports.append(transport)
+            self.frontends.append(frontend)
+        for index, username in enumerate(["a", "b", "c"]):
+            self.frontends[index % 2].data_received(
+                b'connect ["%s","1.2.3.4",%d,false]\n' % (username.encode(), index)
+            )
+        for transport in self.transports:
+            transport.get_lines()
+
+    def test_1(self):
+        held_messages = server.HeldMessages()
+        held_messages.add([1, 2], '[[6,0,1,5],[4,1,2,3],[21,1,"hi","a"]]')
+        held_messages.add([1], "[[6,0,1,6],[6,0,2,6],[4,1,2,7]]")
+        held_messages.add([2], "[[19,3,2]]")
+        held_messages.add([2], "[[18,3,1,2,8],[19,3,9],[3,1,2],[3,1,3]]")
+        held_messages.add([1, 2], "[[6,0,2,7]]")
+        self.assertEqual(
+            held_messages.pop_lines(),
+            [
+                # [6,0,1,5] is only superseded for client 1
+                ("1,2", '[[6,0,1,5],[4,1,2,3],[21,1,"hi","a"]]'),
+                ("1", "[[6,0,1,6],[4,1,2,7]]"),
+                ("2", "[[18,3,1,2,8],[19,3,9],[3,1,2],[3,1,3]]"),
+                ("1,2", "[[6,0,2,7]]"),
+            ],
+        )
+        self.assertEqual(held_messages.coalesced_count, 2)
+        self.assertEqual(held_messages.num_bytes, 0)
+
+        # a whole game board supersedes the cells before it
+        board = [[0] * 9 for _ in range(12)]
+        held_messages.add([1], ujson.dumps([[4, 1, 2, 3], [5, board], [4, 1, 3, 3]]))
+        held_messages.add([1, 2], ujson.dumps([[5, board], [4, 1, 2, 7]]))
+        self.assertEqual(
+            held_messages.pop_lines([1]),
+            [("1", ujson.dumps([[5, board], [4, 1, 2, 7]]))],
+        )
+        self.assertEqual(
+            held_messages.pop_lines(), [("2", ujson.dumps([[5, board], [4, 1, 2, 7]]))]
+        )
+
+        # a run of cells supersedes the single cells it covers, and is superseded only
+        # when all of its cells are
+        held_messages.add([1], "[[4,1,2,3],[4,1,4,3]]")
+        held_messages.add([1], "[[25,7,11,-2,20]]")
+        held_messages.add([1], "[[4,1,2,8],[4,1,3,8],[4,1,4,8]]")
+        held_messages.add([1], "[[25,6,29,-1]]")
+        held_messages.add([1], "[[4,2,2,6]]")
+        self.assertEqual(
+            held_messages.pop_lines(),
+            [("1", "[[4,1,2,8],[4,1,3,8],[4,1,4,8],[25,6,29,-1],[4,2,2,6]]")],
+        )
+        held_messages.add([1], "[[25,7,11,-2,20]]")
+        held_messages.add([1], "[[4,1,2,8],[4,1,3,8],[4,1,4,8],[25,6,21,-1]]")
+        self.assertEqual(
+            held_messages.pop_lines(),
+            [("1", "[[25,7,11,-2,20],[4,1,2,8],[4,1,3,8],[4,1,4,8],[25,6,21,-1]]")],
+        )
+
+    def test_2(self):
+        transport1, transport2 = self.transports
+        frontend1, frontend2 = self.frontends
+        self.assertEqual(transport1.calls, [("set_write_buffer_limits", 65536)])
+
+        # messages for a paused frontend's clients are held, the others are written
+        frontend1.pause_writing()
+        self.assertEqual(transport1.calls[-1], "pause_reading")
+        for value in range(3):
+            self.server.add_pending_messages([[6, 0, 1, value]])
+            self.server.add_pending_messages([[21, 2, "hi%d" % value, "b"]], {1, 2})
+            self.server.flush_pending_messages()
+        self.assertEqual(transport1.get_lines(), [])
+        self.assertEqual(
+            transport2.get_lines(),
+            [
+                b'2 [[6,0,1,0],[21,2,"hi0","b"]]',
+                b'2 [[6,0,1,1],[21,2,"hi1","b"]]',
+                b'2 [[6,0,1,2],[21,2,"hi2","b"]]',
+            ],
+        )
+        metrics = dict(frontend1.get_metrics())
+        self.assertEqual(metrics["paused"], 1)
+        self.assertEqual(metrics["held_lines"], 6)
+        self.assertEqual(metrics["write_buffer"], 1234)
+
+        # and written, coalesced, when it can be written to again
+        frontend1.resume_writing()
+        self.assertEqual(transport1.calls[-1], "resume_reading")
+        self.assertEqual(
+            sorted(transport1.get_lines()),
+            [
+                b'1 [[21,2,"hi0","b"],[21,2,"hi1","b"],[6,0,1,2],[21,2,"hi2","b"]]',
+                b"3 [[6,0,1,2]]",
+            ],
+        )
+        metrics = dict(frontend1.get_metrics())
+        self.assertEqual(metrics["coalesced"], 4)
+        self.assertEqual(metrics["held_bytes"], 0)
+
+        self.server.add_pending_messages([[6, 0, 1, 3]], {1})
+        self.server.flush_pending_messages()
+        self.assertEqual(transport1.get_lines(), [b"1 [[6,0,1,3]]"])
+
+    def test_3(self):
+        transport1, transport2 = self.transports
+        frontend1, frontend2 = self.frontends
+
+        # a client's held messages are written before the server disconnects it
+        frontend1.pause_writing()
+        self.server.add_pending_messages([[21, 2, "hi", "b"]])
+        self.server.flush_pending_messages()
+        self.server.client_id_to_client[1].disconnect()
+        self.assertEqual(
+            transport1.get_lines(), [b'1 [[21,2,"hi","b"]]', b"disconnect 1"]
+        )
+
+        # but not when the frontend disconnects it
+        frontend1.data_received(b"disconnect 3\n")
+        self.assertEqual(transport1.get_lines(), [b"disconnect 3"])
+        self.assertEqual(frontend1.held_messages.pop_lines(), [])
+        frontend1.data_received(b'connect ["c","1.2.3.4",2,false]\n')
+        transport1.get_lines()
+
+        # a frontend that is held too much is aborted
+        for _ in range(100):
+            self.server.add_pending_messages(
+                [[21, 2, "x" * 100, "b"]],
+                {self.server.username_to_client["c"].client_id},
+            )
+            self.server.flush_pending_messages()
+            if "abort" in transport1.calls:
+                break
+        self.assertGreater(frontend1.held_messages.num_bytes, 5000)
+        self.assertLess(frontend1.held_messages.num_bytes, 5200)
+        self.assertNotIn("abort", transport2.calls)
+        frontend1.connection_lost(None)
+        self.assertEqual(set(self.server.client_id_to_client), {2})
+        self.assertEqual(self.server.frontends, {frontend2})
+
+    def test_4(self):
+        # lines are dropped, and their bytes no longer counted, when their last client is
+        # taken or discarded
+        held_messages = server.HeldMessages()
+        held_messages.add([1, 2], '[[21,1,"hi","a"]]')
+        held_messages.add([1], "[[6,0,1,5]]")
+        held_messages.add([2, 3], "[[6,0,2,5]]")
+        held_messages.add([3], "[[6,0,3,5]]")
+        self.assertEqual(held_messages.num_bytes, 50)
+
+        held_messages.discard([1])
+        self.assertEqual(held_messages.num_bytes, 39)
+        self.assertEqual(len(held_messages.messages_jsons), 3)
+        self.assertEqual(
+            held_messages.pop_lines([2]), [("2", '[[21,1,"hi","a"],[6,0,2,5]]')]
+        )
+        self.assertEqual(held_messages.num_bytes, 22)
+        self.assertEqual(held_messages.client_id_sets, [{3}, {3}])
+        self.assertEqual(held_messages.pop_lines([3]), [("3", "[[6,0,2,5],[6,0,3,5]]")])
+        self.assertEqual(held_messages.num_bytes, 0)
+        self.assertEqual(held_messages.messages_jsons, [])
+
+
+def encode_client_frame(payload, opcode=websocket.Opcodes.Text, final=True):
+    # like a browser's: masked
+    mask = bytes(random.randrange(256) for _ in range(4))
+    frame = websocket.encode_frame(websocket.unmask(payload, mask), opcode)
+    if not final:
+        frame = bytes([frame[0] & 0x7F]) + frame[1:]
+    header_size = len(frame) - len(payload)
+    return (
+        frame[:1]
+        + bytes([frame[1] | 0x80])
+        + frame[2:header_size]
+        + mask
+        + frame[header_size:]
+    )
+
+
+def decode_server_frames(data):
+    # returns the (opcode, payload) pairs in frames from the server, which are not masked
+    frames = []
+    index = 0
+    while index < len(data):
+        length = data[index + 1]
+        header_size = 2
+        if length == 126:
+            length = int.from_bytes(data[index + 2 : index + 4], "big")
+            header_size = 4
+        elif length == 127:
+            length = int.from_bytes(data[index + 2 : index + 10], "big")
+            header_size = 10
+        frames.append(
+            (
+                websocket.Opcodes(data[index] & 0x0F),
+                data[index + header_size : index + header_size + length],
+            )
+        )
+        index += header_size + length
+    return frames
+
+
+class TestWebSocket(unittest.TestCase):
+    def test_1(self):
+        # the example in RFC 6455
+        self.assertEqual(
+            websocket.get_accept_key("dGhlIHNhbXBsZSBub25jZQ=="),
+            "s3pPLMBiTxaQ9kYGzzhZRbK+xOo=",
+        )
+
+        request = (
+            b"GET /sockjs/websocket HTTP/1.1\r\nHost: x\r\nUpgrade: websocket\r\n"
+            b"Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+            b"Sec-WebSocket-Version: 13\r\n\r\n"
+        )
+        self.assertIsNone(websocket.parse_handshake(request[:-1]))
+        path, headers, size = websocket.parse_handshake(request + b"\x81")
+        self.assertEqual(path, "/sockjs/websocket")
+        self.assertEqual(headers["sec-websocket-key"], "dGhlIHNhbXBsZSBub25jZQ==")
+        self.assertEqual(size, len(request))
+        with self.assertRaises(websocket.HandshakeError):
+            websocket.parse_handshake(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n")
+
+        self.assertFalse(websocket.re_sockjs_path.match("/sockjs/websocket"))
+        self.assertTrue(
+            websocket.re_sockjs_path.match("/sockjs/123/abcdefgh/websocket")
+        )
+
+    def test_2(self):
+        rng = random.Random(0)
+        for length in [0, 1, 5, 125, 126, 127, 65535, 65536, 100000]:
+            payload = bytes(rng.randrange(256) for _ in range(length))
+            data = encode_client_frame(b"[4]") + encode_client_frame(payload)
+            for chunk_size in [1, 7, len(data)] if length < 1000 else [4096]:
+                decoder = websocket.FrameDecoder()
+                frames = []
+                for index in range(0, len(data), chunk_size):
+                    frames.extend(decoder.feed(data[index : index + chunk_size]))
+                self.assertEqual(
+                    frames,
+                    [
+                        (websocket.Opcodes.Text, b"[4]"),
+                        (websocket.Opcodes.Text, payload),
+                    ],
+                )
+                self.assertEqual(decoder.buffer, b"")
+            self.assertEqual(
+                decode_server_frames(websocket.encode_frame(payload)),
+                [(websocket.Opcodes.Text, payload)],
+            )
+
+    def test_3(self):
+        # fragments around a ping
+        decoder = websocket.FrameDecoder()
+        frames = decoder.feed(
+            encode_client_frame(b"[6,", final=False)
+            + encode_client_frame(b"x", websocket.Opcodes.Ping)
+            + encode_client_frame(b'"hi"]', websocket.Opcodes.Continuation)
+        )
+        self.assertEqual(
+            frames,
+            [(websocket.Opcodes.Ping, b"x"), (websocket.Opcodes.Text, b'[6,"hi"]')],
+        )
+
+        with self.assertRaises(websocket.ProtocolError):
+            websocket.FrameDecoder().feed(websocket.encode_frame(b"[4]"))
+        with self.assertRaises(websocket.ProtocolError):
+            websocket.FrameDecoder().feed(
+                encode_client_frame(b"x", websocket.Opcodes.Continuation)
+            )
+
+
+class TestWebSocketProtocol(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server()
+
+    def connect(
+        self,
+        path="/sockjs/websocket",
+        version=server.server_version,
+        headers=b"",
+        trusted_proxies=(),
+    ):
+        written = []
+        transport = types.SimpleNamespace(
+            write=written.append,
+            close=lambda: written.append(None),
+            get_extra_info=lambda name: ("1.2.3.4", 5678),
+        )
+        protocol = server.WebSocketProtocol(
+            self.server, trusted_proxies=trusted_proxies
+        )
+        protocol.connection_made(transport)
+        protocol.data_received(
+            b"GET "
+            + path.encode()
+            + b" HTTP/1.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+            b"Sec-WebSocket-Version: 13\r\n" + headers + b"\r\n"
+        )
+        self.assertTrue(written.pop(0).startswith(b"HTTP/1.1 101 "))
+        return protocol, written
+
+    def get_messages(self, written):
+        # returns the messages sent in text frames, and whether the socket was closed
+        data = b"".join(x for x in written if x is not None)
+        closed = None in written
+        del written[:]
+        messages = []
+        for opcode, payload in decode_server_frames(data):
+            if opcode == websocket.Opcodes.Text:
+                messages.extend(ujson.decode(payload))
+        return messages, closed
+
+    def test_1(self):
+        protocol1, written1 = self.connect()
+        protocol1.data_received(encode_client_frame(b'["VERSION","a",""]'))
+        messages, closed = self.get_messages(written1)
+        self.assertFalse(closed)
+        self.assertIn([enums.CommandsToClient.SetClientId.value, 1], messages)
+        self.assertIn(
+            [enums.CommandsToClient.SetClientIdToData.value, 1, "a", "1.2.3.4"],
+            messages,
+        )
+        self.assertEqual(protocol1.client_ids, {1})
+
+        protocol2, written2 = self.connect()
+        protocol2.data_received(encode_client_frame(b'["VERSION"," b  ",""]'))
+        self.get_messages(written1)
+        self.get_messages(written2)
+
+        protocol2.data_received(
+            encode_client_frame(b"[6,", final=False)
+            + encode_client_frame(b"x", websocket.Opcodes.Ping)
+            + encode_client_frame(b'"hi"]', websocket.Opcodes.Continuation)
+        )
+        message = [enums.CommandsToClient.AddGlobalChatMessage.value, 2, "hi", "b"]
+        self.assertEqual(self.get_messages(written1), ([message], False))
+        self.assertEqual(
+            decode_server_frames(written2[0]), [(websocket.Opcodes.Pong, b"x")]
+        )
+        self.assertEqual(self.get_messages(written2), ([message], False))
+
+        # a closed socket disconnects its client
+        protocol2.data_received(encode_client_frame(b"", websocket.Opcodes.Close))
+        self.assertEqual(self.get_messages(written2), ([], True))
+        protocol2.connection_lost(None)
+        self.assertEqual(set(self.server.client_id_to_client), {1})
+        self.assertEqual(
+            self.get_messages(written1),
+            ([[enums.CommandsToClient.SetClientIdToData.value, 2, None, None]], False),
+        )
+
+    def test_2(self):
+        # sockjs framing
+        protocol, written = self.connect("/sockjs/123/abcdefgh/websocket")
+        self.assertEqual(
+            decode_server_frames(written.pop(0)), [(websocket.Opcodes.Text, b"o")]
+        )
+        protocol.data_received(
+            encode_client_frame(ujson.dumps(['["VERSION","a",""]']).encode())
+        )
+        protocol.data_received(encode_client_frame(ujson.dumps(['[6,"hi"]']).encode()))
+        messages = []
+        for opcode, payload in decode_server_frames(b"".join(written)):
+            self.assertEqual(payload[:1], b"a")
+            for messages_json in ujson.decode(payload[1:]):
+                messages.extend(ujson.decode(messages_json))
+        self.assertIn([enums.CommandsToClient.SetClientId.value, 1], messages)
+        self.assertEqual(
+            messages[-1],
+            [enums.CommandsToClient.AddGlobalChatMessage.value, 1, "hi", "a"],
+        )
+
+    def test_3(self):
+        # logins refused like server.js does
+        for login, error in [
+            (b'["old","a",""]', enums.Errors.NotUsingLatestVersion),
+            (b'["VERSION","",""]', enums.Errors.InvalidUsername),
+            (b'["VERSION","a\\u00e9",""]', enums.Errors.InvalidUsername),
+            (b'["VERSION","a","' + b"0" * 64 + b'"]', enums.Errors.ProvidedPassword),
+        ]:
+            protocol, written = self.connect()
+            protocol.data_received(encode_client_frame(login))
+            self.assertEqual(
+                self.get_messages(written),
+                ([[enums.CommandsToClient.FatalError.value, error.value]], True),
+            )
+        self.assertEqual(self.server.client_id_to_client, {})
+
+        # and with the user table
+        users = {"a": ["p" * 64], "b": [None]}
+        for login, error in [
+            (b'["VERSION","a",""]', enums.Errors.MissingPassword),
+            (b'["VERSION","a","' + b"q" * 64 + b'"]', enums.Errors.IncorrectPassword),
+            (b'["VERSION","b","' + b"p" * 64 + b'"]', enums.Errors.ProvidedPassword),
+        ]:
+            protocol, written = self.connect()
+            protocol.on_user_found(
+                users.get(ujson.decode(login)[1]), *ujson.decode(login)[1:]
+            )
+            self.assertEqual(
+                self.get_messages(written),
+                ([[enums.CommandsToClient.FatalError.value, error.value]], True),
+            )
+
+        protocol, written = self.connect()
+        protocol.on_user_found(users["a"], "a", "p" * 64)
+        self.assertEqual(protocol.client_ids, {1})
+
+        # a username in use
+        protocol, written = self.connect()
+        protocol.data_received(encode_client_frame(b'["VERSION","a",""]'))
+        self.assertEqual(
+            self.get_messages(written),
+            (
+                [
+                    [
+                        enums.CommandsToClient.FatalError.value,
+                        enums.Errors.UsernameAlreadyInUse.value,
+                    ]
+                ],
+                True,
+            ),
+        )
+
+    def test_4(self):
+        # x-real-ip is only used from a trusted proxy
+        for username, trusted_proxies, ip_address in [
+            (b"a", (), "1.2.3.4"),
+            (b"b", ("5.6.7.8",), "1.2.3.4"),
+            (b"c", ("1.2.3.4",), "9.9.9.9"),
+        ]:
+            protocol, written = self.connect(
+                headers=b"X-Real-IP: 9.9.9.9\r\n", trusted_proxies=trusted_proxies
+            )
+            protocol.data_received(
+                encode_client_frame(b'["VERSION","' + username + b'",""]')
+            )
+            client_id = min(protocol.client_ids)
+            self.assertEqual(
+                self.server.client_id_to_client[client_id].ip_address, ip_address
+            )
+
+    def test_5(self):
+        # whitespace is collapsed like server.js does, so a message can not add lines to
+        # the log. a bad message disconnects the client.
+        protocol, written = self.connect()
+        protocol.data_received(encode_client_frame(b'["VERSION","a",""]'))
+        self.get_messages(written)
+        file = io.StringIO()
+        log_writer_file = server.log_writer.file
+        server.log_writer.file = file
+        try:
+            protocol.data_received(encode_client_frame(b'[6,\r\n\t"hi"]'))
+            self.assertEqual(
+                self.get_messages(written),
+                (
+                    [[enums.CommandsToClient.AddGlobalChatMessage.value, 1, "hi", "a"]],
+                    False,
+                ),
+            )
+            protocol.data_received(
+                encode_client_frame(b'[6,\n{"_":"game-result","game-id":1}\n"hi"]')
+            )
+        finally:
+            server.log_writer.file = log_writer_file
+        self.assertEqual(self.get_messages(written), ([], True))
+        self.assertEqual(self.server.client_id_to_client, {})
+        self.assertIn('1 -> [6, "hi"]\n', file.getvalue())
+        self.assertIn(
+            '1 -> [6, {"_":"game-result","game-id":1} "hi"]\n', file.getvalue()
+        )
+        self.assertNotIn("\n{", file.getvalue())
+
+
+class TestServerPendingMessages(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server()
+        self.server.client_ids.update([1, 2, 3])
+        self.written = []
+        self.server.transport_write = self.written.append
+
+    def test_1(self):
+        self.server.add_pending_messages([[16, 0], [6, 7, 0, "ab"]])
+        self.server.add_pending_messages([[18, 0, 1, 2, 11]], {2})
+        self.server.add_pending_messages([[22, 2, "hi"]], {2, 3})
+        self.server.flush_pending_messages()
+        self.assertEqual(
+            sorted(b"".join(self.written).splitlines()),
+            [
+                b'1 [[16,0],[6,7,0,"ab"]]',
+                b'2 [[16,0],[6,7,0,"ab"],[18,0,1,2,11],[22,2,"hi"]]',
+                b'3 [[16,0],[6,7,0,"ab"],[22,2,"hi"]]',
+            ],
+        )
+        self.assertEqual(self.server.pending_batches, [])
+        self.assertEqual(self.server.client_id_to_pending_batch_indexes, {})
+
+    def test_2(self):
+        message = [7, [[0, 0], [0, 0]]]
+        self.server.add_pending_messages([message], {1})
+        message[1][0][0] = 5
+        self.server.flush_pending_messages()
+        self.assertEqual(self.written, [b"1 [[7,[[0,0],[0,0]]]]\n"])
+
+    def test_3(self):
+        # compare with the group-splitting algorithm add_pending_messages used to have
+        def legacy_add_pending_messages(client_ids_and_messages, messages, client_ids):
+            client_ids = client_ids.copy()
+            new_list = []
+            for client_ids2, messages2 in client_ids_and_messages:
+                client_ids_in_group = client_ids2 & client_ids
+                if len(client_ids_in_group) == len(client_ids2):
+                    messages2.extend(messages)
+                    new_list.append([client_ids2, messages2])
+                elif client_ids_in_group:
+                    new_list.append([client_ids_in_group, messages2 + messages])
+                    client_ids2 -= client_ids_in_group
+                    new_list.append([client_ids2, messages2])
+                else:
+                    new_list.append([client_ids2, messages2])
+                client_ids -= client_ids_in_group
+            if client_ids:
+                new_list.append([client_ids, messages])
+            return new_list
+
+        rng = random.Random(0)
+        for _ in range(200):
+            client_ids_and_messages = []
+            del self.written[:]
+            for message_index in range(rng.randint(0, 30)):
+                messages = [[message_index, x] for x in range(rng.randint(1, 3))]
+                if rng.random() < 0.2:
+                    client_ids = None
+                else:
+                    client_ids = set(rng.sample(range(1, 10), rng.randint(1, 9)))
+                self.server.add_pending_messages(messages, client_ids)
+                client_ids_and_messages = legacy_add_pending_messages(
+                    client_ids_and_messages,
+                    messages,
+                    self.server.client_ids if client_ids is None else client_ids,
+                )
+            self.server.flush_pending_messages()
+
+            expected = {}
+            for client_ids, messages in client_ids_and_messages:
+                for client_id in client_ids:
+                    expected[client_id] = messages
+            actual = {}
+            for line in b"".join(self.written).splitlines():
+                client_ids, messages = line.split(b" ", 1)
+                for client_id in client_ids.split(b","):
+                    self.assertNotIn(int(client_id), actual)
+                    actual[int(client_id)] = ujson.decode(messages)
+            self.assertEqual(actual, expected)
+            self.assertEqual(
+                len(b"".join(self.written).splitlines()), len(client_ids_and_messages)
+            )
+
+
+class TestServerFlushDelay(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = server.Server(0)
+        self.server.client_ids.update([1, 2])
+        self.written = []
+        self.server.transport_write = self.written.append
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_1(self):
+        self.server.add_pending_messages([[16, 0]])
+        self.server.request_flush()
+        self.server.add_pending_messages([[16, 1]], {2})
+        self.server.request_flush()
+        self.assertEqual(self.written, [])
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(
+            sorted(b"".join(self.written).splitlines()),
+            [b"1 [[16,0]]", b"2 [[16,0],[16,1]]"],
+        )
+        self.assertIsNone(self.server.flush_handle)
+
+    def test_2(self):
+        self.server.flush_delay = 0.01
+        self.server.add_pending_messages([[16, 0]], {1})
+        self.server.request_flush()
+        self.server.flush_pending_messages()
+        self.assertEqual(self.written, [b"1 [[16,0]]\n"])
+        self.assertIsNone(self.server.flush_handle)
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        self.assertEqual(len(self.written), 1)
+
+
+class TestServerGameExpiration(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server()
+        self.written = []
+        self.server.transport_write = self.written.append
+        self.client = server.Client(self.server, "a", "1.2.3.4", "x", False)
+        self.client.on_message(b"[0,0,4]")
+        self.game = self.server.game_id_to_game[1]
+
+    def expire_game(self):
+        # pretend the expiration time has passed
+        self.game.expiration_time = time.time() - 1
+        self.server.update_game_expiration(self.game)
+
+    def test_1(self):
+        self.assertEqual(self.server.game_id_to_expiration_timer, {})
+        self.client.on_message(b"[4]")
+        self.assertIn(1, self.server.game_id_to_expiration_timer)
+        self.client.on_message(b"[2,1]")
+        self.assertEqual(self.server.game_id_to_expiration_timer, {})
+        self.server.destroy_expired_games()
+        self.assertIn(1, self.server.game_id_to_game)
+
+    def test_2(self):
+        self.client.on_message(b"[4]")
+        self.expire_game()
+        del self.written[:]
+        self.server.destroy_expired_games()
+        self.assertEqual(self.server.game_id_to_game, {})
+        self.assertEqual(self.server.game_id_to_expiration_timer, {})
+        self.assertEqual(self.written, [b"1 [[23,1]]\n"])
+
+    def test_3(self):
+        self.client.on_message(b"[4]")
+        self.expire_game()
+        watcher = server.Client(self.server, "b", "1.2.3.4", "y", False)
+        watcher.on_message(b"[3,1]")
+        self.server.destroy_expired_games()
+        self.assertIn(1, self.server.game_id_to_game)
+
+
+class TestLobbySnapshot(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server()
+        self.server.transport_write = lambda data: None
+
+    def assert_lobby_snapshot_is_current(self):
+        lobby_snapshot = server.LobbySnapshot(self.server)
+        for client in self.server.client_id_to_client.values():
+            lobby_snapshot.add_client(client)
+        self.assertEqual(
+            self.server.lobby_snapshot.get_clients_json(),
+            lobby_snapshot.get_clients_json(),
+        )
+        self.assertEqual(
+            self.server.lobby_snapshot.get_games_json(),
+            lobby_snapshot.get_games_json(),
+        )
+
+    def test_1(self):
+        written = []
+        self.server.transport_write = written.append
+        server.Client(self.server, "a", "1.2.3.4", "x", False).on_message(b"[0,0,4]")
+        del written[:]
+        server.Client(self.server, "b", "5.6.7.8", "y", False)
+        lines = dict(line.split(b" ", 1) for line in written[1].splitlines())
+        self.assertEqual(
+            ujson.decode(lines[b"2"]),
+            [
+                [1, 2],
+                [2, 1, "a", "1.2.3.4"],
+                [2, 2, "b", "5.6.7.8"],
+                [3, 1, 0, 0, 4],
+                [8, 1, 0, 1],
+            ],
+        )
+
+    def test_2(self):
+        rng = random.Random(0)
+        usernames = ["a", "b", "c", "d", "e", "f"]
+        for _ in range(500):
+            clients = list(self.server.client_id_to_client.values())
+            game_ids = list(self.server.game_id_to_game)
+            choice = rng.randrange(8)
+            if choice == 0 or not clients:
+                username = rng.choice(usernames)
+                server.Client(self.server, username, "1.2.3.4", "x", True)
+            elif choice == 1:
+                rng.choice(clients).disconnect()
+            elif choice == 2:
+                rng.choice(clients).on_message(b"[0,0,%d]" % rng.randint(1, 3))
+            elif choice <= 5 and game_ids:
+                message = b"[%d,%d]" % (choice - 2, rng.choice(game_ids))
+                rng.choice(clients).on_message(message)
+            elif choice == 6:
+                rng.choice(clients).on_message(b"[4]")
+            elif choice == 7:
+                for game in self.server.game_id_to_game.values():
+                    if game.expiration_time:
+                        game.expiration_time = time.time() - 1
+                        self.server.update_game_expiration(game)
+                self.server.destroy_expired_games()
+            self.assert_lobby_snapshot_is_current()
+
+
+class TestGameProcesses(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server()
+        self.written = []
+        self.server.transport_write = self.written.append
+        # game processes run in this process, and reply right away
+        self.game_shards = []
+        for _ in range(2):
+            game_shard = server.GameShard()
+            game_process = server.GameProcessProtocol(self.server)
+            game_process.connection_made(
+                types.SimpleNamespace(
+                    write=lambda data, game_shard=game_shard, game_process=game_process: game_process.data_received(
+                        game_shard.handle_lines(data.split(b"\n")[:-1])
+                    )
+                )
+            )
+            self.game_shards.append(game_shard)
+            self.server.game_processes.append(game_process)
+
+    def get_messages(self, client):
+        messages = []
+        for line in b"".join(self.written).splitlines():
+            client_ids, separator, messages_json = line.partition(b" ")
+            if separator and str(client.client_id).encode() in client_ids.split(b","):
+                messages.extend(ujson.decode(messages_json))
+        return messages
+
+    def test_1(self):
+        a = server.Client(self.server, "a", "1.2.3.4", "x", False)
+        b = server.Client(self.server, "b", "1.2.3.4", "y", False)
+        c = server.Client(self.server, "c", "1.2.3.4", "z", False)
+        a.on_message(b"[0,0,4]")
+        self.assertIn([3, 1, 0, 0, 4], self.get_messages(a))
+        c.on_message(b"[0,0,1]")
+        self.assertEqual(list(self.game_shards[0].game_id_to_game), [1])
+        self.assertEqual(list(self.game_shards[1].game_id_to_game), [2])
+        b.on_message(b"[1,1]")
+        game = self.server.game_id_to_game[1]
+        self.assertIsInstance(game, server.GameProxy)
+        self.assertEqual(sorted(game.get_lobby_players()), [["a", 1], ["b", 2]])
+        self.assertEqual(game.client_ids, {1, 2})
+
+        del self.written[:]
+        a.on_message(b"[5,0]")
+        self.assertEqual(game.state, enums.GameStates.InProgress.value)
+        self.assertIn([3, 1, 2], self.get_messages(a))
+        self.assertIn([3, 1, 2], self.get_messages(b))
+
+        # game 2 is full, so b can only watch it
+        b.on_message(b"[4]")
+        b.on_message(b"[1,2]")
+        self.assertIsNone(b.game_id)
+        self.assertIn(b.client_id, self.server.lobby_client_ids)
+        b.on_message(b"[3,2]")
+        self.assertEqual(b.game_id, 2)
+        self.assertEqual(self.server.game_id_to_game[2].watcher_client_ids, {2})
+
+    def test_2(self):
+        a = server.Client(self.server, "a", "1.2.3.4", "x", False)
+        a.on_message(b"[0,0,4]")
+        game = self.server.game_id_to_game[1]
+        a.on_message(b"[4]")
+        self.assertIsNotNone(game.expiration_time)
+        self.assertIn(1, self.server.game_id_to_expiration_timer)
+
+        # a client coming back in the meantime keeps the game
+        self.game_shards[0].game_id_to_game[1].expiration_time = time.time() - 1
+        game.expiration_time = time.time() - 1
+        self.server.update_game_expiration(game)
+        a.on_message(b"[2,1]")
+        self.server.destroy_expired_games()
+        self.assertIn(1, self.server.game_id_to_game)
+        self.assertNotIn(1, self.server.game_id_to_expiration_timer)
+
+        a.on_message(b"[4]")
+        self.game_shards[0].game_id_to_game[1].expiration_time = time.time() - 1
+        game.expiration_time = time.time() - 1
+        self.server.update_game_expiration(game)
+        del self.written[:]
+        self.server.destroy_expired_games()
+        self.assertEqual(self.server.game_id_to_game, {})
+        self.assertEqual(self.game_shards[0].game_id_to_game, {})
+        self.assertEqual(b"".join(self.written), b"1 [[23,1]]\n")
+
+    def test_3(self):
+        # random lobby activity ends the same as with the games in the lobby's process
+        servers = [server.Server(), self.server]
+        for server_ in servers:
+            server_.transport_write = lambda data: None
+            random.seed(0)
+            rng = random.Random(0)
+            usernames = ["a", "b", "c", "d", "e", "f"]
+            for _ in range(300):
+                clients = list(server_.client_id_to_client.values())
+                game_ids = list(server_.game_id_to_game)
+                choice = rng.randrange(7)
+                if choice == 0 or not clients:
+                    username = rng.choice(usernames)
+                    server.Client(server_, username, "1.2.3.4", "x", True)
+                elif choice == 1:
+                    rng.choice(clients).disconnect()
+                elif choice == 2:
+                    rng.choice(clients).on_message(b"[0,0,%d]" % rng.randint(1, 3))
+                elif choice <= 5 and game_ids:
+                    message = b"[%d,%d]" % (choice - 2, rng.choice(game_ids))
+                    rng.choice(clients).on_message(message)
+                elif choice == 6:
+                    rng.choice(clients).on_message(b"[4]")
+
+        self.assertEqual(
+            servers[1].lobby_snapshot.get_games_json(),
+            servers[0].lobby_snapshot.get_games_json(),
+        )
+        self.assertEqual(
+            *[
+                [
+                    (client.client_id, client.game_id)
+                    for client in server_.client_id_to_client.values()
+                ]
+                for server_ in servers
+            ]
+        )
+        self.assertEqual(servers[1].lobby_client_ids, servers[0].lobby_client_ids)
+
+    def test_4(self):
+        process, lobby_socket = server.start_game_process()
+        lobby_socket.settimeout(10)
+        lobby_socket.sendall(
+            b'create-game [1,1,0,4,null]\njoin-game [1,5,"a"]\njoin-game [1,6,"a"]\n'
+        )
+        data = b""
+        while not data.endswith(b"end 3\n"):
+            data += lobby_socket.recv(65536)
+        lines = [line.split(b" ", 1) for line in data.splitlines()]
+        self.assertEqual(
+            [key for key, value in lines if key in (b"game", b"not-in-game")],
+            [b"game", b"not-in-game", b"game"],
+        )
+        game_data = [ujson.decode(value) for key, value in lines if key == b"game"]
+        self.assertEqual(game_data[-1][5], [["a", 5]])
+        lobby_socket.close()
+        process.join(5)
+        self.assertEqual(process.exitcode, 0)
+
+
+class TestServerSubscriptions(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server()
+        self.written = []
+        self.server.transport_write = self.written.append
+        self.a = server.Client(self.server, "a", "1.2.3.4", "x", False)
+        self.b = server.Client(self.server, "b", "1.2.3.4", "y", False)
+        self.b.on_message(b"[0,0,4]")
+
+    def get_messages(self, client):
+        messages = []
+        for line in b"".join(self.written).splitlines():
+            client_ids, separator, messages_json = line.partition(b" ")
+            if separator and str(client.client_id).encode() in client_ids.split(b","):
+                messages.extend(ujson.decode(messages_json))
+        del self.written[:]
+        return messages
+
+    def test_1(self):
+        # in a game without subscriptions
+        self.assertEqual(self.server.lobby_client_ids, {1})
+        self.assertEqual(self.server.global_chat_client_ids, {1})
+        del self.written[:]
+        c = server.Client(self.server, "c", "5.6.7.8", "z", False)
+        self.a.on_message(b'[6,"hi"]')
+        self.assertEqual(self.get_messages(self.b), [])
+        c.on_message(b"[3,1]")
+        messages = self.get_messages(self.b)
+        self.assertEqual(messages[0], [2, 3, "c", "5.6.7.8"])
+        self.assertIn([12, 1, 3], messages)
+
+    def test_2(self):
+        del self.written[:]
+        self.b.on_message(b"[8,false,true]")
+        self.a.on_message(b'[6,"hi"]')
+        self.assertEqual(self.get_messages(self.b), [[21, 1, "hi", "a"]])
+        self.b.on_message(b"[8,true,true]")
+        self.assertEqual(
+            self.get_messages(self.b),
+            [
+                [24],
+                [2, 1, "a", "1.2.3.4"],
+                [2, 2, "b", "1.2.3.4"],
+                [3, 1, 0, 0, 4],
+                [8, 1, 0, 2],
+            ],
+        )
+        self.assertEqual(self.server.lobby_client_ids, {1, 2})
+
+    def test_3(self):
+        server.Client(self.server, "c", "5.6.7.8", "z", False)
+        del self.written[:]
+        self.b.on_message(b"[4]")
+        self.assertEqual(
+            self.get_messages(self.b),
+            [
+                [10, 1, 0, 2],
+                [24],
+                [2, 1, "a", "1.2.3.4"],
+                [2, 2, "b", "1.2.3.4"],
+                [2, 3, "c", "5.6.7.8"],
+                [3, 1, 0, 0, 4],
+                [11, 1, 0, 2],
+            ],
+        )
+        self.assertEqual(self.server.lobby_client_ids, {1, 2, 3})
+        self.assertEqual(self.server.global_chat_client_ids, {1, 2, 3})
+
+    def test_4(self):
+        # clients in the game that were sent a client's data are told when it leaves
+        c = server.Client(self.server, "c", "5.6.7.8", "z", False)
+        c.on_message(b"[3,1]")
+        del self.written[:]
+        c.disconnect()
+        self.assertIn([2, 3, None, None], self.get_messages(self.b))
+
+        # once, when it is in the lobby too
+        self.b.on_message(b"[8,true,true]")
+        c = server.Client(self.server, "c", "5.6.7.8", "z", False)
+        c.on_message(b"[3,1]")
+        del self.written[:]
+        c.disconnect()
+        self.assertEqual(
+            self.get_messages(self.b).count([2, c.client_id, None, None]), 1
+        )
+
+
+def get_random_game_action(game, rng):
+    # random parameters for the current action. they are not always valid.
+    action = game.actions[-1]
+    game_action_id = action.game_action_id
+    if game_action_id == enums.GameActions.StartGame.value:
+        return []
+    elif game_action_id == enums.GameActions.PlayTile.value:
+        return [rng.randrange(6)]
+    elif game_action_id == enums.GameActions.SelectNewChain.value:
+        return [rng.choice(action.game_board_type_ids)]
+    elif game_action_id == enums.GameActions.SelectMergerSurvivor.value:
+        return [rng.choice(sorted(action.type_id_sets[0]))]
+    elif game_action_id == enums.GameActions.SelectChainToDisposeOfNext.value:
+        return [rng.choice(sorted(action.defunct_type_ids))]
+    elif game_action_id == enums.GameActions.DisposeOfShares.value:
+        trade_amount = min(
+            rng.randrange(action.defunct_type_count + 1) // 2 * 2,
+            action.controlling_type_available * 2,
+        )
+        return [
+            trade_amount,
+            rng.randrange(action.defunct_type_count - trade_amount + 1),
+        ]
+    elif game_action_id == enums.GameActions.PurchaseShares.value:
+        score_sheet = game.score_sheet
+        type_ids = [
+            type_id
+            for type_id in range(7)
+            if score_sheet.chain_size[type_id] and score_sheet.available[type_id]
+        ]
+        game_board_type_ids = (
+            [rng.choice(type_ids) for _ in range(rng.randrange(4))] if type_ids else []
+        )
+        return [game_board_type_ids, int(rng.random() < 0.05)]
+
+
+def play_random_game(
+    seed, game_board_class=None, tile_racks_class=None, max_actions=2000, headless=False
+):
+    # returns the messages sent while playing a game with random moves
+    rng = random.Random(seed)
+    tiles = [(x, y) for x in range(12) for y in range(9)]
+    rng.shuffle(tiles)
+    messages = []
+
+    def add_pending_messages(messages_, client_ids=None):
+        messages.append(
+            (
+                [ujson.dumps(message) for message in messages_],
+                None if client_ids is None else sorted(client_ids),
+            )
+        )
+
+    game = server.Game(
+        1,
+        1,
+        enums.GameModes.Singles.value,
+        4,
+        add_pending_messages,
+        False,
+        tiles,
+        headless=headless,
+    )
+    if game_board_class:
+        game.game_board = game_board_class(game)
+    if tile_racks_class:
+        game.tile_racks_class = tile_racks_class
+    clients = []
+    for client_id in range(1, rng.randint(2, 4) + 1):
+        client = types.SimpleNamespace(
+            client_id=client_id,
+            username="user%d" % client_id,
+            game_id=None,
+            player_id=None,
+        )
+        clients.append(client)
+        game.join_game(client)
+
+    for _ in range(max_actions):
+        action = game.actions[-1]
+        if action.game_action_id == enums.GameActions.GameOver.value:
+            break
+        client = [x for x in clients if x.player_id == action.player_id][0]
+        game.do_game_action(
+            client, action.game_action_id, get_random_game_action(game, rng)
+        )
+
+    return game, messages
+
+
+class FullTileRacks(server.TileRacks):
+    # recomputes every tile every time, like TileRacks did before it was incremental
+    def determine_tile_game_board_types(self, player_ids=None):
+        self.index_racks()
+        super().determine_tile_game_board_types(player_ids)
+
+
+class TestTileRacks(unittest.TestCase):
+    def test_1(self):
+        for seed in range(40):
+            for game_board_class in [server.GameBoard, server.BitboardGameBoard]:
+                game1, messages1 = play_random_game(
+                    seed, game_board_class, FullTileRacks
+                )
+                game2, messages2 = play_random_game(seed, game_board_class)
+                self.assertEqual(messages1, messages2)
+                self.assertEqual(game1.tile_racks.racks, game2.tile_racks.racks)
+                self.assertEqual(
+                    game1.actions[-1].game_action_id, enums.GameActions.GameOver.value
+                )
+
+    def test_2(self):
+        # only tiles next to a changed cell are recomputed
+        game, messages = play_random_game(1, max_actions=10)
+        tile_racks = game.tile_racks
+        tile_racks.determine_tile_game_board_types()
+        self.assertEqual(tile_racks.dirty_tile_indexes, [set()] * game.num_players)
+
+        tile = tile_racks.racks[0][0][0]
+        cell = [
+            (x, y)
+            for x, y in server.coordinates_to_neighbors[tile]
+            if game.game_board.x_to_y_to_board_type[x][y]
+            == enums.GameBoardTypes.Nothing.value
+        ][0]
+        game.game_board.set_cell(cell, enums.GameBoardTypes.NothingYet.value)
+        tile_racks._mark_changed_cells()
+
+        expected = [set() for _ in range(game.num_players)]
+        for coordinates in server.coordinates_to_neighbors[cell]:
+            if coordinates in tile_racks.tile_to_rack_slot:
+                player_id, tile_index = tile_racks.tile_to_rack_slot[coordinates]
+                expected[player_id].add(tile_index)
+        self.assertIn(0, expected[0])
+        self.assertEqual(tile_racks.dirty_tile_indexes, expected)
+
+
+class TestGameBoard(unittest.TestCase):
+    def test_1(self):
+        # the bitboard backend sends the same messages, except for the order of cells
+        # within a fill_cells batch
+        for seed in range(20):
+            game1, messages1 = play_random_game(seed, server.GameBoard)
+            game2, messages2 = play_random_game(seed, server.BitboardGameBoard)
+            self.assertEqual(
+                [(sorted(x), y) for x, y in messages1],
+                [(sorted(x), y) for x, y in messages2],
+            )
+            self.assertEqual(
+                game1.game_board.x_to_y_to_board_type,
+                game2.game_board.x_to_y_to_board_type,
+            )
+            for board_type in range(enums.GameBoardTypes.Max.value):
+                self.assertEqual(
+                    game1.game_board.get_chain_size(board_type),
+                    game2.game_board.get_chain_size(board_type),
+                )
+            self.assertEqual(game1.actions[-1].game_action_id, 7)
+
+    def test_2(self):
+        # the union-find backend sends exactly the same messages as the bitboard one
+        for seed in range(40):
+            game1, messages1 = play_random_game(seed, server.BitboardGameBoard)
+            game2, messages2 = play_random_game(seed, server.UnionFindGameBoard)
+            self.assertEqual(messages1, messages2)
+            self.assertEqual(
+                game1.game_board.x_to_y_to_board_type,
+                game2.game_board.x_to_y_to_board_type,
+            )
+            self.assertEqual(
+                game1.game_board.board_type_to_count,
+                game2.game_board.board_type_to_count,
+            )
+
+            # and its groups are the same as when built from the final board
+            game_board = game2.game_board
+            groups = [
+                game_board.index_to_group_mask[game_board._find(index)]
+                for index in range(108)
+            ]
+            game_board._make_groups()
+            self.assertEqual(
+                groups,
+                [
+                    game_board.index_to_group_mask[game_board._find(index)]
+                    for index in range(108)
+                ],
+            )
+
+    def test_3(self):
+        self.assertEqual(server.get_set_game_board_cells_message(7, [13]), [4, 1, 4, 7])
+        self.assertEqual(
+            server.get_set_game_board_cells_message(7, [13, 14, 15, 16, 12, 40, 41]),
+            [25, 7, 13, -3, 12, 40, -1],
+        )
+        rng = random.Random(0)
+        for _ in range(200):
+            indexes = rng.sample(range(108), rng.randint(2, 30))
+            message = server.get_set_game_board_cells_message(3, indexes)
+            self.assertEqual(server.get_set_game_board_cells_indexes(message), indexes)
+
+        # the board built from the messages sent is the game's board, with each backend
+        for game_board_class in [server.GameBoard, server.BitboardGameBoard]:
+            for seed in range(20):
+                game, messages = play_random_game(seed, game_board_class)
+                board = [[enums.GameBoardTypes.Nothing.value] * 9 for _ in range(12)]
+                for messages_json, _ in messages:
+                    for message in map(ujson.decode, messages_json):
+                        if message[0] == enums.CommandsToClient.SetGameBoardCell.value:
+                            board[message[1]][message[2]] = message[3]
+                        elif (
+                            message[0] == enums.CommandsToClient.SetGameBoardCells.value
+                        ):
+                            for index in server.get_set_game_board_cells_indexes(
+                                message
+                            ):
+                                board[index // 9][index % 9] = message[1]
+                self.assertEqual(board, game.game_board.x_to_y_to_board_type)
+
+
+def play_random_game_to_end(game, rng, max_actions=2000):
+    for _ in range(max_actions):
+        action = game.actions[-1]
+        if action.game_action_id == enums.GameActions.GameOver.value:
+            break
+        client = game.score_sheet.player_data[action.player_id][
+            enums.ScoreSheetIndexes.Client.value
+        ]
+        game.do_game_action(
+            client, action.game_action_id, get_random_game_action(game, rng)
+        )
+
+
+def get_game_state(game):
+    return [
+        game.state,
+        game.tile_bag,
+        game.turn_player_id,
+        game.history_messages,
+        game.game_board.x_to_y_to_board_type,
+        game.score_sheet.player_data,
+        game.score_sheet.available,
+        game.score_sheet.chain_size,
+        game.score_sheet.price,
+        game.tile_racks.racks,
+        [(x.__class__, x.player_id, x.additional_params) for x in game.actions],
+    ]
+
+
+class TestGameSnapshot(unittest.TestCase):
+    def test_1(self):
+        # restoring a snapshot and playing the same moves gives the same game again
+        for seed in range(20):
+            game, messages = play_random_game(seed, max_actions=seed * 7 + 1)
+            snapshot = game.snapshot()
+            num_messages = len(messages)
+
+            play_random_game_to_end(game, random.Random(seed))
+            messages1 = messages[num_messages:]
+            state1 = get_game_state(game)
+            self.assertEqual(game.actions[-1].game_action_id, 7)
+
+            for _ in range(2):
+                del messages[num_messages:]
+                game.restore(snapshot)
+                play_random_game_to_end(game, random.Random(seed))
+                self.assertEqual(messages[num_messages:], messages1)
+                self.assertEqual(get_game_state(game), state1)
+
+    def test_2(self):
+        # a snapshot can be restored into another game, without the clients
+        game1, messages1 = play_random_game(3, max_actions=40)
+        snapshot = game1.snapshot()
+        game2 = server.Game(
+            2,
+            2,
+            enums.GameModes.Singles.value,
+            4,
+            lambda *args: None,
+            False,
+            headless=True,
+        )
+        game2.restore(snapshot)
+        state1 = get_game_state(game1)
+        state2 = get_game_state(game2)
+        client_index = enums.ScoreSheetIndexes.Client.value
+        state1[5] = [x[:client_index] for x in state1[5]]
+        state2[5] = [x[:client_index] for x in state2[5]]
+        self.assertEqual(state2, state1)
+        self.assertEqual(
+            [
+                x[enums.ScoreSheetIndexes.Client.value]
+                for x in game2.score_sheet.player_data
+            ],
+            [None] * game1.num_players,
+        )
+        self.assertTrue(all(action.game is game2 for action in game2.actions))
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "checkpoints")
+
+    def tearDown(self):
+        server.checkpoint_writer.close()
+        self.directory.cleanup()
+
+    def test_1(self):
+        # a restored game plays on like the checkpointed one
+        for seed in range(10):
+            game1, messages1 = play_random_game(seed, max_actions=seed * 9 + 1)
+            writer = checkpoint.CheckpointWriter()
+            writer.open(self.filename)
+            writer.write_game(game1.internal_game_id, tuple(game1.get_checkpoint()))
+            writer.close()
+
+            writer = checkpoint.CheckpointWriter()
+            internal_game_id_to_checkpoint, last_internal_game_id = writer.open(
+                self.filename
+            )
+            writer.close()
+            server_ = server.Server()
+            server_.restore_games(
+                internal_game_id_to_checkpoint.values(), last_internal_game_id
+            )
+            game2 = server_.game_id_to_game[game1.game_id]
+            for player_id in range(game2.num_players):
+                game2.rejoin_game(
+                    types.SimpleNamespace(
+                        client_id=player_id + 1,
+                        username="user%d" % (player_id + 1),
+                        game_id=None,
+                        player_id=None,
+                    )
+                )
+
+            for game in [game1, game2]:
+                play_random_game_to_end(game, random.Random(seed))
+            state1 = get_game_state(game1)
+            state2 = get_game_state(game2)
+            client_index = enums.ScoreSheetIndexes.Client.value
+            state1[5] = [x[:client_index] for x in state1[5]]
+            state2[5] = [x[:client_index] for x in state2[5]]
+            self.assertEqual(state2, state1)
+            os.remove(self.filename)
+
+    def test_2(self):
+        # games and ids are restored, without the expired games
+        server1 = server.Server()
+        server1.transport_write = lambda data: None
+        server.checkpoint_writer.open(self.filename)
+        client1 = server.Client(server1, "a", "1.2.3.4", "x", False)
+        client2 = server.Client(server1, "b", "1.2.3.4", "y", False)
+        client3 = server.Client(server1, "c", "1.2.3.4", "z", False)
+        client1.on_message(b"[0,0,4]")
+        client2.on_message(b"[0,0,4]")
+        client3.on_message(b"[1,1]")
+        client1.on_message(b"[5,0]")
+        client2.on_message(b"[4]")
+        game2 = server1.game_id_to_game[2]
+        game2.expiration_time = time.time() - 1
+        server1.update_game_expiration(game2)
+        server1.destroy_expired_games()
+        server.checkpoint_writer.close()
+
+        (
+            internal_game_id_to_checkpoint,
+            last_internal_game_id,
+        ) = server.checkpoint_writer.open(self.filename)
+        self.assertEqual(list(internal_game_id_to_checkpoint), [1])
+        self.assertEqual(last_internal_game_id, 2)
+        server2 = server.Server()
+        server2.restore_games(
+            internal_game_id_to_checkpoint.values(), last_internal_game_id
+        )
+        game1 = server2.game_id_to_game[1]
+        self.assertEqual(game1.state, enums.GameStates.InProgress.value)
+        self.assertEqual(game1.num_players, 2)
+        self.assertEqual(
+            get_game_state(game1)[1:5],
+            get_game_state(server1.game_id_to_game[1])[1:5],
+        )
+        self.assertIn(1, server2.game_id_to_expiration_timer)
+        self.assertEqual(server2.next_game_id_manager.get_id(), 2)
+        self.assertEqual(server2.next_internal_game_id_manager.get_id(), 3)
+
+        # unchanged games are not checkpointed again
+        with open(self.filename, "rb") as f:
+            length = len(f.read())
+        server2.checkpoint_game(game1)
+        server.checkpoint_writer.flush()
+        with open(self.filename, "rb") as f:
+            self.assertEqual(len(f.read()), length)
+
+    def test_3(self):
+        # a record that was still being written is ignored
+        writer = checkpoint.CheckpointWriter()
+        writer.open(self.filename)
+        writer.write_game(5, ("a",))
+        writer.write_game(6, ("b",))
+        writer.write_game(5, ("c",))
+        writer.remove_game(6)
+        writer.close()
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        for length in range(len(checkpoint.magic), len(data) + 1):
+            with open(self.filename, "wb") as f:
+                f.write(data[:length])
+            internal_game_id_to_checkpoint, _ = writer.open(self.filename)
+            writer.close()
+            self.assertIn(
+                internal_game_id_to_checkpoint,
+                [
+                    {},
+                    {5: ("a",)},
+                    {5: ("a",), 6: ("b",)},
+                    {5: ("c",), 6: ("b",)},
+                    {5: ("c",)},
+                ],
+            )
+        self.assertEqual(internal_game_id_to_checkpoint, {5: ("c",)})
+
+    def test_4(self):
+        # only actions that were done are checkpointed
+        server_ = server.Server()
+        server_.transport_write = lambda data: None
+        server.checkpoint_writer.open(self.filename)
+        client1 = server.Client(server_, "a", "1.2.3.4", "x", False)
+        client2 = server.Client(server_, "b", "1.2.3.4", "y", False)
+        client1.on_message(b"[0,0,4]")
+        client2.on_message(b"[1,1]")
+        client1.on_message(b"[5,0]")
+        game = server_.game_id_to_game[1]
+        server.checkpoint_writer.flush()
+        length = os.path.getsize(self.filename)
+        state_version = game.state_version
+
+        player_client = game.score_sheet.player_data[game.actions[-1].player_id][
+            enums.ScoreSheetIndexes.Client.value
+        ]
+        other_client = client2 if player_client is client1 else client1
+        for message in [b"[5,1,7]", b"[5,1,-1]", b'[5,1,"x"]', b"[5,0]"]:
+            player_client.on_message(message)
+        other_client.on_message(b"[5,1,0]")
+        server.checkpoint_writer.flush()
+        self.assertEqual(game.state_version, state_version)
+        self.assertEqual(os.path.getsize(self.filename), length)
+
+        player_client.on_message(b"[5,1,0]")
+        server.checkpoint_writer.flush()
+        self.assertEqual(game.state_version, state_version + 1)
+        self.assertGreater(os.path.getsize(self.filename), length)
+
+    def test_5(self):
+        # the file is compacted while open, so it stays bounded however many actions
+        writer = checkpoint.CheckpointWriter(min_compaction_size=20000)
+        written = 0
+        for seed in range(3):
+            game, _ = play_random_game(seed, max_actions=1)
+            rng = random.Random(seed)
+            writer.open(self.filename)
+            for _ in range(300):
+                action = game.actions[-1]
+                if action.game_action_id == enums.GameActions.GameOver.value:
+                    break
+                client = game.score_sheet.player_data[action.player_id][
+                    enums.ScoreSheetIndexes.Client.value
+                ]
+                game.do_game_action(
+                    client, action.game_action_id, get_random_game_action(game, rng)
+                )
+                for internal_game_id in [1, 2]:
+                    writer.write_game(internal_game_id, tuple(game.get_checkpoint()))
+                writer.remove_game(2)
+                writer.flush()
+                size = os.path.getsize(self.filename)
+                record_size = checkpoint.record_header.size + len(
+                    pickle.dumps(tuple(game.get_checkpoint()), pickle.HIGHEST_PROTOCOL)
+                )
+                written += 2 * record_size
+                # one checkpoint is live, so a larger file is less than half live
+                self.assertEqual(size, writer.num_bytes)
+                self.assertLessEqual(
+                    size,
+                    max(
+                        20000,
+                        2
+                        * (
+                            len(checkpoint.magic)
+                            + checkpoint.record_header.size
+                            + record_size
+                        ),
+                    ),
+                )
+            writer.close()
+        self.assertGreater(writer.compaction_count, 5)
+        self.assertLess(size, written / 10)
+
+        internal_game_id_to_checkpoint, _ = writer.open(self.filename)
+        writer.close()
+        self.assertEqual(
+            internal_game_id_to_checkpoint, {1: tuple(game.get_checkpoint())}
+        )
+
+
+def get_candidate_game_actions(game):
+    # parameters to probe do_game_action with, valid or not
+    action = game.actions[-1]
+    game_action_id = action.game_action_id
+    if game_action_id == enums.GameActions.StartGame.value:
+        candidates = [[]]
+    elif game_action_id == enums.GameActions.PlayTile.value:
+        candidates = [[x] for x in range(-1, 7)]
+    elif game_action_id in {
+        enums.GameActions.SelectNewChain.value,
+        enums.GameActions.SelectMergerSurvivor.value,
+        enums.GameActions.SelectChainToDisposeOfNext.value,
+    }:
+        candidates = [[x] for x in range(-1, 8)]
+    elif game_action_id == enums.GameActions.DisposeOfShares.value:
+        candidates = [[x, y] for x in range(-1, 27) for y in range(-1, 27)]
+    elif game_action_id == enums.GameActions.PurchaseShares.value:
+        candidates = [
+            [list(x), y]
+            for n in range(4)
+            for x in itertools.product(range(-1, 8), repeat=n)
+            for y in [0, 1, 2]
+        ]
+        candidates.append([[0, 1, 2, 3], 0])
+    else:
+        candidates = []
+    return [[game_action_id] + x for x in candidates]
+
+
+class TestGameLegalActions(unittest.TestCase):
+    def test_1(self):
+        # legal_actions returns the game actions do_game_action accepts
+        num_checked = collections.Counter()
+        # seed 15 has a merger of three chains
+        for seed in [0, 1, 15]:
+            game, messages = play_random_game(seed, max_actions=0, headless=True)
+            rng = random.Random(seed)
+            while True:
+                action = game.actions[-1]
+                player_id = action.player_id
+                legal_actions = game.legal_actions(player_id)
+                if action.game_action_id == enums.GameActions.GameOver.value:
+                    self.assertEqual(legal_actions, [])
+                    break
+                self.assertEqual(game.legal_actions(player_id + 1), [])
+                self.assertEqual(game.legal_actions(None), [])
+                client = game.score_sheet.player_data[player_id][
+                    enums.ScoreSheetIndexes.Client.value
+                ]
+
+                snapshot = game.snapshot()
+                accepted = set()
+                for candidate in get_candidate_game_actions(game):
+                    game.do_game_action(client, candidate[0], candidate[1:])
+                    if game.actions[-1] is not action:
+                        game.restore(snapshot)
+                        action = game.actions[-1]
+                        if candidate[0] == enums.GameActions.PurchaseShares.value:
+                            # ending the game is only an option when it can end
+                            candidate[1].sort()
+                            candidate[2] = int(candidate[2] and action.can_end_game)
+                        accepted.add(ujson.dumps(candidate))
+                self.assertEqual(accepted, {ujson.dumps(x) for x in legal_actions})
+                num_checked[action.game_action_id] += 1
+
+                chosen = rng.choice(legal_actions)
+                game.do_game_action(client, chosen[0], chosen[1:])
+                self.assertIsNot(game.actions[-1], action)
+
+        for game_action_id in range(7):
+            self.assertTrue(num_checked[game_action_id], game_action_id)
+
+
+class TestSimulate(unittest.TestCase):
+    def test_1(self):
+        games = [(seed, seed % 5 + 2) for seed in range(5)]
+        num_games, num_actions, stats = simulate.play_games(
+            games, enums.GameModes.Singles.value, True
+        )
+        self.assertEqual(num_games, 5)
+        self.assertEqual(stats["legal_actions"][0], num_actions)
+        self.assertEqual(
+            sum(
+                count
+                for name, (count, seconds) in stats.items()
+                if name != "legal_actions"
+            ),
+            num_actions,
+        )
+        self.assertEqual(stats["ActionStartGame"][0], 5)
+
+        # seeded games play the same
+        self.assertEqual(
+            simulate.play_games(games, enums.GameModes.Singles.value, False)[1],
+            num_actions,
+        )
+
+
+class TestGameHistory(unittest.TestCase):
+    def get_expected_messages(self, game, player_id):
+        messages = []
+        for target_player_id, message in game.history_messages:
+            if target_player_id is None or target_player_id == player_id:
+                if isinstance(message[1], str):
+                    message = list(message)
+                    message[1] = game.score_sheet.username_to_player_id[message[1]]
+                messages.append(message)
+        return messages
+
+    def check(self, game):
+        for player_id in [None] + list(range(game.num_players)):
+            self.assertEqual(
+                ujson.decode(
+                    "[" + game._get_past_history_messages_json(player_id) + "]"
+                ),
+                self.get_expected_messages(game, player_id),
+            )
+
+    def test_1(self):
+        # the cached history messages stay the same as encoding them all every time,
+        # while players join and the game goes on
+        for seed in range(5):
+            rng = random.Random(seed)
+            tiles = [(x, y) for x in range(12) for y in range(9)]
+            rng.shuffle(tiles)
+            game = server.Game(
+                1, 1, enums.GameModes.Singles.value, 6, lambda *args: None, False, tiles
+            )
+            for client_id in range(1, rng.randint(2, 6) + 1):
+                client = types.SimpleNamespace(
+                    client_id=client_id,
+                    username="user%d" % client_id,
+                    game_id=None,
+                    player_id=None,
+                )
+                game.join_game(client)
+                self.check(game)
+
+            while game.actions[-1].game_action_id != enums.GameActions.GameOver.value:
+                action = game.actions[-1]
+                client = game.score_sheet.player_data[action.player_id][
+                    enums.ScoreSheetIndexes.Client.value
+                ]
+                game_action = rng.choice(game.legal_actions(action.player_id))
+                game.do_game_action(client, game_action[0], game_action[1:])
+                if rng.random() < 0.1:
+                    self.check(game)
+            self.check(game)
+
+    def test_2(self):
+        # watchers get the public history messages in one batch
+        batches = []
+        game, messages = play_random_game(2, max_actions=50)
+        history_command = enums.CommandsToClient.AddGameHistoryMessages.value
+
+        def add_pending_batch(batch_json, client_ids=None):
+            if ujson.decode("[" + batch_json + "]")[0][0] == history_command:
+                batches.append((batch_json, client_ids))
+
+        game.add_pending_batch = add_pending_batch
+        watcher = types.SimpleNamespace(
+            client_id=10, username="watcher", game_id=None, player_id=None
+        )
+        game.watch_game(watcher)
+        game.leave_game(watcher)
+        game.watch_game(watcher)
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batches[0], batches[1])
+        batch_json, client_ids = batches[0]
+        self.assertEqual(client_ids, {10})
+        self.assertEqual(
+            ujson.decode(batch_json),
+            [history_command, self.get_expected_messages(game, None)],
+        )
+
+
+class TestGameInitialization(unittest.TestCase):
+    def get_expected_messages(self, game, player_id):
+        messages = [
+            [
+                enums.CommandsToClient.SetGameBoard.value,
+                game.game_board.x_to_y_to_board_type,
+            ],
+            [
+                enums.CommandsToClient.SetScoreSheet.value,
+                [
+                    [
+                        x[: enums.ScoreSheetIndexes.Cash.value + 1]
+                        for x in game.score_sheet.player_data
+                    ],
+                    game.score_sheet.chain_size,
+                ],
+            ],
+        ]
+        if player_id is not None and game.tile_racks:
+            for tile_index, tile_data in enumerate(game.tile_racks.racks[player_id]):
+                if tile_data:
+                    messages.append(
+                        [
+                            enums.CommandsToClient.SetTile.value,
+                            tile_index,
+                            tile_data[0][0],
+                            tile_data[0][1],
+                            tile_data[1],
+                        ]
+                    )
+        messages.append([enums.CommandsToClient.SetTurn.value, game.turn_player_id])
+        action = game.actions[-1]
+        messages.append(
+            [
+                enums.CommandsToClient.SetGameAction.value,
+                action.game_action_id,
+                action.player_id,
+            ]
+            + action.additional_params
+        )
+        return messages
+
+    def test_1(self):
+        # watchers and rejoining players get the current state, and watchers between two
+        # moves share the same encoded messages
+        game, messages = play_random_game(4, max_actions=0)
+        batches = []
+        game.add_pending_batch = lambda batch_json, client_ids: batches.append(
+            batch_json
+        )
+        rng = random.Random(4)
+        watcher_client_id = 100
+        while game.actions[-1].game_action_id != enums.GameActions.GameOver.value:
+            state_version = game.state_version
+            for _ in range(2):
+                watcher = types.SimpleNamespace(
+                    client_id=watcher_client_id,
+                    username="watcher%d" % watcher_client_id,
+                    game_id=None,
+                    player_id=None,
+                )
+                watcher_client_id += 1
+                del batches[:]
+                game._send_initialization_messages(watcher)
+                self.assertEqual(
+                    ujson.decode("[" + batches[0] + "]"),
+                    self.get_expected_messages(game, None),
+                )
+            initialization_json = game.initialization_json
+
+            player_id = rng.randrange(game.num_players)
+            client = game.score_sheet.player_data[player_id][
+                enums.ScoreSheetIndexes.Client.value
+            ]
+            del batches[:]
+            game._send_initialization_messages(client)
+            self.assertEqual(
+                ujson.decode("[" + batches[0] + "]"),
+                self.get_expected_messages(game, player_id),
+            )
+            self.assertIs(game.initialization_json, initialization_json)
+
+            action = game.actions[-1]
+            client = game.score_sheet.player_data[action.player_id][
+                enums.ScoreSheetIndexes.Client.value
+            ]
+            game_action = rng.choice(game.legal_actions(action.player_id))
+            game.do_game_action(client, game_action[0], game_action[1:])
+            self.assertGreater(game.state_version, state_version)
+
+    def test_2(self):
+        # rejected actions change nothing, so the cached messages are kept
+        for seed in range(5):
+            game, messages = play_random_game(seed, max_actions=0)
+            game.add_pending_batch = lambda batch_json, client_ids: None
+            rng = random.Random(seed)
+            while game.actions[-1].game_action_id != enums.GameActions.GameOver.value:
+                action = game.actions[-1]
+                client = game.score_sheet.player_data[action.player_id][
+                    enums.ScoreSheetIndexes.Client.value
+                ]
+                legal_actions = game.legal_actions(action.player_id)
+                # share purchases are also accepted unsorted or asking to end the game
+                invalid_actions = [
+                    x
+                    for x in get_candidate_game_actions(game)
+                    if x not in legal_actions
+                    and (
+                        x[0] != enums.GameActions.PurchaseShares.value
+                        or (x[1] == sorted(x[1]) and x[2] != 1)
+                    )
+                ]
+                game._send_initialization_messages(client)
+                initialization_json = game.initialization_json
+                state_version = game.state_version
+                for game_action in rng.sample(
+                    invalid_actions, min(len(invalid_actions), 5)
+                ):
+                    self.assertFalse(
+                        game.do_game_action(client, game_action[0], game_action[1:])
+                    )
+                self.assertEqual(game.state_version, state_version)
+                game._send_initialization_messages(client)
+                self.assertIs(game.initialization_json, initialization_json)
+
+                game_action = rng.choice(legal_actions)
+                self.assertTrue(
+                    game.do_game_action(client, game_action[0], game_action[1:])
+                )
+
+
+class TestGameHeadless(unittest.TestCase):
+    def test_1(self):
+        # a headless game ends up the same, but only sends the lobby messages
+        lobby_commands = {
+            enums.CommandsToClient.SetGameState.value,
+            enums.CommandsToClient.SetGamePlayerJoin.value,
+        }
+        for seed in range(10):
+            game1, messages1 = play_random_game(seed)
+            game2, messages2 = play_random_game(seed, headless=True)
+            self.assertEqual(game1.history_messages, game2.history_messages)
+            self.assertEqual(
+                game1.game_board.x_to_y_to_board_type,
+                game2.game_board.x_to_y_to_board_type,
+            )
+            self.assertEqual(
+                game1.score_sheet.player_data, game2.score_sheet.player_data
+            )
+            self.assertEqual(game1.tile_racks.racks, game2.tile_racks.racks)
+            self.assertEqual(
+                [x for x in messages1 if ujson.decode(x[0][0])[0] in lobby_commands],
+                messages2,
+            )
+
+
+class TestLogWriter(unittest.TestCase):
+    def setUp(self):
+        self.file = io.StringIO()
+        self.log_writer = server.LogWriter(self.file)
+
+    def test_1(self):
+        self.log_writer.log("time", "time:", 1.5)
+        self.log_writer.log("command-to-server", 3, "->", "[4]")
+        self.log_writer.end_batch()
+        self.log_writer.end_batch()
+        self.assertEqual(self.file.getvalue(), "time: 1.5\n3 -> [4]\n\n")
+
+    def test_2(self):
+        self.log_writer.enabled_categories.discard("command-to-server")
+        self.log_writer.enabled_categories.discard("command-to-client")
+        self.log_writer.start()
+        for x in range(1000):
+            self.log_writer.log("command-to-server", x, "->", "[4]")
+            self.log_writer.log("game", '{"_":"game","game-id":%d}' % x)
+            self.log_writer.log("command-to-client", x, "<-", "[[16,0]]")
+            self.log_writer.end_batch()
+        self.log_writer.stop()
+        self.assertEqual(
+            self.file.getvalue(),
+            "".join('{"_":"game","game-id":%d}\n\n' % x for x in range(1000)),
+        )
+
+    def test_3(self):
+        # no writer thread, so the queue stays full. other lines are still queued.
+        self.log_writer.queue = queue.Queue()
+        self.log_writer.max_queue_size = 1
+        self.log_writer.log("time", "time:", 1.5)
+        self.log_writer.log("command-to-client", 1, "<-", "[]")
+        self.log_writer.log("command-to-server", 1, "->", "[4]")
+        self.log_writer.log("game", '{"_":"game","game-id":1}')
+        self.log_writer.end_batch()
+        self.assertEqual(self.log_writer.dropped_count, 2)
+        self.assertEqual(
+            [self.log_writer.queue.get_nowait() for _ in range(3)],
+            ["time: 1.5\n", '{"_":"game","game-id":1}\n', "\n"],
+        )
+
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "events")
+        writer = event_log.EventLogWriter()
+        writer.open(self.filename)
+        writer.write(event_log.EventTypes.Game, 1.0, 5, {"_": "game", "game-id": 5})
+        writer.write(event_log.EventTypes.GameAction, 2.0, 5, {"data": [3]})
+        writer.write(event_log.EventTypes.Game, 3.0, 6, {"_": "game", "game-id": 6})
+        writer.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_1(self):
+        with open(self.filename, "rb") as f:
+            reader = event_log.EventReader(f)
+            events = list(reader.events([event_log.EventTypes.Game]))
+            end_offset = f.tell()
+        self.assertEqual(
+            [(e.time, e.internal_game_id, e.data) for e in events],
+            [
+                (1.0, 5, {"_": "game", "game-id": 5}),
+                (3.0, 6, {"_": "game", "game-id": 6}),
+            ],
+        )
+        self.assertEqual(reader.offset, end_offset)
+
+        with open(self.filename, "rb") as f:
+            reader = event_log.EventReader(f, events[1].offset)
+            self.assertEqual([e.time for e in reader.events()], [3.0])
+
+    def test_2(self):
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        for length in range(len(data)):
+            with open(self.filename, "wb") as f:
+                f.write(data[:length])
+            for event_types in [None, [event_log.EventTypes.GameAction]]:
+                with open(self.filename, "rb") as f:
+                    try:
+                        reader = event_log.EventReader(f)
+                    except ValueError:
+                        continue
+                    for event in reader.events(event_types):
+                        pass
+                self.assertLessEqual(reader.offset, length)
+                self.assertIn(reader.offset, (17, 58, 87, 128))
+
+
+def get_server_log(seed, num_games=3, num_frontends=1):
+    # plays random games through frontends, the games taking turns between them, and
+    # returns the text log. a frontend connects before its first game.
+    rng = random.Random(seed)
+    file = io.StringIO()
+    log_writer_file = server.log_writer.file
+    server.log_writer.file = file
+    try:
+        server_ = server.Server()
+        frontends = []
+
+        def send(line):
+            frontend.data_received(line.encode() + b"\n")
+
+        for game_index in range(num_games):
+            if len(frontends) < num_frontends:
+                frontends.append(server.ServerProtocol(server_))
+                frontends[-1].connection_made(FakeFrontendTransport())
+            frontend = frontends[game_index % num_frontends]
+            num_players = rng.randint(2, 4)
+            client_ids = []
+            for player_id in range(num_players):
+                username = "p%d-%d" % (game_index, player_id)
+                send('connect ["%s","1.2.3.4","%s",false]' % (username, username))
+                client_ids.append(server_.username_to_client[username].client_id)
+            send("%d [0,0,%d]" % (client_ids[0], num_players))
+            game = server_.game_id_to_game[
+                server_.client_id_to_client[client_ids[0]].game_id
+            ]
+            for client_id in client_ids[1:]:
+                send("%d [1,%d]" % (client_id, game.game_id))
+            while game.actions[-1].game_action_id != enums.GameActions.GameOver.value:
+                action = game.actions[-1]
+                client = game.score_sheet.player_data[action.player_id][
+                    enums.ScoreSheetIndexes.Client.value
+                ]
+                game_action = rng.choice(game.legal_actions(action.player_id))
+                send("%d %s" % (client.client_id, ujson.dumps([5] + game_action)))
+            for client_id in client_ids:
+                send("disconnect %d" % client_id)
+        for frontend in frontends:
+            frontend.connection_lost(None)
+    finally:
+        server.log_writer.file = log_writer_file
+    return file.getvalue()
+
+
+class TestLogIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.directory.name, "logs_py"))
+        self.log_timestamp = 2000000000
+        self.filename = os.path.join(
+            self.directory.name, "logs_py", str(self.log_timestamp)
+        )
+        self.log = get_server_log(0, 6).encode()
+        with open(self.filename, "wb") as f:
+            f.write(self.log)
+
+        self.checkpoint_interval = logs_to_games.LogIndexer.checkpoint_interval
+        logs_to_games.LogIndexer.checkpoint_interval = 5000
+        self.path_prefixes = settings.util__get_log_file_filenames__path_prefixes
+        settings.util__get_log_file_filenames__path_prefixes = [
+            os.path.join(self.directory.name, "logs_")
+        ]
+        util._log_type_to_log_file_filenames.clear()
+
+    def tearDown(self):
+        logs_to_games.LogIndexer.checkpoint_interval = self.checkpoint_interval
+        settings.util__get_log_file_filenames__path_prefixes = self.path_prefixes
+        util._log_type_to_log_file_filenames.clear()
+        self.directory.cleanup()
+
+    def check_open_log_file_for_game(self, filename, games):
+        # each game is read from a checkpoint before it, and the file is then read to
+        # the end like the original
+        for internal_game_id, game in games:
+            f, checkpoint = logs_to_games.open_log_file_for_game(
+                filename, internal_game_id
+            )
+            self.assertLessEqual(checkpoint["offset"], game["begin-offset"])
+            self.assertEqual(f.read(), self.log[checkpoint["offset"] :].decode())
+            raw_file = getattr(f.buffer, "fileobj", f.buffer)
+            f.close()
+            self.assertTrue(raw_file.closed)
+
+    def test_1(self):
+        index = logs_to_games.index_log_file(self.log_timestamp, self.filename)
+        self.assertGreater(len(index["checkpoints"]), 3)
+        self.assertEqual([x for x, _ in index["games"]], [1, 2, 3, 4, 5, 6])
+        for internal_game_id, game in index["games"]:
+            self.assertIn(
+                b'"game-id":%d' % internal_game_id,
+                self.log[game["begin-offset"] : game["end-offset"]],
+            )
+        self.check_open_log_file_for_game(self.filename, index["games"])
+
+        # gzipped, the index is kept and the log is read from the same checkpoints
+        logs_to_games.gzip_log_file(self.filename)
+        self.assertEqual(
+            util.get_log_file_filenames("py"),
+            [(self.log_timestamp, self.filename + ".gz")],
+        )
+        gzip_index = util.read_log_index(self.filename + ".gz")
+        self.assertTrue(all("gzip-offset" in x for x in gzip_index["checkpoints"]))
+        self.assertEqual(ujson.dumps(gzip_index["games"]), ujson.dumps(index["games"]))
+        self.check_open_log_file_for_game(self.filename + ".gz", index["games"])
+
+        # and without an index, from the start
+        os.remove(util.get_log_index_filename(self.filename))
+        f, checkpoint = logs_to_games.open_log_file_for_game(self.filename + ".gz", 1)
+        with f:
+            self.assertIsNone(checkpoint)
+            self.assertEqual(f.read(), self.log.decode())
+
+    def test_2(self):
+        # a log with several frontends is one run of the server, read to the end
+        log = get_server_log(1, 6, 2)
+        self.assertEqual(log.count("\nconnection_made\n"), 1)
+        self.assertEqual(log.count("\nfrontend_connected "), 2)
+        self.assertEqual(log.count("\nfrontend_disconnected "), 2)
+
+        lines = log.splitlines()
+        log_parser = logs_to_games.LogParser(
+            self.log_timestamp, io.StringIO(log + "time: 1\nconnection_made\n")
+        )
+        parsed_lines = list(log_parser.go())
+        self.assertEqual([x[2] for x in parsed_lines[:-1]], lines + ["time: 1"])
+        self.assertNotIn(None, [x[0] for x in parsed_lines])
+        frontend_ids = [
+            x[3][0] for x in parsed_lines if x[0] == logs_to_games.LineTypes.frontend
+        ]
+        self.assertEqual(frontend_ids, frontend_ids[:2] * 2)
+        self.assertNotEqual(frontend_ids[0], frontend_ids[1])
+
+        index = logs_to_games.LogIndexer(
+            self.log_timestamp, io.BytesIO(log.encode())
+        ).go()
+        self.assertEqual([x for x, _ in index["games"]], [1, 2, 3, 4, 5, 6])
+        log_processor = logs_to_games.LogProcessor(self.log_timestamp, io.StringIO(log))
+        self.assertEqual(
+            sorted(game.internal_game_id for game in log_processor.go()),
+            [1, 2, 3, 4, 5, 6],
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,11 +1,14 @@
 import gzip
+import io
 import os
 import os.path
 import re
 import settings
+import ujson
 
 _log_type_to_log_file_filenames = {}
 re_timestamp_in_path = re.compile(r"([^/]*?)(\.gz)?$")
+re_log_index_filename = re.compile(r".*\.index$")
 
 
 def get_log_file_filenames(log_type, begin=None, end=None):
@@ -18,7 +21,8 @@ def get_log_file_filenames(log_type, begin=None, end=None):
         for path_prefix in settings.util__get_log_file_filenames__path_prefixes:
             path = path_prefix + log_type
             for filename in os.listdir(path):
-                filenames.append(os.path.join(path, filename))
+                if not re_log_index_filename.match(filename):
+                    filenames.append(os.path.join(path, filename))
 
         timestamps_and_filenames = [
             (int(re_timestamp_in_path.search(filename).group(1)), filename)
@@ -43,9 +47,59 @@ def get_log_file_filenames(log_type, begin=None, end=None):
 re_gzip_filename = re.compile(r".*\.gz$")
 
 
-def open_possibly_gzipped_file(filename):
+def open_possibly_gzipped_file(filename, binary=False):
     if re_gzip_filename.match(filename):
+        f = gzip.open(filename, "rb" if binary else "rt")
+    else:
+        f = open(filename, "rb" if binary else "r")
+    return f
+
+
+# a log file's index is next to it and shared by its gzipped version.
+# see logs_to_games.LogIndexer for the contents.
+def get_log_index_filename(filename):
+    if re_gzip_filename.match(filename):
+        filename = filename[:-3]
+    return filename + ".index"
+
+
+def read_log_index(filename):
+    try:
+        with open(get_log_index_filename(filename)) as f:
+            return ujson.decode(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def write_log_index(filename, index):
+    with open(get_log_index_filename(filename), "w") as f:
+        f.write(ujson.dumps(index))
+
+
+def get_log_index_checkpoint(index, offset=None, time=None):
+    # the last checkpoint at or before offset and/or time
+    result = index["checkpoints"][0]
+    for checkpoint in index["checkpoints"]:
+        if offset is not None and checkpoint["offset"] > offset:
+            break
+        if time is not None and (checkpoint["time"] or 0) > time:
+            break
+        result = checkpoint
+    return result
+
+
+def open_possibly_gzipped_file_at_checkpoint(filename, checkpoint):
+    if re_gzip_filename.match(filename):
+        if "gzip-offset" in checkpoint:
+            # the file was written with a gzip member starting at each checkpoint
+            raw_file = open(filename, "rb")
+            raw_file.seek(checkpoint["gzip-offset"])
+            gzip_file = gzip.GzipFile(fileobj=raw_file)
+            # closed with gzip_file, as if it had opened the file itself
+            gzip_file.myfileobj = raw_file
+            return io.TextIOWrapper(gzip_file)
         f = gzip.open(filename, "rt")
     else:
         f = open(filename)
+    f.seek(checkpoint["offset"])
     return f
@@ -0,0 +1,203 @@
+import base64
+import enum
+import hashlib
+import re
+import struct
+import ujson
+
+# the parts of RFC 6455 the server needs: the opening handshake, and frames. frames from
+# clients are masked, frames from the server are not.
+accept_guid = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+max_handshake_size = 16384
+max_message_size = 1048576
+
+# sockjs clients connect to /<prefix>/<server id>/<session id>/websocket and wrap their
+# messages in json arrays of strings
+re_sockjs_path = re.compile(r"^/[^?]*/[^/?.]+/[^/?.]+/websocket/?(?:\?.*)?$")
+
+
+class Opcodes(enum.Enum):
+    Continuation = 0
+    Text = 1
+    Binary = 2
+    Close = 8
+    Ping = 9
+    Pong = 10
+
+
+class HandshakeError(Exception):
+    pass
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# returns (path, headers, size) for a complete upgrade request, with lowercase header
+# names and the number of bytes it took. returns None if more data is needed.
+def parse_handshake(data):
+    end_index = data.find(b"\r\n\r\n")
+    if end_index < 0:
+        if len(data) > max_handshake_size:
+            raise HandshakeError("handshake too large")
+        return None
+
+    lines = bytes(data[:end_index]).decode("latin-1").split("\r\n")
+    request_line = lines[0].split(" ")
+    if len(request_line) != 3 or request_line[0] != "GET":
+        raise HandshakeError("bad request line")
+
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(":")
+        if not separator:
+            raise HandshakeError("bad header line")
+        headers[name.strip().lower()] = value.strip()
+
+    if "websocket" not in headers.get("upgrade", "").lower():
+        raise HandshakeError("not a websocket upgrade")
+    if headers.get("sec-websocket-version") != "13":
+        raise HandshakeError("unsupported websocket version")
+    if "sec-websocket-key" not in headers:
+        raise HandshakeError("missing sec-websocket-key")
+
+    return request_line[1], headers, end_index + 4
+
+
+def get_accept_key(key):
+    return base64.b64encode(hashlib.sha1(key.encode() + accept_guid).digest()).decode()
+
+
+def get_handshake_response(key):
+    return (
+        "HTTP/1.1 101 Switching Protocols\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        "Sec-WebSocket-Accept: " + get_accept_key(key) + "\r\n\r\n"
+    ).encode()
+
+
+def encode_frame(payload, opcode=Opcodes.Text):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode.value, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode.value, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode.value, 127, length)
+    return header + payload
+
+
+def encode_close_frame(code=1000):
+    return encode_frame(struct.pack("!H", code), Opcodes.Close)
+
+
+def unmask(payload, mask):
+    # xor all of it at once as one big integer, which is much faster than byte by byte
+    length = len(payload)
+    if not length:
+        return b""
+    mask = (mask * (length // 4 + 1))[:length]
+    return (
+        int.from_bytes(payload, "little") ^ int.from_bytes(mask, "little")
+    ).to_bytes(length, "little")
+
+
+# splits the bytes received from a client into messages. feed returns a list of
+# (opcode, payload) pairs, with fragmented messages joined and control frames passed
+# through as they arrive.
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.fragments_opcode = None
+        self.fragments = []
+        self.fragments_size = 0
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        index = 0
+        len_buffer = len(buffer)
+        while len_buffer - index >= 2:
+            byte1 = buffer[index]
+            byte2 = buffer[index + 1]
+            if byte1 & 0x70:
+                raise ProtocolError("reserved bits set")
+            if not byte2 & 0x80:
+                raise ProtocolError("unmasked client frame")
+
+            length = byte2 & 0x7F
+            header_size = 6
+            if length == 126:
+                header_size = 8
+                if len_buffer - index < header_size:
+                    break
+                length = struct.unpack_from("!H", buffer, index + 2)[0]
+            elif length == 127:
+                header_size = 14
+                if len_buffer - index < header_size:
+                    break
+                length = struct.unpack_from("!Q", buffer, index + 2)[0]
+            if length > max_message_size:
+                raise ProtocolError("frame too large")
+            if len_buffer - index < header_size + length:
+                break
+
+            mask_index = index + header_size - 4
+            payload = unmask(
+                bytes(buffer[index + header_size : index + header_size + length]),
+                bytes(buffer[mask_index : mask_index + 4]),
+            )
+            index += header_size + length
+
+            try:
+                opcode = Opcodes(byte1 & 0x0F)
+            except ValueError:
+                raise ProtocolError("unknown opcode")
+            final = byte1 & 0x80
+
+            if opcode.value >= Opcodes.Close.value:
+                if not final or length > 125:
+                    raise ProtocolError("bad control frame")
+                messages.append((opcode, payload))
+            elif opcode == Opcodes.Continuation:
+                if self.fragments_opcode is None:
+                    raise ProtocolError("unexpected continuation frame")
+                self._add_fragment(payload)
+                if final:
+                    messages.append((self.fragments_opcode, b"".join(self.fragments)))
+                    self.fragments_opcode = None
+                    self.fragments = []
+                    self.fragments_size = 0
+            else:
+                if self.fragments_opcode is not None:
+                    raise ProtocolError("expected continuation frame")
+                if final:
+                    messages.append((opcode, payload))
+                else:
+                    self.fragments_opcode = opcode
+                    self._add_fragment(payload)
+
+        del buffer[:index]
+        return messages
+
+    def _add_fragment(self, payload):
+        self.fragments_size += len(payload)
+        if self.fragments_size > max_message_size:
+            raise ProtocolError("message too large")
+        self.fragments.append(payload)
+
+
+def encode_sockjs_messages(messages_json):
+    return b"a" + ujson.dumps([messages_json]).encode()
+
+
+def decode_sockjs_messages(payload):
+    # sockjs clients send a json array of strings, or sometimes a single string
+    messages = ujson.decode(payload)
+    if isinstance(messages, str):
+        return [messages]
+    if not isinstance(messages, list) or not all(isinstance(x, str) for x in messages):
+        raise ProtocolError("bad sockjs message")
+    return messages